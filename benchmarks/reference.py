@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Former implementations of pyMolNetEnhancer functions, which the benchmarks time and check the current ones against.
+"""
+# Standard library imports
+import re
+
+# Third party imports
+import pandas as pd
+
+def make_classy_table_regex(jsondic):
+    """make_classy_table as of pyMolNetEnhancer 0.1.9, testing for each field with a regex over all keys"""
+    dmetadatalist = []
+    for idx,entry in enumerate(jsondic):
+        mdict = {}
+        if (entry != {} and entry != None):
+            if sum([bool(re.match('smiles', x)) for x in entry.keys()]) > 0 and entry['smiles'] is not None:
+                mdict['smiles'] = entry['smiles']
+            if sum([bool(re.match('inchikey', x)) for x in entry.keys()]) > 0 and entry['inchikey'] is not None:
+                mdict['inchikey'] = entry['inchikey']
+            if sum([bool(re.match('kingdom', x)) for x in entry.keys()]) > 0 and entry['kingdom'] is not None:
+                mdict['kingdom'] = entry['kingdom']['name']
+            if sum([bool(re.match('superclass', x)) for x in entry.keys()]) > 0 and entry['superclass'] is not None :
+                mdict['superclass'] = entry['superclass']['name']
+            if sum([bool(re.match('class', x)) for x in entry.keys()]) > 0 and entry['class'] is not None :
+                mdict['class'] = entry['class']['name']
+            if sum([bool(re.match('subclass', x)) for x in entry.keys()]) > 0 and entry['subclass'] is not None:
+                mdict['subclass'] = entry['subclass']['name']
+            if sum([bool(re.match('direct_parent', x)) for x in entry.keys()]) > 0 and entry['direct_parent'] is not None:
+                mdict['direct_parent'] = entry['direct_parent']['name']
+            if sum([bool(re.match('molecular_framework', x)) for x in entry.keys()]) > 0 and entry['molecular_framework'] is not None:
+                mdict['molecular_framework'] = entry['molecular_framework']
+        else:
+            for field in ['smiles', 'inchikey', 'kingdom', 'superclass', 'class', 'subclass', 'direct_parent', 'molecular_framework']:
+                mdict[field] = "None"
+        dmetadatalist.append(mdict)
+    return pd.DataFrame.from_dict(dmetadatalist)
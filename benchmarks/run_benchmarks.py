@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of the main pyMolNetEnhancer functions on synthetic networks of growing size.
+
+All inputs are generated offline with fixed seeds by synthetic.py. For each function and
+network size, the wall time (best of --repeat runs) and the peak memory traced by
+tracemalloc (in a separate run, as tracing slows Python down) are reported, together with
+the scaling exponent between consecutive sizes (1 is linear, 2 quadratic). Former
+implementations kept in reference.py are timed alongside, after checking once per size
+that they give the same result as the current ones.
+
+Results can be saved as JSON and compared with a saved baseline. The script exits with
+status 1 if a function got slower, needs more memory or scales worse than in the baseline.
+
+Usage: python benchmarks/run_benchmarks.py [--sizes N ...] [--only NAME ...] [--repeat N] [--no-memory]
+                                           [--save results.json] [--baseline baseline.json]
+"""
+# Standard library imports
+import argparse
+import functools
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Third party imports
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from pyMolNetEnhancer import unique_smiles, Mass2Motif_2_Network, make_motif_graphml, write_motif_graphml, write_motif_network, molfam_classes, highestscore, make_classy_table, make_classyfire_graphml, write_classyfire_graphml, iter_motif_edges
+
+import reference
+import synthetic
+
+@functools.lru_cache(maxsize=1)
+def _network(n_nodes):
+    net, df, inchi_dic = synthetic.synthetic_network(n_nodes)
+    return net, df, inchi_dic, synthetic.gnps_edges(net), synthetic.ms2lda_motifs(net)
+
+@functools.lru_cache(maxsize=1)
+def _motif_network(n_nodes):
+    net, df, inchi_dic, edges, motifs = _network(n_nodes)
+    return Mass2Motif_2_Network(edges.copy(), motifs, expand=False)
+
+@functools.lru_cache(maxsize=1)
+def _classes(n_nodes):
+    net, df, inchi_dic, edges, motifs = _network(n_nodes)
+    graph = nx.from_pandas_edgelist(edges.astype({'CLUSTERID1': str, 'CLUSTERID2': str}), 'CLUSTERID1', 'CLUSTERID2')
+    return graph, molfam_classes(net.copy(), df, inchi_dic)
+
+@functools.lru_cache(maxsize=1)
+def _classyfire_source(n_nodes):
+    # the edges of the network written once as GraphML, removed with the directory when dropped from the cache
+    graph, final = _classes(n_nodes)
+    tmp = tempfile.TemporaryDirectory()
+    nx.write_graphml(nx.Graph(graph.edges()), os.path.join(tmp.name, 'network.graphml'))
+    return tmp
+
+# worker processes of the benchmarks of parallel code paths, fixed so that results compare across machines
+parallel_jobs = 4
+
+# each benchmark prepares its inputs, untimed, and returns the call to time
+
+def bench_unique_smiles(n_nodes):
+    net, df, inchi_dic, edges, motifs = _network(n_nodes)
+    matches = synthetic.library_matches(net)
+    return lambda: unique_smiles(matches)
+
+def bench_mass2motif(n_nodes):
+    net, df, inchi_dic, edges, motifs = _network(n_nodes)
+    edges = edges.copy()
+    return lambda: Mass2Motif_2_Network(edges, motifs)
+
+def bench_make_motif_graphml(n_nodes):
+    network = _motif_network(n_nodes)
+    edges = pd.concat(iter_motif_edges(network['edges']))
+    return lambda: make_motif_graphml(network['nodes'], edges)
+
+def bench_write_motif_graphml(n_nodes):
+    network = _motif_network(n_nodes)
+    def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            write_motif_graphml(network['nodes'], network['edges'], os.path.join(tmp, 'Motif_Network.graphml'))
+    return run
+
+def bench_write_motif_network(n_nodes):
+    net, df, inchi_dic, edges, motifs = _network(n_nodes)
+    def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            write_motif_network(edges, motifs, os.path.join(tmp, 'Mass2Motifs_Edges.tsv'), graphml=os.path.join(tmp, 'Motif_Network.graphml'))
+    return run
+
+def bench_molfam_classes(n_nodes):
+    net, df, inchi_dic, edges, motifs = _network(n_nodes)
+    net = net.copy()
+    return lambda: molfam_classes(net, df, inchi_dic)
+
+def bench_molfam_classes_parallel(n_nodes):
+    net, df, inchi_dic, edges, motifs = _network(n_nodes)
+    net = net.copy()
+    return lambda: molfam_classes(net, df, inchi_dic, n_jobs=parallel_jobs)
+
+def bench_highestscore(n_nodes):
+    net, df, inchi_dic, edges, motifs = _network(n_nodes)
+    a, score = synthetic.components(net, inchi_dic)
+    chem_dic = synthetic.level_dictionary(df, inchi_dic)
+    return lambda: highestscore(a, chem_dic, score)
+
+@functools.lru_cache(maxsize=1)
+def _classyfire_entities(n_nodes):
+    # checked once per size: the current and the 0.1.9 make_classy_table give the same table, "None" rows of missing entities included
+    net, df, inchi_dic, edges, motifs = _network(n_nodes)
+    entities = synthetic.classyfire_entities(df)
+    pd.testing.assert_frame_equal(make_classy_table(entities), reference.make_classy_table_regex(entities))
+    return entities
+
+def bench_make_classy_table(n_nodes):
+    entities = _classyfire_entities(n_nodes)
+    return lambda: make_classy_table(entities)
+
+def bench_make_classy_table_regex(n_nodes):
+    entities = _classyfire_entities(n_nodes)
+    return lambda: reference.make_classy_table_regex(entities)
+
+def bench_make_classyfire_graphml(n_nodes):
+    graph, final = _classes(n_nodes)
+    return lambda: make_classyfire_graphml(graph, final)
+
+def bench_write_classyfire_graphml(n_nodes):
+    graph, final = _classes(n_nodes)
+    tmp = _classyfire_source(n_nodes)
+    def run():
+        write_classyfire_graphml(os.path.join(tmp.name, 'network.graphml'), final, os.path.join(tmp.name, 'ClassyFireResults_Network.graphml'))
+    return run
+
+benchmarks = {'unique_smiles': bench_unique_smiles,
+              'Mass2Motif_2_Network': bench_mass2motif,
+              'make_motif_graphml': bench_make_motif_graphml,
+              'write_motif_graphml': bench_write_motif_graphml,
+              'write_motif_network': bench_write_motif_network,
+              'molfam_classes': bench_molfam_classes,
+              'molfam_classes_parallel': bench_molfam_classes_parallel,
+              'highestscore': bench_highestscore,
+              'make_classy_table': bench_make_classy_table,
+              'make_classy_table_regex': bench_make_classy_table_regex,
+              'make_classyfire_graphml': bench_make_classyfire_graphml,
+              'write_classyfire_graphml': bench_write_classyfire_graphml}
+
+def measure(bench, n_nodes, repeat=1, memory=True):
+    """Time a benchmark at one network size, and trace its peak memory
+
+    :return: A dictionary of the best wall time in seconds and the peak traced memory in MB
+    :rtype: dict
+    """
+    seconds = []
+    for i in range(repeat):
+        run = bench(n_nodes)
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+    result = {'seconds': min(seconds)}
+    if memory:
+        run = bench(n_nodes)
+        tracemalloc.start()
+        try:
+            run()
+            result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+    return result
+
+def scaling(timings, min_seconds=1e-3):
+    """Scaling exponents between consecutive network sizes, log(t2 / t1) / log(n2 / n1)
+
+    :param timings: A dictionary of network sizes and results of measure
+    :type timings: dict
+    :return: A dictionary of network sizes and the exponent from the next smaller size, None where too fast to tell
+    :rtype: dict
+    """
+    sizes = sorted(timings, key=int)
+    slopes = {sizes[0]: None} if sizes else {}
+    for small, large in zip(sizes[:-1], sizes[1:]):
+        t1, t2 = timings[small]['seconds'], timings[large]['seconds']
+        slopes[large] = math.log(t2 / t1) / math.log(int(large) / int(small)) if t1 >= min_seconds else None
+    return slopes
+
+def compare(results, baseline, time_tolerance=0.25, memory_tolerance=0.25, slope_tolerance=0.2, min_seconds=0.05):
+    """Compare results with a baseline of the same format
+
+    Differences below min_seconds, or 1 MB of memory, are taken as noise.
+
+    :return: Messages describing each regression
+    :rtype: list
+    """
+    regressions = []
+    for name, timings in results.items():
+        before = baseline.get(name, {})
+        slopes, slopes_before = scaling(timings, min_seconds), scaling(before, min_seconds)
+        for size, result in timings.items():
+            if size not in before:
+                continue
+            old = before[size]
+            if result['seconds'] > old['seconds'] * (1 + time_tolerance) and result['seconds'] - old['seconds'] > min_seconds:
+                regressions.append('%s at %s nodes: %.3f s, was %.3f s' % (name, size, result['seconds'], old['seconds']))
+            if 'peak_mb' in result and 'peak_mb' in old and result['peak_mb'] > old['peak_mb'] * (1 + memory_tolerance) and result['peak_mb'] - old['peak_mb'] > 1:
+                regressions.append('%s at %s nodes: peak %.1f MB, was %.1f MB' % (name, size, result['peak_mb'], old['peak_mb']))
+            if slopes.get(size) is not None and slopes_before.get(size) is not None and slopes[size] - slopes_before[size] > slope_tolerance:
+                regressions.append('%s at %s nodes: scales as n^%.2f, was n^%.2f' % (name, size, slopes[size], slopes_before[size]))
+    return regressions
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'networkx': nx.__version__}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark pyMolNetEnhancer on synthetic networks')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000], help='network sizes in nodes (default: %(default)s)')
+    parser.add_argument('--only', nargs='+', choices=list(benchmarks), default=list(benchmarks), help='functions to benchmark (default: all)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs to take the best wall time of (default: %(default)s)')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='do not trace peak memory')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of earlier results to flag regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative increase of time and memory (default: %(default)s)')
+    options = parser.parse_args(argv)
+
+    # by size, so that each network is generated once
+    results = {name: {} for name in options.only}
+    print('%-24s %10s %10s %10s %8s' % ('function', 'nodes', 'seconds', 'peak MB', 'scaling'))
+    for n_nodes in sorted(options.sizes):
+        for name in options.only:
+            results[name][str(n_nodes)] = measure(benchmarks[name], n_nodes, options.repeat, options.memory)
+            slope = scaling(results[name])[str(n_nodes)]
+            result = results[name][str(n_nodes)]
+            print('%-24s %10d %10.3f %10s %8s' % (name, n_nodes, result['seconds'],
+                                                 '%.1f' % result['peak_mb'] if 'peak_mb' in result else '-',
+                                                 '%.2f' % slope if slope is not None else '-'))
+            sys.stdout.flush()
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], options.tolerance, options.tolerance)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        if regressions:
+            return 1
+        print('No regressions against %s' % options.baseline)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
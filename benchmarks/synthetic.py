@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Seeded generators of synthetic GNPS networks, library matches, MS2LDA motif summaries,
+ClassyFire tables and ClassyFire entities for the benchmarks. Nothing is downloaded; the same seed always gives the same tables.
+"""
+# Standard library imports
+import zlib
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+levels = ['kingdom', 'superclass', 'CF_class', 'subclass', 'direct_parent', 'molecular_framework']
+
+def synthetic_network(n_nodes, seed=0):
+    """Create a network table, ClassyFire table and InChIKey dictionary of a given size
+
+    About a third of the nodes are singletons (componentindex -1), the rest fall into
+    molecular families of ~8 nodes and half of all nodes carry 1-3 InChIKeys.
+    """
+    rng = np.random.RandomState(seed)
+    comp = rng.randint(1, max(2, n_nodes // 8), n_nodes)
+    comp[rng.rand(n_nodes) < 0.3] = -1
+    net = pd.DataFrame({'cluster index': np.arange(1, n_nodes + 1), 'componentindex': comp})
+
+    n_keys = max(1, n_nodes // 2)
+    keys = np.array(['KEY%08d-UHFFFAOYSA-N' % i for i in range(n_keys)])
+    df = pd.DataFrame({'inchikey': keys})
+    for i, level in enumerate(levels):
+        df[level] = ['%s_%d' % (level, x) for x in rng.randint(0, 4 + 4 * i, n_keys)]
+
+    annotated = np.flatnonzero(rng.rand(n_nodes) < 0.5) + 1
+    inchi_dic = {int(k): list(rng.choice(keys, rng.randint(1, 4))) for k in annotated}
+    return net, df, inchi_dic
+
+def gnps_edges(net, seed=0, extra=0.5):
+    """Create a GNPS edge table ('networkedges_selfloop') for a network table of synthetic_network
+
+    Members of a molecular family are chained in order of cluster index, with about extra
+    additional edges per node between members two or three places apart. Singletons and
+    families of a single node get a self loop with componentindex -1.
+    """
+    rng = np.random.RandomState(seed)
+    net = net.sort_values(['componentindex', 'cluster index'], kind='mergesort')
+    nodes = net['cluster index'].values
+    comp = net['componentindex'].values.copy()
+    sizes = pd.Series(comp).map(pd.Series(comp).value_counts()).values
+    comp[sizes == 1] = -1
+
+    pairs = [np.column_stack([nodes[:-1], nodes[1:]])[(comp[:-1] == comp[1:]) & (comp[1:] != -1)]]
+    for step in (2, 3):
+        pick = np.flatnonzero(rng.rand(len(nodes) - step) < extra / 2)
+        pick = pick[(comp[pick] == comp[pick + step]) & (comp[pick] != -1)]
+        pairs.append(np.column_stack([nodes[pick], nodes[pick + step]]))
+    pairs = np.concatenate(pairs)
+    singles = nodes[comp == -1]
+    component = pd.Series(comp, index=nodes)
+
+    n_pairs = len(pairs)
+    edges = pd.DataFrame({'CLUSTERID1': np.concatenate([pairs[:, 0], singles]),
+                          'CLUSTERID2': np.concatenate([pairs[:, 1], singles]),
+                          'DeltaMZ': np.concatenate([np.round(rng.normal(0, 50, n_pairs), 4), np.zeros(len(singles))]),
+                          'MEH': 0.0,
+                          'Cosine': np.concatenate([np.round(0.7 + 0.3 * rng.rand(n_pairs), 4), np.ones(len(singles))]),
+                          'OtherScore': np.concatenate([np.round(rng.rand(n_pairs), 4), np.ones(len(singles))]),
+                          'ComponentIndex': np.concatenate([component.loc[pairs[:, 0]].values, np.full(len(singles), -1)])})
+    return edges
+
+def library_matches(net, seed=0, per_node=1.0):
+    """Create a GNPS library match table ('#Scan#', 'Smiles') and an in silico annotation table ('Scan', 'NAP_SMILES') for a network table of synthetic_network
+
+    Each table has about per_node rows per node over a third of the nodes. A tenth of the
+    library matches have no SMILES, in silico annotations hold 1-3 comma separated SMILES.
+    """
+    rng = np.random.RandomState(seed)
+    nodes = net['cluster index'].values
+    features = rng.choice(nodes, max(1, len(nodes) // 3), replace=False)
+    n_matches = max(1, int(len(nodes) * per_node))
+    smiles = np.array(['C' * i + 'O' * j for i in range(1, 60) for j in range(0, 40)], dtype=object)
+
+    library = pd.DataFrame({'#Scan#': rng.choice(features, n_matches),
+                            'Smiles': smiles[rng.randint(0, len(smiles), n_matches)]})
+    library.loc[rng.rand(n_matches) < 0.1, 'Smiles'] = np.nan
+    nap = pd.DataFrame({'Scan': rng.choice(features, n_matches),
+                        'NAP_SMILES': [','.join(smiles[rng.randint(0, len(smiles), rng.randint(1, 4))]) for i in range(n_matches)]})
+    return [library, nap]
+
+def ms2lda_motifs(net, n_motifs=50, seed=0, annotated=0.8):
+    """Create an MS2LDA motif summary for a network table of synthetic_network
+
+    A fraction annotated of the nodes carries 1-3 Mass2Motifs, drawn for most nodes from a
+    few motifs typical of their molecular family, so that neighbours share motifs.
+    """
+    rng = np.random.RandomState(seed)
+    scans = net['cluster index'].values
+    scans = scans[rng.rand(len(scans)) < annotated]
+    family = pd.Series(net['componentindex'].values, index=net['cluster index'].values).loc[scans].values
+
+    per_scan = rng.randint(1, 4, len(scans))
+    scan = np.repeat(scans, per_scan)
+    typical = (np.repeat(family, per_scan) * 7 + rng.randint(0, 4, len(scan))) % n_motifs
+    motif = np.where(rng.rand(len(scan)) < 0.8, typical, rng.randint(0, n_motifs, len(scan)))
+
+    motifs = pd.DataFrame({'scans': scan, 'motif': ['motif_%d' % m for m in motif]}).drop_duplicates()
+    n = len(motifs)
+    motifs.insert(1, 'precursormass', np.round(100.0 + motifs['scans'].values % 900, 4))
+    motifs.insert(2, 'parentrt', np.round(60.0 + motifs['scans'].values % 1200 / 2.0, 2))
+    motifs.insert(3, 'document', motifs['scans'].values)
+    motifs['probability'] = np.round(rng.rand(n), 4)
+    motifs['overlap'] = np.round(rng.rand(n), 4)
+    return motifs.reset_index(drop=True)
+
+def classyfire_entities(df, seed=0, missing=0.05):
+    """Create ClassyFire entities, with the keys returned by the ClassyFire API, for the InChIKeys and classes of a ClassyFire table of synthetic_network
+
+    A fraction missing of the InChIKeys has no entity (None), a fifth of the entities has no subclass.
+    """
+    rng = np.random.RandomState(seed)
+    def node(name):
+        return {'name': name, 'description': '', 'chemont_id': 'CHEMONTID:%07d' % (zlib.crc32(name.encode()) % 10000000), 'url': ''}
+    entities = []
+    for i, row in enumerate(df.itertuples(index=False)):
+        if rng.rand() < missing:
+            entities.append(None)
+            continue
+        entities.append({
+            'smiles': 'C' * (i % 20 + 1), 'inchikey': 'InChIKey=' + row.inchikey,
+            'kingdom': node(row.kingdom), 'superclass': node(row.superclass),
+            'class': node(row.CF_class), 'subclass': node(row.subclass) if rng.rand() < 0.8 else None,
+            'intermediate_nodes': [], 'direct_parent': node(row.direct_parent),
+            'alternative_parents': [node('alternative_%d' % x) for x in rng.randint(0, 3000, 3)],
+            'molecular_framework': row.molecular_framework, 'substituents': ['a', 'b', 'c'],
+            'description': 'A synthetic entity.', 'external_descriptors': [], 'ancestors': ['x', 'y'],
+            'predicted_chebi_terms': [], 'predicted_lipidmaps_terms': [], 'classification_version': '2.1'})
+    return entities
+
+def level_dictionary(df, inchi_dic, level='kingdom'):
+    """Map each node of inchi_dic to the classes of its InChIKeys at one level, the chem_dic of highestscore"""
+    classes = df.set_index('inchikey')[level].to_dict()
+    return {node: [classes[k] for k in keys] for node, keys in inchi_dic.items()}
+
+def components(net, inchi_dic):
+    """Lists of the annotated cluster indexes of each molecular family, and the family sizes, the a and score of highestscore"""
+    families = net[net['componentindex'] != -1].groupby('componentindex')['cluster index'].agg(lambda x: x.tolist())
+    a = [[x for x in nodes if x in inchi_dic] for nodes in families]
+    return a, [len(nodes) for nodes in families]
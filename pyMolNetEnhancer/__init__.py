@@ -1,2 +1,9 @@
 name = "pyMolNetEnhancer"
-from .molnetenhancer import unique_smiles, unique_inchis, make_inchidic, make_inchidic_INCHIS, highestscore, molfam_classes, make_classy_table, get_structure_class_entity, get_structure_class, structure_query, iupac_query, get_results, get_entity, get_chemont_node, tabular_query, sdf_query, _prevent_overwrite, run_shell_command,  run_parallel_shellcommands, run_parallel_job, get_classifications, Mass2Motif_2_Network, make_classyfire_graphml, make_motif_graphml
+from .molnetenhancer import unique_smiles, unique_inchis, structure_inchikeys, make_inchidic, make_inchidic_INCHIS, highestscore, highestscores, molfam_classes, make_classy_table, get_structure_class_entity, get_structure_class, structure_query, iupac_query, get_results, get_entity, get_chemont_node, tabular_query, sdf_query, _prevent_overwrite, run_shell_command,  run_parallel_shellcommands, run_parallel_job, get_classifications, install_cache, uninstall_cache, http_cache, Mass2Motif_2_Network, top_shared_motifs, iter_motif_edges, write_motif_edges, write_motif_network, motif_lookup, motif_overlap_matrix, make_classyfire_graphml, write_classyfire_graphml, make_motif_graphml, write_motif_graphml
+from .cache import EntityCache, StructureCache
+from .client import ClassyFireClient, RateLimiter
+from .tables import read_table, iter_table, write_table, write_chunks, read_gnps_nodes, read_gnps_edges, read_motifs, read_classyfire_table, read_classyfire_results
+from .incremental import component_signatures, save_state, load_state, update_molfam_classes, update_classyfire_graphml
+from .links import StructureLinks
+from .graphml import GraphMLWriter, map_node_attributes
+from .metrics import Metrics
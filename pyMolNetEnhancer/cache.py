@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk caches for ClassyFire lookups and for the InChIKeys of structures.
+"""
+# Standard library imports
+import json
+import sqlite3
+import threading
+import time
+
+from . import metrics
+
+
+def _normalize_inchikey(inchikey):
+    return inchikey.replace('InChIKey=', '')
+
+
+class EntityCache(object):
+    """A persistent cache of ClassyFire entities keyed by InChIKey, stored in a SQLite file
+
+    Entities are stored as parsed JSON. InChIKeys for which ClassyFire has no entity are
+    stored as negative results, which expire after negative_ttl seconds so that they are
+    looked up again once ClassyFire may have classified the structure.
+
+    :param path: Path of the SQLite file, created if it does not exist
+    :type path: str
+    :param negative_ttl: Seconds after which a negative result is looked up again, None keeps negative results forever
+    :type negative_ttl: float
+
+    >>> cache = EntityCache('classyfire_cache.sqlite')
+    >>> hits = cache.get_many(['ATUOYWHBWRKTHZ-UHFFFAOYSA-N'])
+    """
+
+    def __init__(self, path='classyfire_cache.sqlite', negative_ttl=7 * 24 * 3600):
+        self.path = path
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS entities '
+                               '(inchikey TEXT PRIMARY KEY, entity TEXT, fetched REAL NOT NULL)')
+            self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (inchikey TEXT PRIMARY KEY)')
+
+    def get_many(self, inchikeys):
+        """Look up many InChIKeys with a single indexed query
+
+        :param inchikeys: InChIKeys, with or without 'InChIKey=' prefix
+        :type inchikeys: list
+        :return: A dictionary of the InChIKeys found in the cache and their entity, None for unexpired negative results
+        :rtype: dict
+        """
+        keys = {}
+        for inchikey in inchikeys:
+            keys.setdefault(_normalize_inchikey(inchikey), []).append(inchikey)
+        if self.negative_ttl is None:
+            oldest = float('-inf')
+        else:
+            oldest = time.time() - self.negative_ttl
+
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR IGNORE INTO lookup VALUES (?)', ((k,) for k in keys))
+            rows = self._conn.execute('SELECT e.inchikey, e.entity FROM lookup l JOIN entities e ON e.inchikey = l.inchikey '
+                                      'WHERE e.entity IS NOT NULL OR e.fetched >= ?', (oldest,)).fetchall()
+            self._conn.execute('DELETE FROM lookup')
+
+        hits = {}
+        for key, entity in rows:
+            entity = json.loads(entity) if entity is not None else None
+            for inchikey in keys[key]:
+                hits[inchikey] = entity
+        metrics.count('cache.hits', len(hits))
+        metrics.count('cache.misses', sum(len(k) for k in keys.values()) - len(hits))
+        return hits
+
+    def get(self, inchikey, default=None):
+        """Look up a single InChIKey
+
+        :param inchikey: An InChIKey, with or without 'InChIKey=' prefix
+        :type inchikey: str
+        :param default: Returned if the InChIKey is not in the cache or its negative result expired
+        :return: The cached entity, None for a negative result
+        :rtype: dict
+        """
+        return self.get_many([inchikey]).get(inchikey, default)
+
+    def put_many(self, items):
+        """Store many entities
+
+        :param items: Pairs of InChIKey and entity, None for InChIKeys ClassyFire has no entity for
+        :type items: iterable
+        """
+        now = time.time()
+        rows = [(_normalize_inchikey(k), json.dumps(e) if e is not None else None, now) for k, e in items]
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO entities VALUES (?, ?, ?)', rows)
+        metrics.count('cache.writes', len(rows))
+
+    def put(self, inchikey, entity):
+        """Store a single entity, None for an InChIKey ClassyFire has no entity for"""
+        self.put_many([(inchikey, entity)])
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM entities').fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StructureCache(object):
+    """A persistent store of the InChIKeys of structures (SMILES or InChIs), stored in a SQLite file
+
+    Structures that could not be converted are stored with the reason, so that they are not
+    converted again either. Unlike negative ClassyFire results these do not expire, as
+    converting the same structure again gives the same result.
+
+    :param path: Path of the SQLite file, created if it does not exist
+    :type path: str
+
+    >>> cache = StructureCache('structure_cache.sqlite')
+    >>> hits = cache.get_many(['CC(=O)Oc1ccccc1C(=O)O'])
+    """
+
+    def __init__(self, path='structure_cache.sqlite'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS structures '
+                               '(structure TEXT PRIMARY KEY, inchikey TEXT, error TEXT, converted REAL NOT NULL)')
+            self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (structure TEXT PRIMARY KEY)')
+
+    def get_many(self, structures):
+        """Look up many structures with a single indexed query
+
+        :param structures: SMILES or InChIs
+        :type structures: list
+        :return: A dictionary of the structures found in the cache and pairs of their InChIKey and the reason the conversion failed, one of them None
+        :rtype: dict
+        """
+        keys = set(structures)
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR IGNORE INTO lookup VALUES (?)', ((k,) for k in keys))
+            rows = self._conn.execute('SELECT s.structure, s.inchikey, s.error FROM lookup l '
+                                      'JOIN structures s ON s.structure = l.structure').fetchall()
+            self._conn.execute('DELETE FROM lookup')
+
+        hits = {structure: (inchikey, error) for structure, inchikey, error in rows}
+        metrics.count('structure_cache.hits', len(hits))
+        metrics.count('structure_cache.misses', len(keys) - len(hits))
+        return hits
+
+    def get(self, structure, default=None):
+        """Look up a single structure
+
+        :param structure: A SMILES or InChI
+        :type structure: str
+        :param default: Returned if the structure is not in the cache
+        :return: The InChIKey and the reason the conversion failed, one of them None
+        :rtype: tuple
+        """
+        return self.get_many([structure]).get(structure, default)
+
+    def put_many(self, items):
+        """Store the InChIKeys of many structures
+
+        :param items: Triples of structure, InChIKey and the reason the conversion failed, None for structures that were converted
+        :type items: iterable
+        """
+        now = time.time()
+        rows = [(structure, inchikey, error, now) for structure, inchikey, error in items]
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO structures VALUES (?, ?, ?, ?)', rows)
+        metrics.count('structure_cache.writes', len(rows))
+
+    def put(self, structure, inchikey, error=None):
+        """Store the InChIKey of a single structure, or the reason it could not be converted"""
+        self.put_many([(structure, inchikey, error)])
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM structures').fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Command-line batch runner for the MolNetEnhancer pipeline.
+
+Each GNPS job is a directory holding the unzipped 'Download Cytoscape data' export of a
+GNPS job, as used in the example notebooks. Chemical classes are mapped through
+unique_smiles, InChIKey conversion, ClassyFire lookup, molfam_classes and
+make_classyfire_graphml. Mass2Motifs are mapped through Mass2Motif_2_Network and
+make_motif_graphml for jobs that also hold an MS2LDA motif summary.
+
+Usage: pymolnetenhancer [options] DIRECTORY [DIRECTORY ...]
+"""
+# Standard library imports
+import argparse
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from . import incremental
+from . import metrics
+from . import molnetenhancer
+from . import tables
+
+# subdirectories of a GNPS job holding each input, in order of preference
+network_dirs = ('clusterinfo_summary', 'clusterinfosummarygroup_attributes_withIDs_withcomponentID', 'clusterinfosummary')
+library_dirs = ('DB_result', 'result_specnets_DB')
+edge_dirs = ('networkedges_selfloop', 'networking_pairs_results_file_filtered')
+
+stages = ('read', 'unique_smiles', 'inchikeys', 'classyfire', 'molfam_classes', 'classyfire_graphml',
+          'mass2motif', 'motif_graphml')
+
+def find_job_files(jobdir, motifs = 'ms2lda_summary.csv'):
+    """Locate the input files of a GNPS job
+
+    :param jobdir: Directory of the unzipped GNPS job
+    :type jobdir: str
+    :param motifs: File name of the MS2LDA motif summary within jobdir
+    :type motifs: str
+    :return: A dictionary of paths to the node table ('network'), library matches ('library'), edge table ('edges'), GNPS network file ('graphml') and motif summary ('motifs'), None where missing
+    :rtype: dict
+
+    """
+    def first(subdirs):
+        for subdir in subdirs:
+            path = os.path.join(jobdir, subdir)
+            if os.path.isdir(path):
+                files = sorted(f for f in os.listdir(path) if not f.endswith(tables.sidecar_suffix))
+                if files:
+                    return os.path.join(path, files[0])
+        return None
+
+    graphml = sorted(f for f in os.listdir(jobdir) if f.endswith('.graphml') and ('FEATURE' in f or 'METABOLOMICS' in f))
+    motifs = os.path.join(jobdir, motifs)
+
+    return {'network': first(network_dirs),
+            'library': first(library_dirs),
+            'edges': first(edge_dirs),
+            'graphml': os.path.join(jobdir, graphml[0]) if graphml else None,
+            'motifs': motifs if os.path.isfile(motifs) else None}
+
+def find_jobs(directories):
+    """List GNPS job directories: each directory that holds a GNPS job itself, otherwise its subdirectories that do
+
+    :param directories: Directories of GNPS jobs or directories containing GNPS jobs
+    :type directories: list
+    :return: Paths of GNPS job directories
+    :rtype: list
+
+    """
+    def is_job(path):
+        return os.path.isdir(path) and any(os.path.isdir(os.path.join(path, d)) for d in network_dirs + edge_dirs)
+
+    jobs = []
+    for directory in directories:
+        if is_job(directory):
+            jobs.append(directory)
+        else:
+            jobs.extend(os.path.join(directory, d) for d in sorted(os.listdir(directory)) if is_job(os.path.join(directory, d)))
+    return jobs
+
+@contextlib.contextmanager
+def _timed(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def _table_path(path, options):
+    if options.table_format == 'parquet':
+        return os.path.splitext(path)[0] + '.parquet'
+    return path
+
+def _write_table(table, path, options, index = False):
+    path = _table_path(path, options)
+    if options.table_format == 'parquet':
+        tables.write_table(table, path, index=index)
+    else:
+        table.to_csv(path, sep='\t', index=index)
+    return path
+
+def _checksum(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def run_classes(files, outdir, options, timings, counts = None):
+    """Map chemical classes of a GNPS job and write ClassyFireResults_Network.txt and ClassyFireResults_Network.graphml
+
+    SMILES that could not be converted are written to SMILES_failed.tsv with the reason. With
+    options.structure_cache, InChIKeys of SMILES are kept across jobs and runs and only new
+    SMILES are converted. With options.incremental, the state of the previous run is kept in
+    outdir/state, which also holds the InChIKeys of SMILES if no options.structure_cache is
+    given, and only new SMILES are converted, only new InChIKeys are looked up, InChIKeys
+    ClassyFire had no entity for not until their negative result expires, only changed components are
+    scored and only changed nodes are mapped onto the previous ClassyFireResults_Network.graphml.
+
+    :param counts: Dictionary receiving the number of converted SMILES, looked up InChIKeys, scored components and mapped nodes
+    :type counts: dict
+    :return: A dataframe containing most predominant chemical classes per node as returned by molfam_classes
+    :rtype: pandas.core.frame.DataFrame
+    """
+    import pandas as pd
+    from .cache import EntityCache, StructureCache
+    from .client import ClassyFireClient
+
+    counts = counts if counts is not None else {}
+    statedir = os.path.join(outdir, 'state')
+    state = incremental.load_state(statedir) if options.incremental else None
+
+    with _timed(timings, 'read'):
+        net = tables.read_gnps_nodes(files['network'], cache=options.parquet_cache)
+        library = tables.read_table(files['library'], cache=options.parquet_cache)
+        library = library[[c for c in library.columns if c in ('Scan', '#Scan#') or re.search('Smiles|SMILES', c)]]
+
+    with _timed(timings, 'unique_smiles'):
+        smiles = molnetenhancer.unique_smiles([library], compact=True)
+
+    with _timed(timings, 'inchikeys'):
+        store = options.structure_cache
+        if store is None and options.incremental:
+            os.makedirs(statedir, exist_ok=True)
+            store = os.path.join(statedir, 'structures.sqlite')
+        store = StructureCache(store) if store else None
+        smiles = molnetenhancer.structure_inchikeys(smiles, cache=store, n_jobs=options.inchikey_workers)
+        if store is not None:
+            store.close()
+        counts['converted_smiles'] = smiles['converted']
+        inchi_dic = molnetenhancer.make_inchidic(smiles)
+        _write_table(smiles['failed'], os.path.join(outdir, 'SMILES_failed.tsv'), options)
+
+    with _timed(timings, 'classyfire'):
+        inchikeys = list(collections.OrderedDict.fromkeys(smiles['df'].inchikey))
+        lookup = incremental.new_inchikeys(inchikeys, state)
+        counts['looked_up_inchikeys'] = len(lookup)
+        cache = EntityCache(options.cache) if options.cache else None
+        entities = cache.get_many(lookup) if cache is not None else {}
+        fetched = []
+        # InChIKeys ClassyFire has no entity for, server errors aside
+        missing = [k for k in lookup if k in entities and entities[k] is None]
+        with ClassyFireClient(base_url=options.classyfire_url, max_workers=options.classyfire_workers,
+                              rate=options.classyfire_rate) as client:
+            for inchikey, entity, cacheable in client.iter_entities([k for k in lookup if k not in entities]):
+                entities[inchikey] = entity
+                if cacheable:
+                    fetched.append((inchikey, entity))
+                    if entity is None:
+                        missing.append(inchikey)
+        if cache is not None:
+            cache.put_many(fetched)
+            cache.close()
+        df = molnetenhancer.make_classy_table([entities[k] for k in lookup])
+        # levels no entity has a class at are missing from make_classy_table
+        df = df.rename(columns = {'class':'CF_class','smiles':'SMILES'}).reindex(columns=tables.classyfire_columns)
+        df = incremental.update_classes(df, state, inchikeys)
+        missing = incremental.update_missing(missing, state, lookup, inchikeys)
+
+    with _timed(timings, 'molfam_classes'):
+        if options.incremental:
+            final = incremental.update_molfam_classes(net, df, inchi_dic, state, n_jobs=options.scoring_workers)
+            counts['scored_components'] = final.attrs['scored_components']
+        else:
+            final = molnetenhancer.molfam_classes(net, df, inchi_dic, n_jobs=options.scoring_workers)
+        # components without matches have empty scores, missing values as after reading ClassyFireResults_Network.txt
+        for column in [c for c in final.columns if c.endswith('_score')]:
+            final[column] = pd.to_numeric(final[column], errors='coerce')
+    _write_table(final, os.path.join(outdir, 'ClassyFireResults_Network.txt'), options)
+
+    checksum = None
+    if files['graphml']:
+        with _timed(timings, 'classyfire_graphml'):
+            output = os.path.join(outdir, 'ClassyFireResults_Network.graphml')
+            checksum = _checksum(files['graphml'])
+            # patch the previous network file if it was made from the same GNPS network file
+            if state is not None and state['meta'].get('graphml') == checksum and os.path.isfile(output):
+                nodes = incremental.changed_nodes(final, state)
+                incremental.update_classyfire_graphml(output, final, nodes)
+                counts['mapped_nodes'] = len(nodes)
+            else:
+                counts['mapped_nodes'] = molnetenhancer.write_classyfire_graphml(files['graphml'], final, output)
+
+    if options.incremental:
+        incremental.save_state(statedir, net, df, inchi_dic, final, missing=missing, graphml=checksum)
+
+    return final
+
+def run_motifs(files, outdir, options, timings, final = None):
+    """Map Mass2Motifs of a GNPS job and write Mass2Motifs_Edges.tsv, Mass2Motifs_Nodes.tsv and Motif_Network.graphml, and Motif_ChemicalClass_Network.graphml if chemical classes are given
+
+    :param final: Most predominant chemical classes per node as returned by molfam_classes
+    :type final: pandas.core.frame.DataFrame
+    """
+    with _timed(timings, 'read'):
+        motifs = tables.read_motifs(files['motifs'], cache=options.parquet_cache)
+
+    # edges are mapped, and written with Motif_Network.graphml, chunk by chunk
+    with _timed(timings, 'mass2motif'):
+        motif_network = molnetenhancer.write_motif_network(files['edges'], motifs, _table_path(os.path.join(outdir, 'Mass2Motifs_Edges.tsv'), options),
+                                                           prob=options.prob, overlap=options.overlap, top=options.top,
+                                                           graphml=os.path.join(outdir, 'Motif_Network.graphml'), cache=options.parquet_cache)
+    _write_table(motif_network['nodes'], os.path.join(outdir, 'Mass2Motifs_Nodes.tsv'), options, index=True)
+
+    if final is not None:
+        with _timed(timings, 'motif_graphml'):
+            molnetenhancer.write_classyfire_graphml(os.path.join(outdir, 'Motif_Network.graphml'), final, os.path.join(outdir, 'Motif_ChemicalClass_Network.graphml'))
+
+def process_job(jobdir, options):
+    """Run all pipeline stages the inputs of a GNPS job allow
+
+    :param jobdir: Directory of the unzipped GNPS job
+    :type jobdir: str
+    :param options: Parsed command-line options
+    :type options: argparse.Namespace
+    :return: A dictionary with the job directory ('job'), output directory ('output'), seconds per stage ('timings'), work done per stage ('counts'), the timings, counters and request latencies recorded by the pipeline functions as returned by Metrics.as_dict ('metrics') and the traceback if the job failed ('error')
+    :rtype: dict
+
+    """
+    outdir = os.path.join(options.output, os.path.basename(os.path.normpath(jobdir))) if options.output else os.path.join(jobdir, 'pyMolNetEnhancer')
+    os.makedirs(outdir, exist_ok=True)
+    timings = collections.OrderedDict()
+    counts = collections.OrderedDict()
+    error = None
+
+    start = time.perf_counter()
+    with metrics.collect() as registry:
+        try:
+            files = find_job_files(jobdir, options.motifs)
+            final = None
+            if 'classes' in options.pipelines and files['network'] and files['library']:
+                final = run_classes(files, outdir, options, timings, counts)
+            if 'motifs' in options.pipelines and files['edges'] and files['motifs']:
+                run_motifs(files, outdir, options, timings, final)
+        except Exception:
+            error = traceback.format_exc()
+    timings['total'] = time.perf_counter() - start
+
+    result = {'job': jobdir, 'output': outdir, 'timings': timings, 'counts': counts, 'metrics': registry.as_dict(), 'error': error}
+    with open(os.path.join(outdir, 'timings.json'), 'w') as f:
+        json.dump(result, f, indent=2)
+    return result
+
+def parse_args(argv = None):
+    """Parse command-line options, see pymolnetenhancer --help"""
+    parser = argparse.ArgumentParser(prog='pymolnetenhancer', description='Map chemical classes and Mass2Motifs onto GNPS molecular networks of many GNPS jobs.')
+    parser.add_argument('directories', nargs='+', help='GNPS job directories (unzipped "Download Cytoscape data" exports), or directories containing them')
+    parser.add_argument('-o', '--output', help='output directory, with one subdirectory per job (default: a pyMolNetEnhancer subdirectory in each job directory)')
+    parser.add_argument('--pipelines', nargs='+', choices=('classes', 'motifs'), default=['classes', 'motifs'], help='pipelines to run (default: both)')
+    parser.add_argument('--motifs', default='ms2lda_summary.csv', help='file name of the MS2LDA motif summary in each job directory (default: %(default)s)')
+    parser.add_argument('--prob', type=float, default=0.01, help='minimal probability score of a Mass2Motif (default: %(default)s)')
+    parser.add_argument('--overlap', type=float, default=0.3, help='minimal overlap score of a Mass2Motif (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=5, help='number of most shared Mass2Motifs per molecular family (default: %(default)s)')
+    parser.add_argument('--cache', help='SQLite file caching ClassyFire entities across jobs and runs')
+    parser.add_argument('--structure-cache', help='SQLite file keeping the InChIKeys of SMILES across jobs and runs (default: with --incremental, a file in the state subdirectory)')
+    parser.add_argument('--classyfire-url', help='ClassyFire server (default: the GNPS ClassyFire proxy)')
+    parser.add_argument('--incremental', action='store_true', help='keep the state of each job in a state subdirectory of its output directory and only redo work for what changed since the previous run')
+    parser.add_argument('--table-format', choices=('tsv', 'parquet'), default='tsv', help='format of output tables (default: %(default)s)')
+    parser.add_argument('--parquet-cache', action='store_true', help='keep Parquet copies of GNPS input tables next to them in the job directories, and read those on later runs')
+    parser.add_argument('--metrics', help='JSON file receiving the timings, counters and ClassyFire request latencies of all jobs added up')
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), default='WARNING', help='level of log messages of the pipeline functions (default: %(default)s)')
+
+    workers = parser.add_argument_group('workers per stage')
+    workers.add_argument('-j', '--jobs', type=int, default=1, help='GNPS jobs processed in parallel (default: %(default)s)')
+    workers.add_argument('--inchikey-workers', type=int, default=1, help='processes converting SMILES to InChIKeys per job (default: %(default)s)')
+    workers.add_argument('--scoring-workers', type=int, default=1, help='processes scoring molecular families per job, -1 for one per CPU (default: %(default)s)')
+    workers.add_argument('--classyfire-workers', type=int, default=16, help='concurrent ClassyFire requests per job (default: %(default)s)')
+    workers.add_argument('--classyfire-rate', type=float, default=20.0, help='ClassyFire requests per second per job (default: %(default)s)')
+    return parser.parse_args(argv)
+
+def _report(results):
+    for result in results:
+        timings = ', '.join(['%s %.1fs' % (s, t) for s, t in result['timings'].items()] + ['%s %d' % (c, n) for c, n in result['counts'].items()])
+        if result['error']:
+            print('%s failed after %s\n%s' % (result['job'], timings, result['error']), file=sys.stderr)
+        else:
+            print('%s: %s' % (result['job'], timings), file=sys.stderr)
+        yield result
+
+def main(argv = None):
+    """Entry point of the pymolnetenhancer command, returning the exit status"""
+    options = parse_args(argv)
+    logging.basicConfig(level=options.log_level, format='%(asctime)s %(processName)s %(name)s %(levelname)s %(message)s')
+    jobs = find_jobs(options.directories)
+    if not jobs:
+        print('No GNPS jobs found in %s' % ', '.join(options.directories), file=sys.stderr)
+        return 2
+
+    if options.jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=options.jobs) as pool:
+            results = pool.map(process_job, jobs, [options] * len(jobs))
+            results = list(_report(results))
+    else:
+        results = list(_report(process_job(job, options) for job in jobs))
+
+    if options.output:
+        with open(os.path.join(options.output, 'timings.tsv'), 'w') as f:
+            f.write('\t'.join(('job',) + stages + ('total', 'status')) + '\n')
+            for result in results:
+                f.write('\t'.join([result['job']] + ['%.3f' % result['timings'][s] if s in result['timings'] else '' for s in stages + ('total',)]
+                                  + ['failed' if result['error'] else 'ok']) + '\n')
+
+    if options.metrics:
+        # jobs run in worker processes record into registries of their own
+        total = metrics.Metrics()
+        for result in results:
+            total.merge(result['metrics'])
+        total.to_json(options.metrics)
+
+    failed = [r for r in results if r['error']]
+    print('%d of %d jobs done' % (len(results) - len(failed), len(results)), file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Concurrent ClassyFire client with connection pooling, rate limiting and retries.
+"""
+# Standard library imports
+import collections
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlparse
+
+from . import metrics
+from . import molnetenhancer
+
+
+class RateLimiter(object):
+    """A thread safe token bucket allowing rate requests per second with bursts of up to burst requests
+
+    :param rate: Requests per second, None for no limit
+    :type rate: float
+    :param burst: Maximal number of requests sent at once
+    :type burst: int
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate is None:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class ClassyFireClient(object):
+    """Retrieve ClassyFire entities concurrently over a pooled requests.Session
+
+    Requests go out from at most max_workers threads, are limited to rate requests per
+    second and host, and are retried with exponential backoff on connection errors,
+    429 (honouring Retry-After) and 5xx responses. Counters of requests, retries, errors
+    and response status codes are kept in stats.
+
+    :param base_url: ClassyFire server, defaults to the GNPS ClassyFire proxy
+    :type base_url: str
+    :param max_workers: Maximal number of concurrent requests
+    :type max_workers: int
+    :param rate: Maximal number of requests per second and host, None for no limit
+    :type rate: float
+    :param max_retries: Maximal number of retries per request
+    :type max_retries: int
+    :param backoff: Initial backoff in seconds, doubled with every retry
+    :type backoff: float
+    :param max_backoff: Maximal backoff in seconds
+    :type max_backoff: float
+    :param timeout: Timeout of a single request in seconds
+    :type timeout: float
+
+    >>> client = ClassyFireClient(max_workers=16, rate=20)
+    >>> for inchikey, entity, cacheable in client.iter_entities(['ATUOYWHBWRKTHZ-UHFFFAOYSA-N']):
+    ...     print(inchikey, entity['kingdom']['name'])
+
+    """
+
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url=None, max_workers=16, rate=20.0, max_retries=5, backoff=0.5,
+                 max_backoff=60.0, timeout=60.0):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.base_url = base_url or molnetenhancer.proxy_url
+        self.max_workers = max_workers
+        self.rate = rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] += n
+        # latencies are summarized per request in the active metrics registry
+        if key.endswith('_seconds'):
+            metrics.observe('classyfire.' + key, n)
+        else:
+            metrics.count('classyfire.' + key, n)
+
+    def _limiter(self, url):
+        host = urlparse(url).netloc
+        with self._limiters_lock:
+            if host not in self._limiters:
+                self._limiters[host] = RateLimiter(self.rate, burst=max(1, self.max_workers))
+            return self._limiters[host]
+
+    def _sleep(self, attempt, response=None):
+        delay = None
+        if response is not None and response.headers.get('Retry-After'):
+            try:
+                delay = float(response.headers['Retry-After'])
+            except ValueError:
+                pass
+        if delay is None:
+            delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+        time.sleep(min(delay, self.max_backoff))
+
+    def get(self, url, **kwargs):
+        """GET a URL with rate limiting and retries
+
+        :param url: The URL
+        :type url: str
+        :return: The response, raise_for_status has been called on it
+        :rtype: requests.Response
+        """
+        import requests
+
+        limiter = self._limiter(url)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            self._count('requests')
+            start = time.monotonic()
+            try:
+                r = self.session.get(url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._count('connection_errors')
+                if attempt >= self.max_retries:
+                    self._count('errors')
+                    raise
+                self._count('retries')
+                self._sleep(attempt)
+                attempt += 1
+                continue
+            finally:
+                self._count('request_seconds', time.monotonic() - start)
+
+            self._count('status_%d' % r.status_code)
+            if r.status_code in self.retry_status and attempt < self.max_retries:
+                self._count('retries')
+                self._sleep(attempt, r)
+                attempt += 1
+                continue
+            if r.status_code >= 400:
+                self._count('errors')
+            r.raise_for_status()
+            return r
+
+    def get_entity(self, inchikey, return_format="json"):
+        """Given a InChIKey for a previously queried structure, fetch the classification results.
+
+        :param inchikey: An InChIKey for a previously calculated chemical structure
+        :type inchikey: str
+        :param return_format: desired return format. valid types are json, csv or sdf
+        :type return_format: str
+        :return: query information
+        :rtype: str
+        """
+        inchikey = inchikey.replace('InChIKey=', '')
+        r = self.get('%s/entities/%s.%s' % (self.base_url, inchikey, return_format),
+                     headers={"Content-Type": "application/%s" % return_format})
+        return r.text
+
+    def fetch_entity(self, inchikey):
+        """Fetch the ClassyFire entity of an InChIKey, falling back to the InChIKey without stereo information
+
+        :param inchikey: An InChIKey
+        :type inchikey: str
+        :return: The entity, None if it could not be retrieved, and whether the result may be cached
+        :rtype: tuple
+        """
+        return molnetenhancer._fetch_structure_class_entity(inchikey, self.get_entity)
+
+    def iter_entities(self, inchikeys):
+        """Fetch the ClassyFire entities of many InChIKeys, yielding results as they complete
+
+        At most twice max_workers InChIKeys are in flight at any time, so arbitrarily long
+        iterables of InChIKeys can be streamed.
+
+        :param inchikeys: InChIKeys
+        :type inchikeys: iterable
+        :return: Generator of (InChIKey, entity, cacheable) in order of completion
+        :rtype: generator
+        """
+        inchikeys = iter(inchikeys)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = {}
+            while True:
+                while len(pending) < 2 * self.max_workers:
+                    try:
+                        inchikey = next(inchikeys)
+                    except StopIteration:
+                        break
+                    pending[pool.submit(self.fetch_entity, inchikey)] = inchikey
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    inchikey = pending.pop(future)
+                    entity, cacheable = future.result()
+                    self._count('entities' if entity is not None else 'missing')
+                    yield inchikey, entity, cacheable
+
+    def get_entities(self, inchikeys):
+        """Fetch the ClassyFire entities of many InChIKeys
+
+        :param inchikeys: InChIKeys
+        :type inchikeys: list
+        :return: Entities in the order of inchikeys, None where no entity could be retrieved
+        :rtype: list
+        """
+        entities = {}
+        for inchikey, entity, cacheable in self.iter_entities(collections.OrderedDict.fromkeys(inchikeys)):
+            entities[inchikey] = entity
+        return [entities[k] for k in inchikeys]
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming GraphML output, without building a networkx graph.
+
+Files are written in the format of networkx.write_graphml(G, path, infer_numeric_types=True),
+node by node and edge by edge, so that networks too large to hold as a networkx graph can
+still be imported into Cytoscape or read with networkx.read_graphml. Existing GraphML files
+are copied with attributes added to their nodes the same way, reading them with iterparse.
+"""
+# Standard library imports
+import itertools
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+
+_header = ("<?xml version='1.0' encoding='utf-8'?>\n"
+           '<graphml xmlns="http://graphml.graphdrawing.org/xmlns" '
+           'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+           'xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns '
+           'http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">\n')
+
+
+def graphml_type(dtype):
+    """GraphML attribute type of the values of a numpy or pandas dtype, as networkx infers it from the values
+
+    :param dtype: The dtype of a column
+    :type dtype: numpy.dtype
+    :return: 'boolean', 'long', 'double' or 'string'
+    :rtype: str
+    """
+    # pandas sparse dtypes hold values of their subtype
+    dtype = getattr(dtype, 'subtype', dtype)
+    kind = getattr(dtype, 'kind', 'O')
+    if kind == 'b':
+        return 'boolean'
+    if kind in 'iu':
+        return 'long'
+    if kind == 'f':
+        return 'double'
+    return 'string'
+
+
+class GraphMLWriter(object):
+    """Write an undirected GraphML network node by node and edge by edge
+
+    All attribute keys are declared up front. Values are given per key, in the order of the
+    keys; None leaves the attribute out. Parallel edges get consecutive IDs per pair of
+    nodes, as networkx numbers the edges of a MultiGraph. Nodes that only appear in edges
+    need not be written.
+
+    :param path: Path of the GraphML file
+    :type path: str
+    :param node_keys: Names and GraphML types ('string', 'double', 'long' or 'boolean') of the node attributes
+    :type node_keys: list
+    :param edge_keys: Names and GraphML types of the edge attributes
+    :type edge_keys: list
+
+    >>> with GraphMLWriter('network.graphml', [('motif', 'string')], [('Cosine', 'double')]) as writer:
+    ...     writer.write_nodes([1, 2], [['motif_1', 'motif_1,motif_2']])
+    ...     writer.write_edges([1], [2], [[0.9]])
+    """
+
+    def __init__(self, path, node_keys, edge_keys):
+        self.path = path
+        self._file = open(path, 'w', encoding='utf-8')
+        self._edge_ids = {}
+
+        keys = [('node', name, kind) for name, kind in node_keys] + [('edge', name, kind) for name, kind in edge_keys]
+        # opening data tag and whether values need escaping, per key
+        tags = [('      <data key="d%d">' % i, kind == 'string') for i, (domain, name, kind) in enumerate(keys)]
+        self._node_tags = tags[:len(node_keys)]
+        self._edge_tags = tags[len(node_keys):]
+        self._file.write(_header)
+        for i, (domain, name, kind) in enumerate(keys):
+            self._file.write('  <key id="d%d" for="%s" attr.name=%s attr.type="%s" />\n' % (i, domain, quoteattr(str(name)), kind))
+        self._file.write('  <graph edgedefault="undirected">\n')
+
+    @staticmethod
+    def _data(tags, columns, n):
+        # the data elements of each of n rows, formatted column by column
+        elements = []
+        for (tag, text), values in zip(tags, columns):
+            if text:
+                elements.append(['' if v is None else tag + escape(str(v)) + '</data>\n' for v in values])
+            else:
+                elements.append(['' if v is None else tag + str(v) + '</data>\n' for v in values])
+        return map(''.join, zip(*elements)) if elements else itertools.repeat('', n)
+
+    def write_nodes(self, nodes, columns):
+        """Write nodes with their attributes
+
+        :param nodes: Node IDs
+        :type nodes: list
+        :param columns: Per node key a list of the values of all nodes
+        :type columns: list
+        """
+        lines = []
+        for node, data in zip(nodes, self._data(self._node_tags, columns, len(nodes))):
+            if data:
+                lines.append('    <node id=%s>\n%s    </node>\n' % (quoteattr(str(node)), data))
+            else:
+                lines.append('    <node id=%s />\n' % quoteattr(str(node)))
+        self._file.write(''.join(lines))
+
+    def write_edges(self, sources, targets, columns):
+        """Write edges with their attributes
+
+        :param sources: Node IDs of the sources
+        :type sources: list
+        :param targets: Node IDs of the targets
+        :type targets: list
+        :param columns: Per edge key a list of the values of all edges
+        :type columns: list
+        """
+        lines = []
+        edge_ids = self._edge_ids
+        for source, target, data in zip(sources, targets, self._data(self._edge_tags, columns, len(sources))):
+            pair = (source, target) if source <= target else (target, source)
+            key = edge_ids.get(pair, 0)
+            edge_ids[pair] = key + 1
+            lines.append('    <edge source=%s target=%s id="%d">\n%s    </edge>\n'
+                         % (quoteattr(str(source)), quoteattr(str(target)), key, data))
+        self._file.write(''.join(lines))
+
+    def close(self):
+        """Finish the file"""
+        if not self._file.closed:
+            self._file.write('  </graph>\n</graphml>\n')
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _attributes(element):
+    # the XML attributes of an element, as written in a start tag, leaving out those of other namespaces
+    return ''.join(' %s=%s' % (name, quoteattr(value)) for name, value in element.attrib.items() if not name.startswith('{'))
+
+def _local(tag):
+    # a tag without its namespace
+    return tag.rsplit('}', 1)[-1]
+
+def map_node_attributes(source, path, keys, attributes, chunksize = 10000):
+    """Copy a GraphML file node by node and edge by edge, adding attributes to its nodes
+
+    The file is read with iterparse and written as it is read, so that memory does not grow
+    with the size of the network. Keys, the graph, nodes and edges are copied with their
+    attributes and data, other elements such as descriptions are left out. Node attributes
+    of the file with the name of one of keys are replaced on the nodes attributes returns
+    values for, other nodes keep theirs. Nested graphs are not supported.
+
+    :param source: Path of the GraphML file to copy
+    :type source: str
+    :param path: Path of the GraphML file to write
+    :type path: str
+    :param keys: Names and GraphML types ('string', 'double', 'long' or 'boolean') of the node attributes to add
+    :type keys: list
+    :param attributes: Function returning the values of the added attributes of a node given its ID, in the order of keys, None leaves an attribute out and returning None copies the node unchanged
+    :type attributes: function
+    :param chunksize: Number of nodes or edges written at once
+    :type chunksize: int
+    :return: The number of nodes
+    :rtype: int
+
+    >>> classes = {'1': ['Organic compounds'], '2': [None]}
+    >>> map_node_attributes('network.graphml', 'classes.graphml', [('CF_kingdom', 'string')], classes.get)
+    """
+    names = set(name for name, kind in keys)
+    source_keys, tags, local = [], [], {}
+    # opening data tag and whether values need escaping per key of the file, None for replaced keys
+    copied = {}
+    # opening data tag and whether values need escaping of the added key replacing a key of the file
+    replaced = {}
+    graph, lines, n_nodes = None, [], 0
+
+    def data(element, indent, keep = False):
+        key = element.get('key')
+        if key not in copied:
+            copied[key] = ('<data key=%s>' % quoteattr(key), True)
+        if copied[key] is None:
+            if not keep:
+                return ''
+            tag, text = replaced[key]
+        else:
+            tag, text = copied[key]
+        return indent + tag + (escape(element.text or '') if text else (element.text or '')) + '</data>\n'
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(_header)
+        for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+            tag = local.get(element.tag)
+            if tag is None:
+                tag = local[element.tag] = _local(element.tag)
+            if event == 'start':
+                if tag == 'graph':
+                    if graph is not None:
+                        raise ValueError('Nested graphs are not supported: %s' % source)
+                    graph = element
+                    # keys of the file, with node attributes of the same name as an added one left out
+                    for key in source_keys:
+                        if key.get('for') == 'node' and key.get('attr.name') in names:
+                            copied[key.get('id')] = None
+                            replaced[key.get('id')] = key.get('attr.name')
+                            continue
+                        copied[key.get('id')] = ('<data key=%s>' % quoteattr(key.get('id')), key.get('attr.type', 'string') == 'string')
+                        default = next((d for d in key if _local(d.tag) == 'default'), None)
+                        if default is not None:
+                            f.write('  <key%s>\n    <default>%s</default>\n  </key>\n' % (_attributes(key), escape(default.text or '')))
+                        else:
+                            f.write('  <key%s />\n' % _attributes(key))
+                    used = set(key.get('id') for key in source_keys)
+                    ids = ('d%d' % i for i in itertools.count() if 'd%d' % i not in used)
+                    added_tags = {}
+                    for (name, kind), key in zip(keys, ids):
+                        f.write('  <key id="%s" for="node" attr.name=%s attr.type="%s" />\n' % (key, quoteattr(str(name)), kind))
+                        tags.append(('      <data key="%s">' % key, kind == 'string'))
+                        added_tags[name] = ('<data key="%s">' % key, kind == 'string')
+                    replaced.update((key, added_tags[name]) for key, name in replaced.items())
+                    f.write('  <graph%s>\n' % _attributes(element))
+                continue
+
+            if tag == 'key':
+                source_keys.append(element)
+                continue
+            if graph is None or tag not in ('node', 'edge', 'graph'):
+                continue
+            # data of the graph, which precedes the current node or edge, or ends the graph
+            lines.extend(data(d, '    ') for d in graph if local.get(d.tag) == 'data')
+            if tag != 'graph':
+                added = attributes(element.get('id')) if tag == 'node' else None
+                # nodes without added attributes keep their values of the replaced keys
+                keep = tag == 'node' and added is None
+                values = ''.join([data(d, '      ', keep) for d in element if local.get(d.tag) == 'data'])
+                if added is not None:
+                    values += ''.join([t + (escape(str(v)) if text else str(v)) + '</data>\n' for (t, text), v in zip(tags, added) if v is not None])
+                if tag == 'node':
+                    n_nodes += 1
+                if values:
+                    lines.append('    <%s%s>\n%s    </%s>\n' % (tag, _attributes(element), values, tag))
+                else:
+                    lines.append('    <%s%s />\n' % (tag, _attributes(element)))
+            # drop the parsed elements, the graph holds no more than the current one
+            del graph[:]
+            if len(lines) >= chunksize:
+                f.write(''.join(lines))
+                lines = []
+        f.write(''.join(lines))
+        f.write('  </graph>\n</graphml>\n')
+    return n_nodes
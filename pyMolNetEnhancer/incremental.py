@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental re-annotation of GNPS jobs against a stored previous result.
+
+The state of a finished run is a directory of Parquet tables: chemical classes per InChIKey,
+InChIKeys ClassyFire has no entity for, the result of molfam_classes and a signature per
+node. The signature of a node fingerprints the membership and annotations of its component,
+so that a later run only looks up new InChIKeys in ClassyFire, only scores components whose
+nodes, InChIKeys or chemical classes changed, and only maps changed nodes onto the network
+file. InChIKeys of SMILES are kept across runs with StructureCache instead.
+
+>>> state = load_state('state')
+>>> final = update_molfam_classes(net, df, inchi_dic, state)
+>>> save_state('state', net, df, inchi_dic, final)
+"""
+# Standard library imports
+import json
+import os
+import time
+
+from . import molnetenhancer
+from . import tables
+from .links import StructureLinks
+
+# levels of the ClassyFire chemical ontology as named in df and in the result of molfam_classes
+levels = ['kingdom', 'superclass', 'CF_class', 'subclass', 'direct_parent', 'molecular_framework']
+final_levels = ['CF_kingdom', 'CF_superclass', 'CF_class', 'CF_subclass', 'CF_Dparent', 'CF_MFramework']
+
+state_tables = ('signatures', 'classes', 'final', 'missing')
+
+# seconds after which InChIKeys ClassyFire had no entity for are looked up again, as negative results of EntityCache
+negative_ttl = 7 * 24 * 3600
+
+def component_signatures(net, df, smilesdict):
+    """Fingerprint the membership and annotations of the component of each node
+
+    The signature of a component is the sum of hashes of its nodes, their InChIKeys and the
+    chemical classes of these InChIKeys, together with the position of each node in the
+    component and of each InChIKey in its node. It changes if a node joins or leaves the
+    component, if an InChIKey of one of its nodes changes, if a chemical class of one of these
+    InChIKeys changes, or if any of them change order, as the order decides ties between
+    chemical classes. Nodes with componentindex -1 (selfloops) are components of their own.
+
+    :param net: GNPS network data
+    :type net: pandas.core.frame.DataFrame
+    :param df: A dataframe comprising all unique SMILES, InChIKeys and corresponding chemical classes at each level of the ClassyFire chemical ontology
+    :type df: pandas.core.frame.DataFrame
+    :param smilesdict: A dictionary of nodes with corresponding unique InChIKeys, or links of nodes to InChIKeys as returned by make_inchidic
+    :type smilesdict: dict or StructureLinks
+    :return: The signature of the component of each node, with columns 'cluster index' and 'signature'
+    :rtype: pandas.core.frame.DataFrame
+
+    """
+    import numpy as np
+    import pandas as pd
+
+    nodes = net['cluster index'].values
+    selfloop = (net['componentindex'].astype(str) == '-1').values
+    codes, uniques = pd.factorize(net['componentindex'].astype(str).where(~selfloop, 'S' + net['cluster index'].astype(str)))
+
+    # one row per node and InChIKey, nodes without InChIKeys have a single row without
+    links = StructureLinks.from_dict(smilesdict)
+    per_node, keys = links.gather(nodes)
+    lengths = np.maximum(per_node, 1)
+    inchikeys = np.full(lengths.sum(), None, dtype=object)
+    inchikeys[np.repeat(np.cumsum(lengths) - lengths, per_node) + np.arange(per_node.sum()) - np.repeat(np.cumsum(per_node) - per_node, per_node)] = links.structures[keys]
+    rows = pd.DataFrame({'cluster index': np.repeat(nodes, lengths),
+                         'position': np.repeat(pd.Series(codes).groupby(codes).cumcount().values, lengths),
+                         'inchikey': inchikeys})
+    rows['inchikey_position'] = rows.groupby(np.repeat(np.arange(len(nodes)), lengths)).cumcount().values
+    classes = df.drop_duplicates('inchikey', keep='last').set_index('inchikey')[levels]
+    rows = rows.join(classes, on='inchikey')
+
+    # hash plain objects with None for missing values, so that signatures do not depend on dtypes
+    rows = rows.astype(object)
+    rows = rows.where(rows.notna(), None)
+    hashes = pd.util.hash_pandas_object(rows, index=False).values
+
+    # sum of hashes per component
+    signatures = np.zeros(len(uniques), dtype=np.uint64)
+    np.add.at(signatures, np.repeat(codes, lengths), hashes)
+
+    return pd.DataFrame({'cluster index': nodes, 'signature': signatures[codes]})
+
+def save_state(path, net, df, smilesdict, final, missing = None, **meta):
+    """Store the result of a run for later incremental runs
+
+    :param path: Directory of the state, created if it does not exist
+    :type path: str
+    :param net: GNPS network data
+    :type net: pandas.core.frame.DataFrame
+    :param df: A dataframe comprising all unique SMILES, InChIKeys and corresponding chemical classes at each level of the ClassyFire chemical ontology
+    :type df: pandas.core.frame.DataFrame
+    :param smilesdict: A dictionary of nodes with corresponding unique InChIKeys
+    :type smilesdict: dict
+    :param final: A dataframe containing most predominant chemical classes per node as returned by molfam_classes
+    :type final: pandas.core.frame.DataFrame
+    :param missing: InChIKeys ClassyFire has no entity for, as returned by update_missing
+    :type missing: pandas.core.frame.DataFrame
+    :param meta: Further values to store, such as checksums of input files
+    :return: The directory of the state
+    :rtype: str
+
+    """
+    import pandas as pd
+
+    os.makedirs(path, exist_ok=True)
+    final = final.copy()
+    # no matches are empty scores in molfam_classes, store them as missing values
+    for column in [c for c in final.columns if c.endswith('_score')]:
+        final[column] = pd.to_numeric(final[column], errors='coerce')
+
+    tables.write_table(component_signatures(net, df, smilesdict), os.path.join(path, 'signatures.parquet'))
+    tables.write_table(df, os.path.join(path, 'classes.parquet'))
+    tables.write_table(final, os.path.join(path, 'final.parquet'))
+    if missing is not None:
+        tables.write_table(missing[['inchikey', 'fetched']], os.path.join(path, 'missing.parquet'))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return path
+
+def load_state(path):
+    """Load the state of a previous run stored by save_state
+
+    :param path: Directory of the state
+    :type path: str
+    :return: A dictionary of the stored tables ('signatures', 'classes', 'final', 'missing', None where not stored) and further values ('meta'), None if there is no state
+    :rtype: dict
+
+    """
+    if not os.path.isfile(os.path.join(path, 'signatures.parquet')):
+        return None
+
+    state = {}
+    for name in state_tables:
+        table = os.path.join(path, name + '.parquet')
+        state[name] = tables.read_table(table) if os.path.isfile(table) else None
+    meta = os.path.join(path, 'meta.json')
+    if os.path.isfile(meta):
+        with open(meta) as f:
+            state['meta'] = json.load(f)
+    else:
+        state['meta'] = {}
+    return state
+
+def new_inchikeys(inchikeys, state, negative_ttl = negative_ttl):
+    """List InChIKeys the previous run has no chemical classes for, leaving out those ClassyFire had no entity for
+
+    :param inchikeys: InChIKeys
+    :type inchikeys: list
+    :param state: State of the previous run as returned by load_state, None returns all InChIKeys
+    :type state: dict
+    :param negative_ttl: Seconds after which InChIKeys ClassyFire had no entity for are listed again, None never lists them again
+    :type negative_ttl: float
+    :return: The InChIKeys not in the previous run, in order
+    :rtype: list
+
+    """
+    if state is None:
+        return list(inchikeys)
+    known = set()
+    if state['classes'] is not None:
+        known.update(state['classes']['inchikey'])
+    if state.get('missing') is not None:
+        missing = state['missing']
+        if negative_ttl is not None:
+            missing = missing[missing['fetched'] >= time.time() - negative_ttl]
+        known.update(missing['inchikey'])
+    return [k for k in inchikeys if k not in known]
+
+def update_missing(missing, state, lookup = None, inchikeys = None):
+    """Combine InChIKeys ClassyFire had no entity for in this run with those of the previous run
+
+    :param missing: InChIKeys looked up in this run that ClassyFire has no entity for
+    :type missing: list
+    :param state: State of the previous run as returned by load_state
+    :type state: dict
+    :param lookup: InChIKeys looked up in this run, whose results replace those of the previous run, None replaces those in missing only
+    :type lookup: list
+    :param inchikeys: InChIKeys to keep, None keeps all InChIKeys
+    :type inchikeys: list
+    :return: InChIKeys ClassyFire has no entity for (column inchikey) and the time they were looked up (column fetched)
+    :rtype: pandas.core.frame.DataFrame
+
+    """
+    import pandas as pd
+
+    missing = pd.DataFrame({'inchikey': pd.Series(list(missing), dtype=object), 'fetched': time.time()})
+    if state is not None and state.get('missing') is not None:
+        previous = state['missing']
+        previous = previous[~previous['inchikey'].isin(set(lookup if lookup is not None else missing['inchikey']))]
+        missing = pd.concat([previous[['inchikey', 'fetched']], missing], ignore_index=True)
+    if inchikeys is not None:
+        missing = missing[missing['inchikey'].isin(set(inchikeys))]
+    return missing.drop_duplicates('inchikey', keep='last').reset_index(drop=True)
+
+def update_classes(df, state, inchikeys = None):
+    """Combine chemical classes of new InChIKeys with the chemical classes of the previous run
+
+    :param df: Chemical classes of new InChIKeys, as renamed for molfam_classes
+    :type df: pandas.core.frame.DataFrame
+    :param state: State of the previous run as returned by load_state
+    :type state: dict
+    :param inchikeys: InChIKeys to keep, None keeps all InChIKeys
+    :type inchikeys: list
+    :return: Chemical classes of all InChIKeys, new chemical classes take precedence
+    :rtype: pandas.core.frame.DataFrame
+
+    """
+    import pandas as pd
+
+    if state is not None and state['classes'] is not None:
+        previous = state['classes'].astype(object)
+        df = pd.concat([previous, df.astype(object)], ignore_index=True).drop_duplicates('inchikey', keep='last')
+    if inchikeys is not None:
+        df = df[df['inchikey'].isin(set(inchikeys))]
+    return df.reset_index(drop=True)
+
+@molnetenhancer._quiet_chained_assignment
+def update_molfam_classes(net, df, smilesdict, state, n_jobs = 1):
+    """Retrieve most predominant chemical classes as molfam_classes does, scoring only components that changed since the previous run
+
+    Components whose signature (see component_signatures) matches the signature of a
+    component of the previous run take the chemical classes and scores of that component.
+    All other components are scored with highestscores. The number of scored components
+    is stored in the attrs of the result as 'scored_components'.
+
+    :param net: GNPS network data
+    :type net: pandas.core.frame.DataFrame
+    :param df: A dataframe comprising all unique SMILES, InChIKeys and corresponding chemical classes at each level of the ClassyFire chemical ontology
+    :type df: pandas.core.frame.DataFrame
+    :param smilesdict: A dictionary of nodes with corresponding unique InChIKeys
+    :type smilesdict: dict
+    :param state: State of the previous run as returned by load_state, None scores all components
+    :type state: dict
+    :param n_jobs: Number of worker processes scoring components, -1 for one per CPU, see highestscores
+    :type n_jobs: int
+    :return: A dataframe containing most predominant chemical classes per node at each level of the ClassyFire chemical ontology
+    :rtype: pandas.core.frame.DataFrame
+
+    """
+    import numpy as np
+
+    ci, score, a = molnetenhancer._components(net, smilesdict)
+
+    # representative node and signature of each component
+    signatures = component_signatures(net, df, smilesdict)
+    first = signatures.assign(componentindex=net['componentindex'].values).drop_duplicates('componentindex')
+    component_signature = dict(zip(first['componentindex'], first['signature']))
+
+    previous = {}
+    if state is not None:
+        previous_rows = state['final'].drop_duplicates('cluster index', keep='last').set_index('cluster index')
+        previous_nodes = state['signatures'].drop_duplicates('signature')
+        previous_nodes = previous_nodes[previous_nodes['cluster index'].isin(previous_rows.index)]
+        previous = dict(zip(previous_nodes['signature'], previous_nodes['cluster index']))
+
+    representative = [previous.get(component_signature[c]) for c in ci]
+    changed = [i for i, node in enumerate(representative) if node is None]
+    scores = molnetenhancer.highestscores([a[i] for i in changed], smilesdict, df, [score[i] for i in changed], n_jobs=n_jobs)
+
+    # chemical classes of unchanged components from the rows of their previous representative nodes
+    finalscores = {}
+    if state is not None:
+        reused = previous_rows.reindex([node for node in representative if node is not None])
+    for level, column in zip(levels, final_levels):
+        if state is not None:
+            # missing classes come back from Parquet as None, molfam_classes gives NaN
+            labels = [c if c is not None else np.nan for c in reused[column].tolist()]
+            classes = iter(zip(labels, [s if s == s else '' for s in reused[column + '_score'].tolist()]))
+        computed = iter(scores[level])
+        finalscores[level] = [next(computed) if node is None else list(next(classes)) for node in representative]
+
+    final = molnetenhancer._molfam_table(net, ci, score, finalscores)
+    final.attrs['scored_components'] = len(changed)
+    return final
+
+def changed_nodes(final, state):
+    """List the nodes whose chemical classes differ from the previous run
+
+    :param final: A dataframe containing most predominant chemical classes per node as returned by molfam_classes
+    :type final: pandas.core.frame.DataFrame
+    :param state: State of the previous run as returned by load_state, None returns all nodes
+    :type state: dict
+    :return: Cluster indexes of new nodes and of nodes with changed chemical classes, scores or componentindex
+    :rtype: list
+
+    """
+    import pandas as pd
+
+    final = final.drop_duplicates('cluster index', keep='last').set_index('cluster index')
+    if state is None:
+        return final.index.tolist()
+
+    previous = state['final'].drop_duplicates('cluster index', keep='last').set_index('cluster index').reindex(final.index)
+    columns = [c for c in final.columns if c in previous.columns]
+
+    # compare as the attributes make_classyfire_graphml writes, missing and empty scores alike
+    def attributes(table):
+        table = table[columns].astype(object)
+        for column in [c for c in columns if c.endswith('_score') or c == 'CF_NrNodes']:
+            table[column] = pd.to_numeric(table[column], errors='coerce').astype(float)
+        return table.where(table.notna(), '').astype(str)
+
+    differs = (attributes(final) != attributes(previous)).any(axis=1) | previous[columns].isnull().all(axis=1)
+    return final.index[differs.values].tolist()
+
+def update_classyfire_graphml(path, final, nodes):
+    """Map chemical classes onto the given nodes of a network file only, as write_classyfire_graphml does for all nodes
+
+    The file is copied node by node, with the other nodes keeping the chemical classes of the
+    previous run, and then replaces the original.
+
+    :param path: Path of a network file with chemical classes of a previous run mapped, as written by write_classyfire_graphml
+    :type path: str
+    :param final: A dataframe containing most predominant chemical classes per node at each level of the ClassyFire chemical ontology
+    :type final: pandas.core.frame.DataFrame
+    :param nodes: Cluster indexes of the nodes to map, as returned by changed_nodes
+    :type nodes: list
+    :return: The number of nodes
+    :rtype: int
+
+    """
+    updated = path + '.update'
+    try:
+        n_nodes = molnetenhancer.write_classyfire_graphml(path, final, updated, nodes)
+        os.replace(updated, path)
+    finally:
+        if os.path.exists(updated):
+            os.remove(updated)
+    return n_nodes
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact links of molecular features to chemical structures.
+
+Each unique structure (SMILES, InChI or InChIKey) is stored once and referred to by an
+integer code. The codes of the structures of all features are held in one array, and
+features index into it through CSR offsets, as scipy.sparse.csr_matrix does for rows.
+"""
+# Standard library imports
+import sys
+
+
+class StructureLinks(object):
+    """Links of molecular features to structures, held as integer codes with CSR offsets
+
+    The structures of features[i] are structures[codes[offsets[i]:offsets[i + 1]]], in their
+    order of first appearance. Features without structures have an empty range. Links can be
+    used in place of the dictionaries of unique_smiles, unique_inchis and make_inchidic: they
+    support len, in, iteration over features, keys, items, get and indexing by feature, which
+    returns a list of structures. to_dict converts them to such a dictionary.
+
+    :param features: Feature IDs (cluster indexes), sorted
+    :type features: numpy.ndarray
+    :param offsets: Offsets of the codes of each feature, of length len(features) + 1
+    :type offsets: numpy.ndarray
+    :param codes: Codes of the structures of all features, indexes into structures
+    :type codes: numpy.ndarray
+    :param structures: Unique structures
+    :type structures: numpy.ndarray
+
+    >>> links = StructureLinks.from_dict({1: ['CCO', 'CCN'], 2: [], 3: ['CCO']})
+    >>> links[1], len(links.structures)
+    (['CCO', 'CCN'], 2)
+
+    """
+
+    def __init__(self, features, offsets, codes, structures):
+        self.features = features
+        self.offsets = offsets
+        self.codes = codes
+        self.structures = structures
+
+    @classmethod
+    def from_pairs(cls, features, structures, all_features = None):
+        """Build links from parallel sequences of features and structures
+
+        :param features: The feature of each link
+        :type features: array_like
+        :param structures: The structure of each link
+        :type structures: array_like
+        :param all_features: Features to keep even if they have no links
+        :type all_features: array_like
+        :return: The links, with the structures of each feature in the order given
+        :rtype: StructureLinks
+        """
+        import numpy as np
+        import pandas as pd
+
+        features = np.asarray(features)
+        if all_features is not None:
+            unique = np.unique(np.concatenate([np.asarray(all_features, dtype=features.dtype), features]))
+        else:
+            unique = np.unique(features)
+        rows = np.searchsorted(unique, features)
+
+        # codes are assigned in order of first appearance over the sorted features
+        order = np.argsort(rows, kind='mergesort')
+        codes, uniques = pd.factorize(pd.Series(np.asarray(structures, dtype=object)[order], dtype=object))
+        offsets = np.zeros(len(unique) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(unique)), out=offsets[1:])
+
+        return cls(unique, offsets, codes.astype(np.int32), np.asarray(uniques, dtype=object))
+
+    @classmethod
+    def from_dict(cls, dic):
+        """Build links from a dictionary of features and lists of structures
+
+        :param dic: A dictionary of features with corresponding structures, as returned by unique_smiles or make_inchidic
+        :type dic: dict
+        :return: The links
+        :rtype: StructureLinks
+        """
+        import numpy as np
+
+        if isinstance(dic, cls):
+            return dic
+        features = list(dic.keys())
+        lengths = [len(v) for v in dic.values()]
+        return cls.from_pairs(np.repeat(np.asarray(features), lengths), [x for v in dic.values() for x in v], all_features=features)
+
+    def to_dict(self):
+        """Convert to a dictionary of features and lists of structures, as returned by unique_smiles or make_inchidic
+
+        :return: The dictionary, with features in sorted order
+        :rtype: dict
+        """
+        structures = self.structures[self.codes].tolist()
+        bounds = self.offsets.tolist()
+        return dict(zip(self.features.tolist(), [structures[start:end] for start, end in zip(bounds[:-1], bounds[1:])]))
+
+    def gather(self, features):
+        """Look up the structures of many features at once
+
+        :param features: Features, possibly repeated; features without links have no structures
+        :type features: array_like
+        :return: The number of structures of each feature, and the codes of their structures concatenated in the order of features
+        :rtype: tuple
+        """
+        import numpy as np
+
+        features = np.asarray(features)
+        if not len(self.features):
+            return np.zeros(len(features), dtype=np.int64), self.codes[:0]
+        rows = np.minimum(np.searchsorted(self.features, features), len(self.features) - 1)
+        found = self.features[rows] == features
+
+        starts = self.offsets[rows]
+        lengths = np.where(found, self.offsets[rows + 1] - starts, 0)
+        # position of each link within its feature, added to the start of the feature
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return lengths, self.codes[np.repeat(starts, lengths) + within]
+
+    def map_structures(self, mapping):
+        """Replace structures through a mapping, dropping links to structures the mapping lacks or maps to themselves, as make_inchidic does, and to structures it maps to missing values
+
+        :param mapping: A dictionary or series of structures and their replacements, such as InChIKeys of SMILES
+        :type mapping: dict
+        :return: The links to the replacements, features without remaining links are kept
+        :rtype: StructureLinks
+        """
+        import numpy as np
+        import pandas as pd
+
+        mapping = pd.Series(mapping, dtype=object) if isinstance(mapping, dict) else mapping.astype(object)
+        mapping = mapping[~mapping.index.duplicated(keep='last')]
+        replaced = mapping.reindex(pd.Index(self.structures, dtype=object)).values
+        keep = pd.notna(replaced) & (replaced != self.structures)
+
+        # per unique structure the code of its replacement, -1 where the link is dropped
+        new_codes, new_structures = pd.factorize(pd.Series(np.where(keep, replaced, None), dtype=object))
+        links = new_codes[self.codes]
+        kept = links >= 0
+        rows = np.repeat(np.arange(len(self.features)), np.diff(self.offsets))[kept]
+        offsets = np.zeros(len(self.features) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.features)), out=offsets[1:])
+
+        # recode, so that replacement codes are in order of first appearance again
+        codes, structures = pd.factorize(pd.Series(np.asarray(new_structures, dtype=object)[links[kept]], dtype=object))
+        return StructureLinks(self.features, offsets, codes.astype(np.int32), np.asarray(structures, dtype=object))
+
+    @property
+    def nbytes(self):
+        """Bytes held by the feature, offset and code arrays and the unique structures"""
+        return (self.features.nbytes + self.offsets.nbytes + self.codes.nbytes + self.structures.nbytes
+                + sum(sys.getsizeof(s) for s in self.structures))
+
+    def __len__(self):
+        return len(self.features)
+
+    def __iter__(self):
+        return iter(self.features.tolist())
+
+    def __contains__(self, feature):
+        import numpy as np
+
+        row = np.searchsorted(self.features, feature)
+        return bool(row < len(self.features) and self.features[row] == feature)
+
+    def __getitem__(self, feature):
+        import numpy as np
+
+        row = np.searchsorted(self.features, feature)
+        if not (row < len(self.features) and self.features[row] == feature):
+            raise KeyError(feature)
+        return self.structures[self.codes[self.offsets[row]:self.offsets[row + 1]]].tolist()
+
+    def get(self, feature, default = None):
+        try:
+            return self[feature]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.features
+
+    def values(self):
+        return list(self.to_dict().values())
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __repr__(self):
+        return '<StructureLinks: %d features, %d links, %d structures>' % (len(self.features), len(self.codes), len(self.structures))
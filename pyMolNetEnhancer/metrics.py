@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timings and counters of the pipeline stages.
+
+The main functions of the pipeline time themselves and count the rows they process, the
+InChIKeys found in and missing from the entity cache and the ClassyFire requests and their
+latency in the active Metrics registry. A registry for the whole process is active by
+default; collect activates a fresh one for a block of code, such as one GNPS job, and can
+export it as JSON when the block ends.
+
+Registries are thread safe, so worker threads of a ClassyFireClient record into the
+registry of the code that started them. Worker processes record into their own.
+"""
+# Standard library imports
+import contextlib
+import json
+import threading
+import time
+
+
+class Metrics(object):
+    """A registry of the time spent per stage, counters and observed values such as request latencies
+
+    >>> registry = Metrics()
+    >>> with registry.timer('molfam_classes'):
+    ...     registry.count('molfam_classes.nodes', 1200)
+    >>> registry.observe('classyfire.request_seconds', 0.25)
+    >>> registry.to_json('metrics.json')
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+        self.observations = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Time a block of code, adding the time and one call to a stage
+
+        :param stage: Name of the stage
+        :type stage: str
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds, calls = 1):
+        """Add time spent in a stage
+
+        :param stage: Name of the stage
+        :type stage: str
+        :param seconds: Seconds spent
+        :type seconds: float
+        :param calls: Number of calls the seconds were spent in
+        :type calls: int
+        """
+        with self._lock:
+            timing = self.timings.setdefault(stage, {'calls': 0, 'seconds': 0.0})
+            timing['calls'] += calls
+            timing['seconds'] += seconds
+
+    def count(self, name, n = 1):
+        """Add n to a counter
+
+        :param name: Name of the counter
+        :type name: str
+        :param n: Number to add
+        :type n: int
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        """Record a value, keeping the number, total, minimum and maximum of the values recorded under a name
+
+        :param name: Name of the values, such as 'classyfire.request_seconds'
+        :type name: str
+        :param value: The value
+        :type value: float
+        """
+        with self._lock:
+            if name in self.observations:
+                summary = self.observations[name]
+                summary['n'] += 1
+                summary['total'] += value
+                summary['min'] = min(summary['min'], value)
+                summary['max'] = max(summary['max'], value)
+            else:
+                self.observations[name] = {'n': 1, 'total': value, 'min': value, 'max': value}
+
+    def merge(self, other):
+        """Add the timings, counters and observed values of another registry
+
+        :param other: A registry or a dictionary returned by as_dict, such as one read from an exported JSON file
+        :type other: Metrics or dict
+        """
+        other = other.as_dict() if isinstance(other, Metrics) else other
+        for stage, timing in other.get('timings', {}).items():
+            self.add_time(stage, timing['seconds'], timing['calls'])
+        for name, n in other.get('counters', {}).items():
+            self.count(name, n)
+        with self._lock:
+            for name, summary in other.get('observations', {}).items():
+                if name in self.observations:
+                    mine = self.observations[name]
+                    mine['n'] += summary['n']
+                    mine['total'] += summary['total']
+                    mine['min'] = min(mine['min'], summary['min'])
+                    mine['max'] = max(mine['max'], summary['max'])
+                else:
+                    self.observations[name] = dict(summary)
+
+    def as_dict(self):
+        """The timings, counters and observed values, with the mean of each observed value
+
+        :return: A dictionary with seconds and calls per stage ('timings'), counters ('counters') and number, total, mean, minimum and maximum of observed values ('observations')
+        :rtype: dict
+        """
+        with self._lock:
+            observations = {name: dict(summary, mean=summary['total'] / summary['n']) for name, summary in self.observations.items()}
+            return {'timings': {stage: dict(timing) for stage, timing in self.timings.items()},
+                    'counters': dict(self.counters),
+                    'observations': observations}
+
+    def to_json(self, path):
+        """Export the registry as returned by as_dict to a JSON file
+
+        :param path: Path of the JSON file
+        :type path: str
+        """
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+    def reset(self):
+        """Clear all timings, counters and observed values"""
+        with self._lock:
+            self.timings.clear()
+            self.counters.clear()
+            self.observations.clear()
+
+
+# the process-wide registry, and those activated by collect on top of it
+_registries = [Metrics()]
+_registries_lock = threading.Lock()
+
+def current():
+    """The active registry, the one of the innermost collect block or else the process-wide registry
+
+    :rtype: Metrics
+    """
+    return _registries[-1]
+
+@contextlib.contextmanager
+def collect(path = None):
+    """Record into a fresh registry within a block, adding it to the enclosing registry when the block ends
+
+    The registry is active for all threads of the process, so blocks should not run
+    concurrently in threads of one process.
+
+    :param path: JSON file to export the registry of the block to when it ends
+    :type path: str
+    :return: The registry of the block
+
+    >>> with collect('job_metrics.json') as registry:
+    ...     final = molfam_classes(net, df, inchi_dic)
+    """
+    registry = Metrics()
+    with _registries_lock:
+        _registries.append(registry)
+    try:
+        yield registry
+    finally:
+        with _registries_lock:
+            _registries.remove(registry)
+        current().merge(registry)
+        if path is not None:
+            registry.to_json(path)
+
+@contextlib.contextmanager
+def timer(stage):
+    """Time a block of code, or each call of a function when used as decorator, in the active registry
+
+    :param stage: Name of the stage
+    :type stage: str
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current().add_time(stage, time.perf_counter() - start)
+
+def count(name, n = 1):
+    """Add n to a counter of the active registry"""
+    current().count(name, n)
+
+def observe(name, value):
+    """Record a value in the active registry, see Metrics.observe"""
+    current().observe(name, value)
@@ -8,30 +8,35 @@ Created on Mon Aug 13 16:19:11 2018
 # Standard library imports
 import os
 import re
-import sys
 import time
 
 # Third party imports 
-import collections
-from collections import Counter
+import contextlib
 from collections import OrderedDict
 import csv  
 import functools
-from functools import reduce
-from joblib import Parallel, delayed
+import itertools
 import json
+import logging
 import multiprocessing
-import networkx as nx
-import operator
-import pandas as pd
-from pandas.api.types import is_numeric_dtype
-import requests
-import requests_cache
 
-pd.options.mode.chained_assignment = None 
-requests_cache.install_cache('demo_cache')
+from . import metrics
+from .links import StructureLinks
 
-def Mass2Motif_2_Network(edges,motifs,prob = 0.01,overlap = 0.3, top = 5):
+logger = logging.getLogger(__name__)
+
+def _quiet_chained_assignment(function):
+    """Run a function with pandas' SettingWithCopyWarning disabled, for functions adding columns to dataframes passed in, which may be slices"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        import pandas as pd
+        with pd.option_context('mode.chained_assignment', None):
+            return function(*args, **kwargs)
+    return wrapper
+
+@metrics.timer('Mass2Motif_2_Network')
+@_quiet_chained_assignment
+def Mass2Motif_2_Network(edges,motifs,prob = 0.01,overlap = 0.3, top = 5, sparse = False, expand = True):
     """Map Mass2Motifs onto a mass spectral molecular network
 
     :param edges: An edges file downloaded from GNPS 
@@ -44,264 +49,842 @@ def Mass2Motif_2_Network(edges,motifs,prob = 0.01,overlap = 0.3, top = 5):
     :type overlap: float
     :param top: Specifies how many most shared motifs per molecular family (network component index) should be shown
     :type top: int
+    :param sparse: How to return the scan x Mass2Motif overlap matrix: False merges it into nodes as dense columns, True merges it as pandas sparse columns and 'csr' leaves it out of nodes and returns it separately as a scipy.sparse CSR matrix under the 'overlap' key (see motif_overlap_matrix)
+    :type sparse: bool or str
+    :param expand: Whether to add a separate edge for each shared motif to the edges, if False the edges can be expanded chunk by chunk with iter_motif_edges or write_motif_edges
+    :type expand: bool
     :return: A dictionary of two dataframes containing network nodes and edges with motifs mapped
     :rtype: dict
 
     """ 
+    import numpy as np
+    import pandas as pd
+    
     motifs = motifs[motifs.probability > prob]
     motifs = motifs[motifs.overlap > overlap]
-    
+    metrics.count('Mass2Motif_2_Network.edges', len(edges))
+    metrics.count('Mass2Motif_2_Network.motifs', len(motifs))
+
+    # categorical labels (see tables.read_motifs) are aggregated and pivoted as plain values
+    motifs = motifs.astype({c: object for c in motifs.columns if isinstance(motifs[c].dtype, pd.CategoricalDtype)})
+
     if 'MEH' not in edges.columns and 'OtherScore' not in edges.columns:
         edges['MEH'] = 0.0 
         edges['OtherScore'] = 0.0
     
-    motifs_con = motifs.groupby('scans').agg(lambda x: x.tolist())
-    df = pd.DataFrame(0.0, index=motifs_con.index, columns=motifs.motif.unique())
+    comb, matrix = _motif_nodes(motifs, sparse)
+    
+    # shared motifs per edge through two joins on the scan/motif incidence table,
+    # keeping the motif order of CLUSTERID1
+    incidence = motifs[['scans', 'motif']].drop_duplicates()
+    incidence['rank'] = incidence.groupby('scans').cumcount()
+    ends = pd.DataFrame({'edge': np.arange(len(edges)),
+                         'CLUSTERID1': edges['CLUSTERID1'].values,
+                         'CLUSTERID2': edges['CLUSTERID2'].values})
+    shared = pd.merge(ends, incidence, left_on='CLUSTERID1', right_on='scans')
+    shared = pd.merge(shared[['edge', 'CLUSTERID2', 'motif', 'rank']], incidence[['scans', 'motif']], 
+                      left_on=['CLUSTERID2', 'motif'], right_on=['scans', 'motif'])
+    shared = shared.sort_values(['edge', 'rank'], kind='mergesort')
+    shared = shared.groupby('edge', sort=False)['motif'].agg(lambda x: x.tolist()).to_dict()
+    
+    both = (edges['CLUSTERID1'].isin(comb.index) & edges['CLUSTERID2'].isin(comb.index)).values
+    edges['shared_motifs'] = [shared.get(i, []) if b else 'None' for i, b in enumerate(both)]
+
+    edges['TopSharedMotifs'] = edges['ComponentIndex'].map(top_shared_motifs(edges, top))
+
+    edges.insert(loc=1, column='interaction', value= 'cosine')
+
+    # add separate edge for each shared motif
+    if expand:
+        edges = pd.concat([edges] + list(_motif_edge_chunks(edges, motif_edge_chunksize)))
+    
+    if sparse == 'csr':
+        return {'nodes':comb,'edges':edges,'overlap':matrix}
+    return {'nodes':comb,'edges':edges}
+
+def _motif_nodes(motifs, sparse = False):
+    """The nodes of Mass2Motif_2_Network from filtered motifs, and the overlap matrix if sparse (see Mass2Motif_2_Network)
+
+    :return: The nodes and the overlap matrix as returned by motif_overlap_matrix, None if not sparse
+    :rtype: tuple
+    """
+    import numpy as np
+    import pandas as pd
     
-    for index, row in motifs_con.iterrows():
-        for idx, val in enumerate(row["motif"]):
-            df.loc[index][val] = row["overlap"][idx]
+    matrix = None
+    motifs_con = _scan_lists(motifs)
     
-    comb = pd.merge(motifs_con, df, left_index= True, right_index=True)
+    if sparse == 'csr':
+        matrix = motif_overlap_matrix(motifs, motifs_con.index)
+        comb = motifs_con
+    elif sparse:
+        matrix = motif_overlap_matrix(motifs, motifs_con.index)
+        # one motif column at a time, so the dense matrix never exists as a whole
+        csc = matrix['matrix'].tocsc()
+        column = np.zeros(csc.shape[0])
+        df = {}
+        for j, motif in enumerate(matrix['motifs']):
+            column[:] = 0.0
+            column[csc.indices[csc.indptr[j]:csc.indptr[j+1]]] = csc.data[csc.indptr[j]:csc.indptr[j+1]]
+            df[motif] = pd.arrays.SparseArray(column, fill_value=0.0)
+        df = pd.DataFrame(df, index=motifs_con.index)
+        comb = pd.merge(motifs_con, df, left_index= True, right_index=True)
+    else:
+        # scan x motif overlap matrix, built from the long scan/motif table in one pivot
+        # (the last overlap wins if a scan lists the same motif twice)
+        pairs = motifs.drop_duplicates(['scans', 'motif'], keep='last')
+        df = pairs.pivot(index='scans', columns='motif', values='overlap')
+        df = df.reindex(index=motifs_con.index, columns=motifs.motif.unique()).fillna(0.0)
+        df.columns.name = None
+        
+        comb = pd.merge(motifs_con, df, left_index= True, right_index=True)
     
-    edges['shared_motifs'] = 'None'
+    return comb, matrix
 
-    for index, row in edges.iterrows():
-        if row['CLUSTERID1'] in motifs_con.index and row['CLUSTERID2'] in motifs_con.index:
-            edges['shared_motifs'].iloc[index] = list(set(motifs_con.loc[row['CLUSTERID1'],'motif']) & set(motifs_con.loc[row['CLUSTERID2'],'motif']))
+def _scan_lists(motifs):
+    """The values of each column per scan as lists, indexed by sorted scan, as motifs.groupby('scans').agg(lambda x: x.tolist()) returns them"""
+    import numpy as np
+    import pandas as pd
+    
+    motifs = motifs[motifs['scans'].notnull()]
+    if not len(motifs):
+        return motifs.groupby('scans').agg(lambda x: x.tolist())
+    
+    # one stable sort, then slices of plain lists instead of a Python call per scan and column
+    order = np.argsort(motifs['scans'].values, kind='mergesort')
+    scans = motifs['scans'].values[order]
+    starts = np.flatnonzero(np.r_[True, scans[1:] != scans[:-1]])
+    bounds = list(zip(starts.tolist(), starts[1:].tolist() + [len(scans)]))
+    columns = [c for c in motifs.columns if c != 'scans']
+    data = {}
+    for column in columns:
+        values = motifs[column].to_numpy()[order].tolist()
+        data[column] = [values[a:b] for a, b in bounds]
+    return pd.DataFrame(data, index=pd.Index(scans[starts], name='scans'), columns=columns)
+
+def top_shared_motifs(edges, top = 5):
+    """Find the most shared motifs per molecular family (network component index)
+
+    Motifs are counted over the shared motifs of all edges of a family and ranked by count,
+    ties going to the motif that appears first. A family of a single edge between nodes
+    that are not both in the motif summary gets ['None'].
+
+    :param edges: Edges with a list of shared motifs, or 'None', per edge in column 'shared_motifs'
+    :type edges: pandas.core.frame.DataFrame
+    :param top: Number of motifs per molecular family
+    :type top: int
+    :return: A series of lists of the most shared motifs, indexed by component index
+    :rtype: pandas.core.series.Series
 
-    # calculate most shared motifs per molecular family
-    topmotifs = edges.groupby('ComponentIndex')['shared_motifs'].agg(lambda x: x.tolist()).to_frame(name='topmotifs')
+    """
+    import pandas as pd
 
-    for index,row in topmotifs.iterrows():
-        if row['topmotifs'] != ['None']:
-            mcounts = list(filter(lambda a: a != 'None', row['topmotifs']))
-            topmotifs.loc[index,'topmotifs'] = [x for sub_list in mcounts for x in sub_list]
+    none = pd.Series([not isinstance(m, list) and m == 'None' for m in edges['shared_motifs']], index=edges.index)
+    
+    # one row per shared motif, numbered in order of appearance
+    long = edges.loc[~none, ['ComponentIndex', 'shared_motifs']].explode('shared_motifs').dropna()
+    long = long.rename(columns={'shared_motifs': 'motif'})
+    counts = long.groupby(['ComponentIndex', 'motif'], sort=False).size().reset_index(name='count')
+    counts['first'] = range(len(counts))
+
+    families = none.groupby(edges['ComponentIndex']).agg(['size', 'all'])
+    return _top_motifs(counts, families, top)
+
+def _top_motifs(counts, families, top):
+    """Rank counted motifs per molecular family as top_shared_motifs does
+
+    :param counts: Number of edges sharing each motif ('count') and order of first appearance ('first') per family ('ComponentIndex') and motif ('motif')
+    :type counts: pandas.core.frame.DataFrame
+    :param families: Number of edges ('size') and whether all of them are 'None' edges ('all') per family
+    :type families: pandas.core.frame.DataFrame
+    :return: A series of lists of the most shared motifs, indexed by component index
+    :rtype: pandas.core.series.Series
+    """
+    import pandas as pd
 
-    for index,row in topmotifs.iterrows():
-        counts = collections.Counter(row['topmotifs'])
-        mcs = sorted(row['topmotifs'], key=counts.get, reverse=True)
-        row['topmotifs'] = list(OrderedDict.fromkeys(mcs))[0:top]
+    counts = counts.sort_values(['ComponentIndex', 'count', 'first'], ascending=[True, False, True])
+    topmotifs = counts.groupby('ComponentIndex').head(top).groupby('ComponentIndex')['motif'].agg(lambda x: x.tolist())
 
-    topmotifs['ComponentIndex'] = topmotifs.index
+    topmotifs = topmotifs.reindex(families.index)
+    lone = (families['size'] == 1) & families['all']
+    return pd.Series([['None'] if l else (t if isinstance(t, list) else []) for t, l in zip(topmotifs, lone)], index=families.index, dtype=object)
 
-    edges['TopSharedMotifs'] = edges['ComponentIndex'].map(topmotifs.set_index('ComponentIndex')['topmotifs'])
+# number of motif edges expanded at once
+motif_edge_chunksize = 100000
 
-    # add separate edge for each shared motif
-    edges.insert(loc=1, column='interaction', value= 'cosine')
+def _motif_edge_chunks(edges, chunksize):
+    """Expand the edges sharing motifs into one edge per shared motif, yielding about chunksize motif edges at a time, numbered from 0 over all chunks"""
+    import numpy as np
+    import pandas as pd
+    
+    counts = np.array([len(m) if m != 'None' else 0 for m in edges['shared_motifs']], dtype=np.int64)
+    rows = np.flatnonzero(counts)
+    ends = np.cumsum(counts[rows])
+    
+    start, offset = 0, 0
+    while start < len(rows):
+        # the edges whose motif edges end within the next chunksize motif edges, at least one edge
+        end = max(int(np.searchsorted(ends, offset + chunksize, side='right')), start + 1)
+        chunk = edges.iloc[rows[start:end]].assign(interaction=lambda d: d['shared_motifs']).explode('interaction')
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        yield chunk
+        start, offset = end, offset + len(chunk)
+
+def iter_motif_edges(edges, chunksize = motif_edge_chunksize):
+    """Iterate over the edges of Mass2Motif_2_Network with a separate edge for each shared motif in chunks, as Mass2Motif_2_Network(..., expand=True) returns them
+
+    All columns of edges are kept. The edges of the network come first, followed by one edge per shared
+    motif with the motif as interaction.
+
+    :param edges: The edges returned by Mass2Motif_2_Network(..., expand=False)
+    :type edges: pandas.core.frame.DataFrame
+    :param chunksize: Number of edges per chunk
+    :type chunksize: int
+    :return: Generator of dataframes of edges
+    :rtype: generator
 
-    cols = edges.columns
-    lst = []
+    """
+    for start in range(0, len(edges), chunksize):
+        yield edges.iloc[start:start + chunksize]
+    for chunk in _motif_edge_chunks(edges, chunksize):
+        yield chunk
 
-    for index, row in edges.iterrows():
-        if row['shared_motifs'] != 'None':
-            for idx,val in enumerate(row['shared_motifs']):
-                if 'EdgeAnnotation' not in edges.columns:
-                    lst.append([row['CLUSTERID1'],row['shared_motifs'][idx],row['CLUSTERID2'], 
-                        row['DeltaMZ'], row['MEH'], row['Cosine'], row['OtherScore'],row['ComponentIndex'],row['shared_motifs'], row['TopSharedMotifs']])
-                else:
-                    lst.append([row['CLUSTERID1'],row['shared_motifs'][idx],row['CLUSTERID2'], 
-                        row['DeltaMZ'], row['MEH'], row['Cosine'], row['OtherScore'],row['ComponentIndex'],row['EdgeAnnotation'],row['shared_motifs'], row['TopSharedMotifs']])
+def write_motif_edges(edges, path, chunksize = motif_edge_chunksize):
+    """Write the edges of Mass2Motif_2_Network with a separate edge for each shared motif, holding one chunk of edges in memory at a time
 
+    :param edges: The edges returned by Mass2Motif_2_Network(..., expand=False)
+    :type edges: pandas.core.frame.DataFrame
+    :param path: Path of a .parquet file or of a tab separated text file
+    :type path: str
+    :param chunksize: Number of edges per chunk
+    :type chunksize: int
+    :return: The path
+    :rtype: str
 
-    motifedges = pd.DataFrame(lst, columns=cols)
-    edges = pd.concat([edges,motifedges])
+    """
+    from . import tables
     
-    return {'nodes':comb,'edges':edges}
+    return tables.write_chunks(iter_motif_edges(edges, chunksize), path)
+
+def motif_lookup(motifs, directory = None):
+    """Index the Mass2Motifs of each scan, for looking up the motifs shared by the nodes of edges one chunk of edges at a time
+
+    The index is held in flat arrays: the sorted scans, the offsets of their motifs, the
+    codes of their motifs in order of appearance in motifs, and the sorted codes of all
+    scan/motif pairs (index of the scan x number of motifs + code of the motif). With a
+    directory, the arrays are saved there as .npy files and memory-mapped, so that only the
+    pages the looked up scans fall on are read into memory.
+
+    :param motifs: A motif summary file downloaded from MS2LDA, filtered as needed, with integer scans
+    :type motifs: pandas.core.frame.DataFrame
+    :param directory: Directory to save the arrays to and memory-map them from, None keeps them in memory
+    :type directory: str
+    :return: A dictionary with the arrays 'scans', 'indptr', 'codes' and 'pairs' and the motif names per code ('motifs')
+    :rtype: dict
+
+    """
+    import numpy as np
+    import pandas as pd
+    
+    incidence = motifs[['scans', 'motif']].dropna().drop_duplicates()
+    codes, names = pd.factorize(incidence['motif'].astype(object))
+    
+    # motifs of a scan stay in order of appearance, as Mass2Motif_2_Network ranks them
+    order = np.argsort(incidence['scans'].values, kind='mergesort')
+    scans, counts = np.unique(incidence['scans'].values[order].astype(np.int64), return_counts=True)
+    arrays = {'scans': scans,
+              'indptr': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+              'codes': codes[order].astype(np.int64)}
+    arrays['pairs'] = np.sort(np.repeat(np.arange(len(scans), dtype=np.int64), counts) * len(names) + arrays['codes'])
+    
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + '.npy'), array)
+        # empty files cannot be memory-mapped
+        arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if len(array) else None) 
+                  for name, array in arrays.items()}
+    arrays['motifs'] = np.array(list(names), dtype=object)
+    return arrays
+
+def _shared_motifs(lookup, sources, targets):
+    """Look up the motifs shared by the nodes of edges in a motif_lookup
+
+    :return: Whether both nodes of each edge have motifs, and the edge numbers and motif codes of the shared motifs, in order of edges and of the motifs of the source
+    :rtype: tuple
+    """
+    import numpy as np
+    
+    scans, indptr = lookup['scans'], lookup['indptr']
+    
+    def find(ids):
+        rows = np.searchsorted(scans, ids)
+        found = rows < len(scans)
+        found[found] = scans[rows[found]] == ids[found]
+        return rows, found
+    
+    sources, targets = np.asarray(sources, dtype=np.int64), np.asarray(targets, dtype=np.int64)
+    rows1, found1 = find(sources)
+    rows2, found2 = find(targets)
+    both = found1 & found2
+    
+    # all motifs of the sources, checked for being motifs of the targets as well
+    edges = np.flatnonzero(both)
+    starts = indptr[rows1[both]]
+    n = indptr[rows1[both] + 1] - starts
+    offsets = np.repeat(starts - (np.cumsum(n) - n), n)
+    codes = lookup['codes'][np.arange(n.sum()) + offsets]
+    query = np.repeat(rows2[both], n) * len(lookup['motifs']) + codes
+    pairs = lookup['pairs']
+    positions = np.searchsorted(pairs, query)
+    shared = positions < len(pairs)
+    shared[shared] = pairs[positions[shared]] == query[shared]
+    
+    return both, np.repeat(edges, n)[shared], codes[shared]
+
+def _map_motif_edges(chunk, lookup, topmotifs):
+    """Add the columns Mass2Motif_2_Network(..., expand=False) adds to a chunk of edges, the most shared motifs per family given"""
+    import numpy as np
+    
+    both, edge, codes = _shared_motifs(lookup, chunk['CLUSTERID1'].values, chunk['CLUSTERID2'].values)
+    names = lookup['motifs'][codes].tolist()
+    ends = np.cumsum(np.bincount(edge, minlength=len(chunk))).tolist()
+    
+    chunk = chunk.copy()
+    if 'MEH' not in chunk.columns and 'OtherScore' not in chunk.columns:
+        chunk['MEH'] = 0.0 
+        chunk['OtherScore'] = 0.0
+    chunk['shared_motifs'] = [names[a:b] if x else 'None' for a, b, x in zip([0] + ends[:-1], ends, both.tolist())]
+    chunk['TopSharedMotifs'] = chunk['ComponentIndex'].map(topmotifs)
+    chunk.insert(loc=1, column='interaction', value= 'cosine')
+    return chunk
+
+@metrics.timer('write_motif_network')
+def write_motif_network(edges, motifs, path, prob = 0.01, overlap = 0.3, top = 5, sparse = False, graphml = None, chunksize = motif_edge_chunksize, directory = None, **kwargs):
+    """Map Mass2Motifs onto a mass spectral molecular network and write its edges, holding one chunk of edges in memory at a time
+
+    Writes the files write_motif_edges and write_motif_graphml write for the edges of
+    Mass2Motif_2_Network(..., expand=False), for edge tables too large to map in memory.
+    The edge table is read three times, chunk by chunk: to count the shared motifs per
+    molecular family, to write the edges of the network and to write a separate edge for
+    each shared motif. Shared motifs are looked up in a memory-mapped motif_lookup. Only the
+    nodes, the lookup and the counts of motifs per family are held as a whole.
+
+    :param edges: Path of an edges file downloaded from GNPS, read with tables.iter_table, or the edges as dataframe, with integer scans
+    :type edges: str or pandas.core.frame.DataFrame
+    :param motifs: A motif summary file downloaded from MS2LDA
+    :type motifs: pandas.core.frame.DataFrame
+    :param path: Path of the edge table to write, a .parquet file or a tab separated text file
+    :type path: str
+    :param prob: Minimal probability score for a Mass2Motif to be included 
+    :type prob: float
+    :param overlap: Minimal overlap score for a Mass2Motif to be included
+    :type overlap: float
+    :param top: Specifies how many most shared motifs per molecular family (network component index) should be shown
+    :type top: int
+    :param sparse: How to return the scan x Mass2Motif overlap matrix, see Mass2Motif_2_Network
+    :type sparse: bool or str
+    :param graphml: Path of a GraphML file to write the network of make_motif_graphml to as well
+    :type graphml: str
+    :param chunksize: Number of edges per chunk
+    :type chunksize: int
+    :param directory: Directory of the memory-mapped motif lookup, defaults to a temporary directory removed afterwards
+    :type directory: str
+    :param kwargs: Further arguments of tables.iter_table, such as sep or cache
+    :return: A dictionary with the nodes as returned by Mass2Motif_2_Network ('nodes'), the path of the edge table ('edges') and, with sparse='csr', the overlap matrix ('overlap')
+    :rtype: dict
+
+    """
+    import tempfile
+    import pandas as pd
+    from . import tables
+    
+    def read():
+        if isinstance(edges, str):
+            return tables.iter_table(edges, chunksize, **kwargs)
+        return (edges.iloc[start:start + chunksize] for start in range(0, len(edges), chunksize))
+    
+    motifs = motifs[motifs.probability > prob]
+    motifs = motifs[motifs.overlap > overlap]
+    motifs = motifs.astype({c: object for c in motifs.columns if isinstance(motifs[c].dtype, pd.CategoricalDtype)})
+    nodes, matrix = _motif_nodes(motifs, sparse)
+    
+    with contextlib.ExitStack() as stack:
+        if directory is None:
+            directory = stack.enter_context(tempfile.TemporaryDirectory())
+        lookup = motif_lookup(motifs, directory)
+        
+        # first pass: shared motifs per family, and the nodes in order of appearance
+        counts, families, ids, seen, template = None, None, {}, 0, None
+        for chunk in read():
+            if template is None:
+                template = chunk.iloc[:0]
+            both, edge, codes = _shared_motifs(lookup, chunk['CLUSTERID1'].values, chunk['CLUSTERID2'].values)
+            long = pd.DataFrame({'ComponentIndex': chunk['ComponentIndex'].values[edge], 'motif': codes, 'first': range(seen, seen + len(codes))})
+            part = long.groupby(['ComponentIndex', 'motif'], sort=False)['first'].agg(['size', 'min']).reset_index()
+            part.columns = ['ComponentIndex', 'motif', 'count', 'first']
+            counts = part if counts is None else pd.concat([counts, part]).groupby(['ComponentIndex', 'motif'], sort=False).agg({'count': 'sum', 'first': 'min'}).reset_index()
+            part = pd.DataFrame({'none': ~both}).groupby(chunk['ComponentIndex'].values)['none'].agg(['size', 'all'])
+            families = part if families is None else pd.concat([families, part]).groupby(level=0).agg({'size': 'sum', 'all': 'all'})
+            if graphml is not None:
+                ids.update(dict.fromkeys(pd.unique(chunk[['CLUSTERID1', 'CLUSTERID2']].values.ravel()).tolist()))
+            seen += len(codes)
+            metrics.count('write_motif_network.edges', len(chunk))
+        
+        if counts is None:
+            template = pd.DataFrame(columns=['CLUSTERID1', 'CLUSTERID2', 'ComponentIndex'])
+            counts = pd.DataFrame(columns=['ComponentIndex', 'motif', 'count', 'first'])
+            families = pd.DataFrame(columns=['size', 'all'])
+        counts['motif'] = lookup['motifs'][counts['motif'].values.astype(int)]
+        topmotifs = _top_motifs(counts, families, top)
+        overlap_matrix = matrix if sparse == 'csr' else None
+        
+        writer = None
+        if graphml is not None:
+            writer = stack.enter_context(_motif_graphml_writer(graphml, nodes, list(ids), _map_motif_edges(template, lookup, topmotifs), overlap_matrix, chunksize))
+        
+        def network():
+            # second pass: the edges of the network, third pass: one edge per shared motif
+            mapped = (_map_motif_edges(chunk, lookup, topmotifs) for chunk in read())
+            parts = (part for chunk in read() for part in _motif_edge_chunks(_map_motif_edges(chunk, lookup, topmotifs), chunksize))
+            for chunk in itertools.chain(mapped, parts):
+                if writer is not None:
+                    names, columns = _motif_edge_attributes(chunk)
+                    writer.write_edges(chunk['CLUSTERID1'].tolist(), chunk['CLUSTERID2'].tolist(), columns)
+                yield chunk
+        
+        tables.write_chunks(network(), path)
+    
+    if sparse == 'csr':
+        return {'nodes':nodes,'edges':path,'overlap':matrix}
+    return {'nodes':nodes,'edges':path}
+
+def motif_overlap_matrix(motifs, scans = None):
+    """Build a sparse scan x Mass2Motif matrix of overlap scores
+
+    :param motifs: A motif summary file downloaded from MS2LDA, filtered as needed
+    :type motifs: pandas.core.frame.DataFrame
+    :param scans: Row order of the matrix, defaults to the sorted unique scans in motifs
+    :type scans: array-like
+    :return: A dictionary with the CSR matrix ('matrix') and its row ('scans') and column ('motifs') index arrays
+    :rtype: dict
+
+    """
+    import pandas as pd
+    from scipy.sparse import csr_matrix
+    
+    # the last overlap wins if a scan lists the same motif twice
+    pairs = motifs.drop_duplicates(['scans', 'motif'], keep='last')
+    if scans is None:
+        scans = pd.Index(pairs['scans'].unique()).sort_values()
+    scans = pd.Index(scans)
+    names = pd.Index(motifs.motif.unique())
+    
+    rows = scans.get_indexer(pairs['scans'])
+    cols = names.get_indexer(pairs['motif'])
+    keep = rows >= 0
+    matrix = csr_matrix((pairs['overlap'].values[keep].astype(float), (rows[keep], cols[keep])), 
+                        shape=(len(scans), len(names)))
+    
+    return {'matrix':matrix, 'scans':scans.values, 'motifs':names.values}
 
 def make_inchidic(smilesdic):
     """Convert a dictionary of SMILES to a dictionary of InChIKeys
 
-    :param smilesdic: A dictionary of SMILES
+    :param smilesdic: A dictionary of SMILES, or links of features to SMILES as returned by unique_smiles(..., compact=True)
     :type smilesdic: dict
-    :return: A dictionary of InChIKeys
+    :return: A dictionary of InChIKeys, or links of features to InChIKeys if smilesdic holds links
     :rtype: InChIKeys
 
     """
-    inchi_dic = smilesdic['dic'].copy()
-    d = {k: v for k, v in zip(smilesdic['df'].SMILES, smilesdic['df'].inchikey)}
-    for k in inchi_dic:
-        inchi_dic[k] = [d.get(k, k) for k in inchi_dic[k] if d.get(k, k) != k]
-    
-    return inchi_dic
+    return _map_structures(smilesdic, 'SMILES')
     
 def make_inchidic_INCHIS(smilesdic):
     """Convert a dictionary of INCHIS to a dictionary of InChIKeys
-    :param smilesdic: A dictionary of INCHIS
+    :param smilesdic: A dictionary of INCHIS, or links of features to INCHIS as returned by unique_inchis(..., compact=True)
     :type smilesdic: dict
-    :return: A dictionary of InChIKeys
+    :return: A dictionary of InChIKeys, or links of features to InChIKeys if smilesdic holds links
     :rtype: InChIKeys
     """
+    return _map_structures(smilesdic, 'INCHI')
+
+def _map_structures(smilesdic, column):
+    d = {k: v for k, v in zip(smilesdic['df'][column], smilesdic['df'].inchikey)}
+    
+    # links are mapped once per unique structure
+    if isinstance(smilesdic['dic'], StructureLinks):
+        return smilesdic['dic'].map_structures(d)
+    
     inchi_dic = smilesdic['dic'].copy()
-    d = {k: v for k, v in zip(smilesdic['df'].INCHI, smilesdic['df'].inchikey)}
     for k in inchi_dic:
         inchi_dic[k] = [d.get(k, k) for k in inchi_dic[k] if d.get(k, k) != k]
     
     return inchi_dic
 
-def unique_smiles(matches):
+# structures converted per batch, the unit of work of a worker process and of cache writes
+structure_batchsize = 1000
+
+@metrics.timer('structure_inchikeys')
+def structure_inchikeys(smilesdic, cache = None, n_jobs = 1, batchsize = structure_batchsize, convert = None):
+    """Convert the unique SMILES or InChIs returned by unique_smiles or unique_inchis to InChIKeys
+
+    Structures found in the cache are not converted again. The others are converted in
+    batches, in worker processes if n_jobs > 1, and stored in the cache batch by batch.
+    Structures that could not be converted are left out of the dataframe of structures,
+    so that make_inchidic and make_inchidic_INCHIS leave them out, and are listed with the
+    reason in a separate dataframe.
+
+    :param smilesdic: A dictionary containing a dataframe with overall unique SMILES or InChIs and unique structures per molecular feature, as returned by unique_smiles or unique_inchis
+    :type smilesdic: dict
+    :param cache: Persistent store of the InChIKeys of structures, None converts all structures
+    :type cache: StructureCache
+    :param n_jobs: Number of worker processes, -1 for one per CPU
+    :type n_jobs: int
+    :param batchsize: Number of structures per batch
+    :type batchsize: int
+    :param convert: Function converting a list of structures to a list of pairs of InChIKey and the reason the conversion failed, None for RDKit. It is sent to the worker processes, so it needs to be picklable if n_jobs > 1
+    :type convert: function
+    :return: smilesdic with the converted structures and their InChIKeys prefixed with 'InChIKey=' as returned by ClassyFire (column inchikey) as dataframe ('df'), the structures that could not be converted with the reason (column error) ('failed') and the number of structures converted rather than taken from the cache ('converted')
+    :rtype: dict
+
+    """
+    import pandas as pd
+    
+    column = 'INCHI' if 'INCHI' in smilesdic['df'].columns else 'SMILES'
+    structures = list(OrderedDict.fromkeys(smilesdic['df'][column]))
+    results = cache.get_many(structures) if cache is not None else {}
+    missing = [s for s in structures if s not in results]
+    if convert is None:
+        convert = functools.partial(_rdkit_inchikeys, inchi = column == 'INCHI')
+    
+    batches = [missing[i:i + batchsize] for i in range(0, len(missing), batchsize)]
+    for batch, converted in zip(batches, _map_batches(convert, batches, n_jobs)):
+        rows = [(structure, inchikey, error) for structure, (inchikey, error) in zip(batch, converted)]
+        results.update((structure, (inchikey, error)) for structure, inchikey, error in rows)
+        if cache is not None:
+            cache.put_many(rows)
+    
+    df = smilesdic['df'].copy()
+    df['inchikey'] = [results[s][0] for s in df[column]]
+    errors = [results[s][1] for s in df[column]]
+    failed = pd.DataFrame({column: df[column].values, 'error': errors})[df['inchikey'].isnull().values].reset_index(drop=True)
+    df = df.dropna(subset=['inchikey'])
+    
+    metrics.count('structure_inchikeys.structures', len(structures))
+    metrics.count('structure_inchikeys.converted', len(missing))
+    metrics.count('structure_inchikeys.failed', len(failed))
+    logger.info('%d structures, %d converted, %d could not be converted', len(structures), len(missing), len(failed))
+    return dict(smilesdic, df=df, failed=failed, converted=len(missing))
+
+def _map_batches(convert, batches, n_jobs):
+    # results of batches in order, as they are done
+    if n_jobs < 0:
+        n_jobs = max(1, multiprocessing.cpu_count() + 1 + n_jobs)
+    if n_jobs == 1 or len(batches) < 2:
+        for batch in batches:
+            yield convert(batch)
+        return
+    with multiprocessing.Pool(min(n_jobs, len(batches))) as pool:
+        for converted in pool.imap(convert, batches):
+            yield converted
+
+def _rdkit_inchikeys(structures, inchi = False):
+    """Convert SMILES or InChIs to InChIKeys with RDKit
+
+    :return: Pairs of InChIKey prefixed with 'InChIKey=' and the reason the conversion failed, one of them None
+    :rtype: list
+    """
+    from rdkit import Chem
+    from rdkit import RDLogger
+    RDLogger.DisableLog('rdApp.*')
+    
+    results = []
+    for structure in structures:
+        try:
+            if inchi:
+                inchikey = Chem.InchiToInchiKey(structure)
+                error = 'invalid InChI'
+            else:
+                mol = Chem.MolFromSmiles(structure)
+                inchikey = Chem.MolToInchiKey(mol) if mol is not None else None
+                error = 'invalid SMILES' if mol is None else 'no InChI'
+        except Exception as e:
+            inchikey, error = None, '%s: %s' % (type(e).__name__, e)
+        results.append(('InChIKey=' + inchikey, None) if inchikey else (None, error))
+    return results
+
+@metrics.timer('unique_smiles')
+def unique_smiles(matches, compact = False):
     """Retrieve overall unique SMILES and unique SMILES per molecular feature 
 
     :param matches: A list of dataframes with feature IDs and corresponding SMILES, where each dataframe can correspond to a different source of chemical structural annotation (e.g. GNPS library matches, in silico strucutral prediction through NAP, Dereplicator or SIRIUS+CSI:FingerID). Feature IDs need to correspond in all dataframes as well as the mass spectral molecular network.
     :type matches: list
+    :param compact: Whether to return unique SMILES per molecular feature as StructureLinks instead of a dictionary
+    :type compact: bool
     :return: A dictionary containing a dataframe with doverall unique SMILES and a dictionary with unique SMILES per molecular feature
     :rtype: dict
 
     """
-    # combine SMILES for same feature into one string of features
-    for index, item in enumerate(matches):
-        if 'Scan' in matches[index].columns:
-            matches[index] = matches[index].groupby('Scan', as_index=False).agg(lambda x: ','.join(set(x.dropna()))) 
-            matches[index] = matches[index].rename(columns = {'Scan':'cluster.index'})
-        if '#Scan#' in matches[index].columns:
-            matches[index] = matches[index].groupby('#Scan#', as_index=False).agg(lambda x: ','.join(set(x.dropna())))
-            matches[index] = matches[index].rename(columns = {'#Scan#':'cluster.index'})
-            
-    comb = reduce(lambda left,right: pd.merge(left,right,on='cluster.index', how = "outer"), matches)
-    if 'FusionSMILES' in comb.columns:
-        comb = comb.drop(['FusionSMILES', 'ConsensusSMILES'], axis=1)
+    def clean(smiles):
+        # remove white space from SMILES
+        smiles = smiles.str.strip().str.replace(' ', '', regex=False)
+        return smiles[~smiles.isin(['', 'N/A'])]
     
-    # concatenate all SMILES
-    comb['AllSmiles'] = comb.filter(regex='^.*(Smiles|SMILES).*$').apply(lambda x: ','.join([y for y in x.tolist() if str(y) != 'nan']), axis=1)
+    return _unique_structures(matches, '^.*(Smiles|SMILES).*$', ',', 'SMILES', ('Scan', '#Scan#'), clean, compact)
     
-    # create dictionary of SMILES
-    comb_dic = comb.set_index('cluster.index')['AllSmiles'].to_dict()
+@metrics.timer('unique_inchis')
+def unique_inchis(matches, compact = False):
+    """Retrieve overall unique InChIs and unique InChIs per molecular feature
+
+    :param matches: A list of dataframes with feature IDs (column Scan) and corresponding InChIs, where each dataframe can correspond to a different source of chemical structural annotation. Several InChIs per field are separated by ';'.
+    :type matches: list
+    :param compact: Whether to return unique InChIs per molecular feature as StructureLinks instead of a dictionary
+    :type compact: bool
+    :return: A dictionary containing a dataframe with overall unique InChIs and a dictionary with unique InChIs per molecular feature
+    :rtype: dict
+
+    """
+    def clean(inchis):
+        return inchis[~inchis.isin(['', ' '])]
     
-    # split comma separated strings of SMILES 
-    for k in comb_dic:
-        comb_dic[k] = comb_dic[k].split(',')
+    return _unique_structures(matches, '^.*(INCHI).*$', ';', 'INCHI', ('Scan',), clean, compact)
+
+def _unique_structures(matches, pattern, sep, name, scans, clean, compact = False):
+    """Melt the structures of all sources into one long (cluster.index, structure) table and retrieve overall unique structures and unique structures per molecular feature from it
+
+    :param matches: A list of dataframes with feature IDs and corresponding structures
+    :type matches: list
+    :param pattern: Regular expression matching the names of columns holding structures
+    :type pattern: str
+    :param sep: Separator of several structures in one field
+    :type sep: str
+    :param name: Name of the column of unique structures
+    :type name: str
+    :param scans: Names of feature ID columns, renamed to cluster.index
+    :type scans: tuple
+    :param clean: Function normalizing a series of structures and dropping those that are not structures
+    :type clean: function
+    :param compact: Whether to return unique structures per molecular feature as StructureLinks instead of a dictionary
+    :type compact: bool
+    :return: A dictionary containing a dataframe with overall unique structures and a dictionary (or StructureLinks) with unique structures per molecular feature, in order of first appearance
+    :rtype: dict
+
+    """
+    import numpy as np
+    import pandas as pd
     
-    # retrieve unique SMILES per feature
-    for i in comb_dic:
-        comb_dic[i] = list(set(comb_dic[i]))
-        
-    # remove empty values
-    comb_dic = {k: comb_dic[k] for k in comb_dic if not comb_dic[k] == ['']} 
-    comb_dic = {k: comb_dic[k] for k in comb_dic if not comb_dic[k] == []}
-    comb_dic = {k: comb_dic[k] for k in comb_dic if not comb_dic[k] == [' ']}
+    # one row per feature and field holding structures, over all sources
+    long = []
+    for match in matches:
+        scan = [c for c in scans if c in match.columns]
+        scan = scan[0] if scan else 'cluster.index'
+        columns = [c for c in match.columns if re.match(pattern, c) and c not in ('FusionSMILES', 'ConsensusSMILES')]
+        for column in columns:
+            long.append(pd.DataFrame({'cluster.index': match[scan].values, name: match[column].values}))
+    if not long:
+        return {'df': pd.DataFrame({name: []}), 'dic': StructureLinks.from_dict({}) if compact else {}}
+    long = pd.concat(long, ignore_index=True).dropna(subset=[name])
     
-    # convert dictionary into list of unique SMILES
-    l = list(set([item for sublist in list(comb_dic.values()) for item in sublist]))
-    l = [x.strip() for x in l]
-    l = [x for x in l if x not in ['',' ',None, 'N/A']]
+    # one row per feature and structure, missing values that were converted to strings are missing
+    long[name] = long[name].astype(str).str.split(sep)
+    long = long.explode(name).reset_index(drop=True)
+    long = long[long[name] != 'nan']
+    structures = clean(long[name])
+    long = long.loc[structures.index]
+    long[name] = structures
+    long = long.drop_duplicates(['cluster.index', name])
+    if compact:
+        links = StructureLinks.from_pairs(long['cluster.index'].values, long[name].values)
+        return {'df': pd.DataFrame({name: links.structures}), 'dic': links}
     
-    # convert list into dataframe
-    df = pd.DataFrame({"SMILES": l})
+    # unique structures per feature in a single pass, features in sorted order
+    codes, ids = pd.factorize(long['cluster.index'], sort=True)
+    order = np.argsort(codes, kind='mergesort')
+    structures = long[name].values[order]
+    bounds = np.cumsum(np.bincount(codes, minlength=len(ids)))[:-1]
+    dic = dict(zip(ids.tolist(), [item.tolist() for item in np.split(structures, bounds)]))
     
-    # remove white space from SMILES
-    df.SMILES = df.SMILES.str.replace(' ', '')
+    df = pd.DataFrame({name: pd.unique(structures)})
     
-    return {'df':df, 'dic':comb_dic}
+    return {'df':df, 'dic':dic}
+
+def highestscore(a, chem_dic, score):
+    """Retrieve most predominant chemical class per componentindex at a single level of the ClassyFire chemical ontology
+
+    :param a: list of all cluster indexes per componentindex
+    :type a: list
+    :param chem_dic: A dictionary of chemical classes at a single level of the ClassyFire chemical ontology
+    :type chem_dic: dict
+    :param score: A list of number of nodes per compontentindex
+    :type score: list
+    :return: List of componentindexes with name and score of the most predominant chemical class at a signle level of the ClassyFire chemical ontology
+    :rtype: list
+
+    """
+    import numpy as np
+    import pandas as pd
     
-def unique_inchis(matches):
+    # one row per chemical class of the SMILES matched to one node, where each node 
+    # occurrence in a gets its own slot
+    slots = [(index, x) for index, item in enumerate(a) for x in item]
+    classes = pd.DataFrame({'component': np.array([s[0] for s in slots], dtype=int),
+                            'slot': np.arange(len(slots))})
+    lengths = [len(chem_dic[s[1]]) for s in slots]
+    classes = classes.loc[classes.index.repeat(lengths)].reset_index(drop=True)
+    classes['level'] = 0
+    classes['class'] = pd.Series([c for s in slots for c in chem_dic[s[1]]], dtype=object)
     
-    # combine SMILES for same feature into one string features
-    #for index, item in enumerate(matches):
-        #if 'Scan' in matches[index].columns:
-           # matches[index] = matches[index].groupby('Scan', as_index=False).agg(lambda x: ','.join(set(x.dropna()))) 
-           # matches[index] = matches[index].rename(columns = {'Scan':'cluster.index'})
-            
-    for index, item in enumerate(matches):
-        if 'Scan' in matches[index].columns:
-            matches[index] = matches[index].groupby('Scan', as_index=False).agg(lambda x: ';'.join(map(str,x)) if is_numeric_dtype(x) else ';'.join(set(x.dropna()))) 
-            matches[index] = matches[index].rename(columns = {'Scan':'cluster.index'})
-            
-    comb = reduce(lambda left,right: pd.merge(left,right,on='cluster.index', how = "outer"), matches)
-    if 'FusionSMILES' in comb.columns:
-        comb = comb.drop(['FusionSMILES', 'ConsensusSMILES'], axis=1)
+    return _class_scores(classes, score, [0])[0]
+
+@metrics.timer('highestscores')
+def highestscores(a, inchi_dic, df, score, levels = ('kingdom', 'superclass', 'CF_class', 'subclass', 'direct_parent', 'molecular_framework'), n_jobs = 1):
+    """Retrieve most predominant chemical class per componentindex at several levels of the ClassyFire chemical ontology in a single pass
+
+    With n_jobs other than 1, componentindexes are split into shards of consecutive
+    componentindexes that are scored in worker processes. On platforms that start worker
+    processes by spawning (Windows, macOS), call it from within an if __name__ == '__main__': block.
+
+    :param a: list of all cluster indexes per componentindex
+    :type a: list
+    :param inchi_dic: A dictionary of nodes with corresponding InChIKeys, or links of nodes to InChIKeys as returned by make_inchidic
+    :type inchi_dic: dict or StructureLinks
+    :param df: A dataframe comprising all unique InChIKeys and corresponding chemical classes at each level of the ClassyFire chemical ontology
+    :type df: pandas.core.frame.DataFrame
+    :param score: A list of number of nodes per compontentindex
+    :type score: list
+    :param levels: Columns of df holding the levels of the ClassyFire chemical ontology
+    :type levels: tuple
+    :param n_jobs: Number of worker processes, -1 for one per CPU
+    :type n_jobs: int
+    :return: A dictionary with, for each level, a list of componentindexes with name and score of the most predominant chemical class as returned by highestscore
+    :rtype: dict
+
+    """
+    import numpy as np
+    import pandas as pd
     
-    # concatenate all SMILES
-    comb['All_INCHIS'] = comb.filter(regex='^.*(INCHI).*$').apply(lambda x: ';'.join([y for y in x.tolist() if str(y) != 'nan']), axis=1)
+    levels = list(levels)
+    if n_jobs != 1 and len(a) > 1:
+        return _parallel_highestscores(a, inchi_dic, df, score, levels, n_jobs)
     
-    # create dictionary of SMILES
-    comb_dic = comb.set_index('cluster.index')['All_INCHIS'].to_dict()
+    if isinstance(inchi_dic, StructureLinks):
+        links = inchi_dic
+    else:
+        links = StructureLinks.from_dict({x: inchi_dic[x] for item in a for x in item})
     
-    # split comma separated strings of SMILES 
-    for k in comb_dic:
-        comb_dic[k] = comb_dic[k].split(';')
+    # one row per InChIKey matched to one node, where each node occurrence in a gets its own slot
+    nodes = np.asarray([x for item in a for x in item])
+    per_slot, codes = links.gather(nodes)
+    component = np.repeat(np.repeat(np.arange(len(a)), [len(item) for item in a]), per_slot)
+    slot = np.repeat(np.arange(len(nodes)), per_slot)
     
-    # retrieve unique SMILES per feature
-    for i in comb_dic:
-        comb_dic[i] = list(set(comb_dic[i]))
+    # chemical classes are looked up once per unique InChIKey and coded as integers over all levels, 
+    # InChIKeys without ClassyFire results are dropped, for duplicate InChIKeys the last row wins
+    lookup = df.drop_duplicates('inchikey', keep='last').set_index('inchikey')[levels]
+    pos = lookup.index.get_indexer(pd.Index(links.structures, dtype=object))
+    names = []
+    columns = {'component': [], 'slot': [], 'level': [], 'class': []}
+    for level, l in enumerate(levels):
+        labels = np.append(np.asarray(lookup[l].values, dtype=object), None)[pos]
+        # a class equal to its InChIKey is not a class
+        valid = ((pos >= 0) & (labels != links.structures))[codes]
+        # missing classes are a class of their own
+        label_codes, uniques = pd.factorize(pd.Series(labels, dtype=object))
+        label_codes = np.where(label_codes < 0, len(uniques), label_codes) + len(names)
+        names.extend(list(uniques) + [np.nan])
         
-    # remove empty values
-    comb_dic = {k: comb_dic[k] for k in comb_dic if not comb_dic[k] == ['']} # 2172
-    comb_dic = {k: comb_dic[k] for k in comb_dic if not comb_dic[k] == []}
-    comb_dic = {k: comb_dic[k] for k in comb_dic if not comb_dic[k] == [' ']}
+        # long format (component, slot, level, class), level by level
+        columns['component'].append(component[valid])
+        columns['slot'].append(slot[valid])
+        columns['level'].append(np.full(valid.sum(), level))
+        columns['class'].append(label_codes[codes][valid])
+    classes = pd.DataFrame({c: np.concatenate(v) if v else np.array([], dtype=int) for c, v in columns.items()})
+    
+    scores = _class_scores(classes, score, range(len(levels)), np.array(names, dtype=object))
+    return {l: scores[i] for i, l in enumerate(levels)}
+
+# inputs shared by all shards scored in a worker process, set once per worker by _init_scoring
+_scoring_inputs = {}
+
+def _init_scoring(inchi_dic, df, levels):
+    _scoring_inputs.update(inchi_dic=inchi_dic, df=df, levels=levels)
+
+def _score_shard(shard):
+    a, score = shard
+    return highestscores(a, _scoring_inputs['inchi_dic'], _scoring_inputs['df'], score, _scoring_inputs['levels'])
+
+def _parallel_highestscores(a, inchi_dic, df, score, levels, n_jobs):
+    """Score shards of consecutive componentindexes in worker processes and join the results in order of the componentindexes"""
+    import numpy as np
     
-    # convert dictionary into list of unique SMILES
-    l = list(set([item for sublist in list(comb_dic.values()) for item in sublist]))
-    l = [x for x in l if x not in ['',' ',None]]
+    if n_jobs < 0:
+        n_jobs = max(1, multiprocessing.cpu_count() + 1 + n_jobs)
     
-    # convert list into dataframe
-    df = pd.DataFrame({"INCHI": l})
+    # only the InChIKeys and classes highestscores reads are sent to the workers, for duplicate InChIKeys the last row wins
+    df = df.drop_duplicates('inchikey', keep='last')[['inchikey'] + levels]
+    inchi_dic = StructureLinks.from_dict(inchi_dic)
     
-    return {'df':df, 'dic':comb_dic}
+    # shards with about the same number of nodes with InChIKeys, four per worker to even out run times
+    n_shards = min(len(a), 4 * n_jobs)
+    nodes = np.cumsum([len(item) for item in a])
+    bounds = np.searchsorted(nodes, nodes[-1] * np.arange(1, n_shards) / float(n_shards), side='right')
+    bounds = [0] + sorted(set(bounds.tolist()).difference([0, len(a)])) + [len(a)]
+    shards = [(a[start:end], score[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+    
+    with multiprocessing.Pool(min(n_jobs, len(shards)), initializer=_init_scoring, initargs=(inchi_dic, df, levels)) as pool:
+        results = pool.map(_score_shard, shards, chunksize=1)
+    
+    return {l: [item for result in results for item in result[l]] for l in levels}
 
-def highestscore(a, chem_dic, score):
-    """Retrieve most predominant chemical class per componentindex at a single level of the ClassyFire chemical ontology
+def _class_scores(classes, score, levels, names = None):
+    """Score chemical classes of all componentindexes and levels at once
 
-    :param a: list of all cluster indexes per componentindex
-    :type a: list
-    :param chem_dic: A dictionary of chemical classes at a single level of the ClassyFire chemical ontology
-    :type chem_dic: dict
+    Each node contributes a total of 1 per level, split over its chemical classes by the 
+    number of SMILES associated with each class. The summed node fractions per componentindex
+    are divided by the number of nodes per componentindex. Ties go to the class found first.
+
+    :param classes: A long format dataframe with columns component (position in score), slot (node occurrence), level and class, in node order
+    :type classes: pandas.core.frame.DataFrame
     :param score: A list of number of nodes per compontentindex
     :type score: list
-    :return: List of componentindexes with name and score of the most predominant chemical class at a signle level of the ClassyFire chemical ontology
-    :rtype: list
+    :param levels: Level codes used in classes
+    :type levels: list
+    :param names: Names of the chemical classes if classes holds integer codes of chemical classes
+    :type names: numpy.ndarray
+    :return: A dictionary with, for each level code, a list of componentindexes with name and score of the most predominant chemical class
+    :rtype: dict
 
     """
-    # creates a list of lists, where each list item corresponds to one componentindex
-    # each sublist item corresponds to the chemical classes of the SMILES matched to one node
-    chem_ci = []
-    for i in a:
-        chem_ci.append([chem_dic[x] for x in i])
-
-    # Creates a list of dictionaries, where each list item corresponds to one componentindex and each
-    # dictionary corresponds to the chemical categories found within this node with a corresponding score.
-    #
-    # This score sums up to 1 per node and corresponds to the number of SMILES associated with this class 
-    # divided by the total number of SMILES per node.
-    chem_scores = [] 
-    for i in chem_ci:
-        subl = []
-        for j in i:
-            dic_a = dict(Counter(j))
-            out = {k: v / total for total in (sum(dic_a.values()),) for k, v in dic_a.items()}
-            subl.append(out)
-        chem_scores.append(subl)
-
-    # List of dictionaries, each list item corresponds to one componentindex and dictionaries contain
-    # summed values per chemical category per component index.
-    #
-    # E.g. Organic acids and derivatives': 2.1246753246753247 means that 2.12 nodes
-    # in this molecular family were classified as Organic acids and derivatives
-    chem_sums = []
-    for i in chem_scores:
-        if i:
-            sums = functools.reduce(operator.add, map(Counter, i))
-        if not i:
-            sums = []
-        chem_sums.append(sums)
-
-    # List of items, where each list item corresponds to one componentindex and name and score of the most highly abundant
-    # chemical class are found in it.
-    # 
-    # E.g. Lipids and 0.75 means that 0.75 of the molecular family was associated to lipids, 
-    # this could be the case if e.g. Lipids score is 2.25 (nodes) and the molecular family consits of a total of 3 nodes.
-    chem_finalscore = []
-    for index, item in enumerate(chem_sums): 
-        if chem_sums[index]:
-            char = max(chem_sums[index].items(), key=operator.itemgetter(1))
-            num = char[1]/score[index]
-        if not chem_sums[index]:
-            char = ["no matches","no matches"]
-            num = ""
-        chem_finalscore.append([char[0],num])
-    
-    return chem_finalscore
-
-def molfam_classes(net, df, smilesdict):
+    import numpy as np
+    
+    final = {l: [["no matches", ""] for i in score] for l in levels}
+    if not len(classes):
+        return final
+    
+    # fraction of the SMILES of each node per chemical class
+    per_node = classes.groupby(['slot', 'level', 'class'], sort=False, dropna=False).size()
+    per_node = per_node / per_node.groupby(level=['slot', 'level']).transform('sum')
+    per_node = per_node.reset_index(name='fraction')
+    per_node['component'] = classes.drop_duplicates('slot').set_index('slot')['component'].reindex(per_node['slot']).values
+    
+    # summed node fractions per componentindex, added up one node after the other as
+    # highestscore does, so that equal scores and the class found first win the same ties
+    groups = per_node.groupby(['level', 'component', 'class'], sort=False, dropna=False)
+    fractions = np.zeros(groups.ngroups)
+    np.add.at(fractions, groups.ngroup().values, per_node['fraction'].values)
+    sums = groups.size().reset_index(name='n')
+    sums['fraction'] = fractions
+    best = sums.loc[sums.groupby(['level', 'component'], sort=False)['fraction'].idxmax()]
+    
+    best_classes = names[best['class'].values] if names is not None else best['class']
+    for l, c, char, num in zip(best['level'], best['component'], best_classes, best['fraction']):
+        final[l][c] = [char, num/score[c]]
+    
+    return final
+
+@metrics.timer('molfam_classes')
+@_quiet_chained_assignment
+def molfam_classes(net, df, smilesdict, n_jobs = 1):
     """Retrieve most predominant chemical class for each level of the ClassyFire chemical ontology
 
     :param net: GNPS network data
@@ -310,74 +893,78 @@ def molfam_classes(net, df, smilesdict):
     :type df: pandas.core.frame.DataFrame
     :param smilesdict: A dictionary of nodes with corresponding unique SMILES
     :type smilesdict: dict
+    :param n_jobs: Number of worker processes scoring componentindexes, -1 for one per CPU, see highestscores
+    :type n_jobs: int
     :return: A dataframe containing most predominant chemical classes per node at each level of the ClassyFire chemical ontology
     :rtype: pandas.core.frame.DataFrame
 
     """
-    # create dictionaries for each hierarchical level of Classyfire
+    ci, score, a = _components(net, smilesdict)
+    metrics.count('molfam_classes.nodes', len(net))
+    metrics.count('molfam_classes.components', len(a))
+    
+    # score all levels of the ClassyFire chemical ontology in one pass
+    finalscores = highestscores(a, smilesdict, df, score, n_jobs=n_jobs)
+    
+    return _molfam_table(net, ci, score, finalscores)
+
+def _components(net, smilesdict):
+    """Group the cluster indexes of a network by componentindex, renaming the componentindex of selfloops in net to S1, S2, ...
+
+    :param net: GNPS network data
+    :type net: pandas.core.frame.DataFrame
+    :param smilesdict: A dictionary of nodes with corresponding unique SMILES or InChIKeys
+    :type smilesdict: dict
+    :return: The componentindexes in order of appearance, the number of nodes per componentindex and the cluster indexes with SMILES per componentindex
+    :rtype: tuple
+    """
+    import numpy as np
+    import pandas as pd
     
     # rename componentindex of selfloops, so they are considered independently of each other
     selfs = list(range(1,len(net.componentindex[net.componentindex == -1])+1))
-    net.loc[net.componentindex == -1,['componentindex']] = ["S" + str(s) for s in selfs]
-
+    selfloops = net.componentindex == -1
+    net['componentindex'] = net['componentindex'].astype(object)
+    net.loc[selfloops,['componentindex']] = ["S" + str(s) for s in selfs]
+
+    # group all cluster indexes by componentindex in a single pass over the network
+    codes, ci = pd.factorize(net['componentindex'])
+    ci = list(ci)
+    order = np.argsort(codes, kind='mergesort')
+    
+    # score retrieves number of nodes per cluster index
+    score = np.bincount(codes, minlength=len(ci)).tolist()
+    
+    # remove all items that do not have any SMILES (are not contained in keys of smilesdict),
+    # in the order of the set intersection, which decides between classes of equal score
+    keys = set(smilesdict.keys())
+    bounds = np.cumsum(score)[:-1]
+    a = [list(keys.intersection(item.tolist())) for item in np.split(net['cluster index'].values[order], bounds)] if ci else []
+    
+    return ci, score, a
 
-    kingdom_dic = smilesdict.copy()
-    d = {k: v for k, v in zip(df.inchikey, df.kingdom)}
-    for k in kingdom_dic:
-            kingdom_dic[k] = [d.get(k, k) for k in kingdom_dic[k] if d.get(k, k) != k]
+def _molfam_table(net, ci, score, finalscores):
+    """Map the most predominant chemical classes per componentindex onto the nodes of a network
 
-    # Superclass
-    superclass_dic = smilesdict.copy()
-    d = {k: v for k, v in zip(df.inchikey, df.superclass)}
-    for k in superclass_dic:
-            superclass_dic[k] = [d.get(k, k) for k in superclass_dic[k] if d.get(k, k) != k]
-            
-    # Class
-    class_dic = smilesdict.copy()
-    d = {k: v for k, v in zip(df.inchikey, df.CF_class)}
-    for k in class_dic:
-            class_dic[k] = [d.get(k, k) for k in class_dic[k] if d.get(k, k) != k]
-    
-    # Sublass
-    subclass_dic = smilesdict.copy()
-    d = {k: v for k, v in zip(df.inchikey, df.subclass)}
-    for k in subclass_dic:
-            subclass_dic[k] = [d.get(k, k) for k in subclass_dic[k] if d.get(k, k) != k]
-            
-    # Direct parent
-    Dparent_dic = smilesdict.copy()
-    d = {k: v for k, v in zip(df.inchikey, df.direct_parent)}
-    for k in Dparent_dic:
-            Dparent_dic[k] = [d.get(k, k) for k in Dparent_dic[k] if d.get(k, k) != k]
-            
-    # Molecular framework
-    MFramework_dic = smilesdict.copy()
-    d = {k: v for k, v in zip(df.inchikey, df.molecular_framework)}
-    for k in MFramework_dic:
-            MFramework_dic[k] = [d.get(k, k) for k in MFramework_dic[k] if d.get(k, k) != k]
-    
-    # iterate over all cluster indexes
-    ci = list(set(net['componentindex']))
-    
-    # get list of all cluster indexes per componentindex
-    a = []
-    for i in ci:
-        a.append(list(net.loc[net['componentindex'] == i, 'cluster index']))
-        
-    # remove all items that do not have any SMILES (are not contained in keys of smilesdict)
-    # score retrieves number of nodes per cluster index
-    score = []
-    for index, item in enumerate(a): 
-        red = list(set(list(smilesdict.keys())).intersection(a[index]))
-        score.append(len(a[index]))
-        a[index] = red 
-    
-    kingdom_finalscore = highestscore(a, kingdom_dic, score)
-    superclass_finalscore = highestscore(a, superclass_dic, score)
-    class_finalscore = highestscore(a, class_dic, score)
-    subclass_finalscore = highestscore(a, subclass_dic, score)
-    Dparent_finalscore = highestscore(a, Dparent_dic, score)
-    MFramework_finalscore = highestscore(a, MFramework_dic, score)
+    :param net: GNPS network data with componentindexes as returned by _components
+    :type net: pandas.core.frame.DataFrame
+    :param ci: The componentindexes
+    :type ci: list
+    :param score: The number of nodes per componentindex
+    :type score: list
+    :param finalscores: Name and score of the most predominant chemical class per componentindex and level, as returned by highestscores
+    :type finalscores: dict
+    :return: A dataframe containing most predominant chemical classes per node at each level of the ClassyFire chemical ontology
+    :rtype: pandas.core.frame.DataFrame
+    """
+    import pandas as pd
+    
+    kingdom_finalscore = finalscores['kingdom']
+    superclass_finalscore = finalscores['superclass']
+    class_finalscore = finalscores['CF_class']
+    subclass_finalscore = finalscores['subclass']
+    Dparent_finalscore = finalscores['direct_parent']
+    MFramework_finalscore = finalscores['molecular_framework']
    
     kingdom = [item[0] for item in kingdom_finalscore]
     superclass = [item[0] for item in superclass_finalscore]
@@ -403,6 +990,7 @@ def molfam_classes(net, df, smilesdict):
     
     return final
     
+@metrics.timer('make_classyfire_graphml')
 def make_classyfire_graphml(graphML,final):
     """Create a network file with chemical classes mapped
 
@@ -414,128 +1002,267 @@ def make_classyfire_graphml(graphML,final):
     :rtype: networkx.classes.graph.Graph
 
     """
-    for v in graphML.nodes():  
-
-        graphML.node[v]['CF_componentindex']= str(final[final['cluster index'] == int(v)]['CF_componentindex'].iloc[-1])
-        graphML.node[v]['CF_NrNodes']= float(final[final['cluster index'] == int(v)]['CF_NrNodes'].iloc[-1])
-        graphML.node[v]['CF_kingdom']= str(final[final['cluster index'] == int(v)]['CF_kingdom'].iloc[-1])
-
-        try:
-            graphML.node[v]['CF_kingdom_score']= float(final[final['cluster index'] == int(v)]['CF_kingdom_score'].iloc[-1])
-        except:
-            graphML.node[v]['CF_kingdom_score']= object()
-
-        graphML.node[v]['CF_superclass']= str(final[final['cluster index'] == int(v)]['CF_superclass'].iloc[-1])
-
-        try:
-            graphML.node[v]['CF_superclass_score']= float(final[final['cluster index'] == int(v)]['CF_superclass_score'].iloc[-1])
-        except:
-            graphML.node[v]['CF_superclass_score']= object()
-
-        graphML.node[v]['CF_class']= str(final[final['cluster index'] == int(v)]['CF_class'].iloc[-1])
-
-        try:
-            graphML.node[v]['CF_class_score']= float(final[final['cluster index'] == int(v)]['CF_class_score'].iloc[-1])
-        except:
-            graphML.node[v]['CF_class_score']= object()
-
-        graphML.node[v]['CF_subclass']= str(final[final['cluster index'] == int(v)]['CF_subclass'].iloc[-1])
+    import networkx as nx
+    
+    # index final once by cluster index, the last row of a cluster index wins
+    lookup = final.drop_duplicates('cluster index', keep='last').set_index('cluster index').to_dict('index')
+    
+    metrics.count('make_classyfire_graphml.nodes', graphML.number_of_nodes())
+    attributes = {}
+    for v in graphML.nodes():
+        attributes[v] = _classyfire_attributes(lookup[int(v)])
+    
+    nx.set_node_attributes(graphML, attributes)
+        
+    return graphML
 
-        try:
-            graphML.node[v]['CF_subclass_score']= float(final[final['cluster index'] == int(v)]['CF_subclass_score'].iloc[-1])
-        except:
-            graphML.node[v]['CF_subclass_score']= object()
+# node attributes mapped by make_classyfire_graphml, and their GraphML types
+_classyfire_keys = [('CF_componentindex', 'string'), ('CF_NrNodes', 'double')] + [
+    (name + suffix, kind) for name in ('CF_kingdom', 'CF_superclass', 'CF_class', 'CF_subclass', 'CF_Dparent', 'CF_MFramework') 
+    for suffix, kind in (('', 'string'), ('_score', 'double'))]
 
-        graphML.node[v]['CF_Dparent']= str(final[final['cluster index'] == int(v)]['CF_Dparent'].iloc[-1])
+@metrics.timer('write_classyfire_graphml')
+def write_classyfire_graphml(source, final, path, nodes = None):
+    """Write a network file with chemical classes mapped, copying a network file node by node instead of loading it into networkx
 
-        try:
-            graphML.node[v]['CF_Dparent_score']= float(final[final['cluster index'] == int(v)]['CF_Dparent_score'].iloc[-1])
-        except:
-            graphML.node[v]['CF_Dparent_score']= object()
+    The file holds the network nx.write_graphml(make_classyfire_graphml(nx.read_graphml(source), final), path, infer_numeric_types = True)
+    writes, with the keys, nodes and edges of source in their order. Scores that are not numeric
+    are left out, as networkx cannot write them. Nodes missing from final or from nodes are copied unchanged.
 
-        graphML.node[v]['CF_MFramework']= str(final[final['cluster index'] == int(v)]['CF_MFramework'].iloc[-1])
+    :param source: Path of a GNPS network file, or of a network file of Mass2Motifs as written by write_motif_graphml
+    :type source: str
+    :param final: A dataframe containing most predominant chemical classes per node at each level of the ClassyFire chemical ontology
+    :type final: pandas.core.frame.DataFrame
+    :param path: Path of the network file to write
+    :type path: str
+    :param nodes: Cluster indexes of the nodes to map, None maps all nodes
+    :type nodes: list
+    :return: The number of nodes
+    :rtype: int
 
+    """
+    from .graphml import map_node_attributes
+    
+    # index final once by cluster index, the last row of a cluster index wins
+    lookup = final.drop_duplicates('cluster index', keep='last').set_index('cluster index').to_dict('index')
+    if nodes is not None:
+        nodes = set(nodes)
+        lookup = {k: row for k, row in lookup.items() if k in nodes}
+    
+    def values(v):
         try:
-            graphML.node[v]['CF_MFramework_score']= float(final[final['cluster index'] == int(v)]['CF_MFramework_score'].iloc[-1])
-        except ValueError:
-            graphML.node[v]['CF_MFramework_score']= object()
-        
-    return graphML
+            row = lookup[int(v)]
+        except (KeyError, ValueError):
+            return None
+        attributes = _classyfire_attributes(row)
+        return [attributes[name] if type(attributes[name]) is not object else None for name, kind in _classyfire_keys]
     
-def make_motif_graphml(nodes, edges):
+    n_nodes = map_node_attributes(source, path, _classyfire_keys, values)
+    metrics.count('write_classyfire_graphml.nodes', n_nodes)
+    return n_nodes
+
+def _classyfire_attributes(row):
+    """Node attributes of a row of final, as make_classyfire_graphml maps them"""
+    return {'CF_componentindex': str(row['CF_componentindex']),
+            'CF_NrNodes': float(row['CF_NrNodes']),
+            'CF_kingdom': str(row['CF_kingdom']),
+            'CF_kingdom_score': _score_attribute(row['CF_kingdom_score']),
+            'CF_superclass': str(row['CF_superclass']),
+            'CF_superclass_score': _score_attribute(row['CF_superclass_score']),
+            'CF_class': str(row['CF_class']),
+            'CF_class_score': _score_attribute(row['CF_class_score']),
+            'CF_subclass': str(row['CF_subclass']),
+            'CF_subclass_score': _score_attribute(row['CF_subclass_score']),
+            'CF_Dparent': str(row['CF_Dparent']),
+            'CF_Dparent_score': _score_attribute(row['CF_Dparent_score']),
+            'CF_MFramework': str(row['CF_MFramework']),
+            'CF_MFramework_score': _score_attribute(row['CF_MFramework_score'])}
+
+def _score_attribute(score):
+    """Convert a chemical class score to a node attribute, scores that are not numeric (no matches) become an empty object
+
+    :param score: A chemical class score
+    :type score: float or str
+    :return: The score as float or an empty object
+    :rtype: float or object
+    """
+    try:
+        return float(score)
+    except (TypeError, ValueError):
+        return object()
+    
+@metrics.timer('make_motif_graphml')
+@_quiet_chained_assignment
+def make_motif_graphml(nodes, edges, overlap = None):
     """Create a network file with Mass2Motifs mapped on nodes and shared Mass2Motifs mapped as multiple edges
 
-    :param nodes: A dataframe showing Mass2Motifs per node
+    :param nodes: A dataframe showing Mass2Motifs per node, overlap columns may be dense or pandas sparse
     :type nodes: pandas.core.frame.DataFrame
     :param edges: A dataframe showing shared Mass2Motifs for each network pair
     :type edges: pandas.core.frame.DataFrame
+    :param overlap: The 'overlap' entry returned by Mass2Motif_2_Network with sparse='csr'
+    :type overlap: dict
     :return: A network file with Mass2Motifs mapped on nodes and shared Mass2Motifs mapped as multiple edges
     :rtype: networkx.classes.graph.Graph
 
     """
-    # convert lists to strings
-    edges['shared_motifs'] = edges['shared_motifs'].replace('None', '')
-    edges['TopSharedMotifs'] = edges['TopSharedMotifs'].replace('None', '')
-    edges['shared_motifs'] = edges['shared_motifs'].agg(lambda x: ','.join(map(str, x)))
-    edges['TopSharedMotifs'] = edges['TopSharedMotifs'].agg(lambda x: ','.join(map(str, x)))
+    import networkx as nx
     
-    # create motif network with multiple edges
-    MG = nx.from_pandas_edgelist(edges, 'CLUSTERID1', 'CLUSTERID2', edge_attr=list(set(list(edges.columns)) - set(['CLUSTERID1','CLUSTERID2'])), 
-                             create_using=nx.MultiGraph())
+    metrics.count('make_motif_graphml.edges', len(edges))
+    # create motif network with multiple edges, lists converted to strings
+    names, columns = _motif_edge_attributes(edges)
+    MG = nx.MultiGraph()
+    MG.add_edges_from(zip(edges['CLUSTERID1'].tolist(), edges['CLUSTERID2'].tolist(), 
+                          (dict(zip(names, values)) for values in _rows(columns, len(edges)))))
     
     # map node attributes to network
-    nodes['precursormass'] = nodes['precursormass'].agg(lambda x: ','.join(map(str, x)))
-    nodes['parentrt'] = nodes['parentrt'].agg(lambda x: ','.join(map(str, x)))
-    nodes['document'] = nodes['document'].agg(lambda x: ','.join(map(str, x)))
-    nodes['motif'] = nodes['motif'].agg(lambda x: ','.join(map(str, x)))
-    nodes['probability'] = nodes['probability'].agg(lambda x: ','.join(map(str, x)))
-    nodes['overlap'] = nodes['overlap'].agg(lambda x: ','.join(map(str, x)))
-    
-    for column in nodes:
-        nx.set_node_attributes(MG, pd.Series(nodes[column], index=nodes.index).to_dict(), column)
+    for ids, names, columns in _motif_node_attributes(nodes, list(MG), overlap):
+        for node, values in zip(ids, _rows(columns, len(ids))):
+            MG.nodes[node].update((name, value) for name, value in zip(names, values) if value is not None)
         
     return MG
+
+@metrics.timer('write_motif_graphml')
+def write_motif_graphml(nodes, edges, path, overlap = None, chunksize = motif_edge_chunksize):
+    """Write the network of make_motif_graphml to a GraphML file without building it, holding one chunk of nodes or edges in memory at a time
+
+    The file holds the nodes, attributes and edges nx.write_graphml(make_motif_graphml(...), path, infer_numeric_types = True)
+    writes, with the edges in the order of iter_motif_edges.
+
+    :param nodes: A dataframe showing Mass2Motifs per node, overlap columns may be dense or pandas sparse
+    :type nodes: pandas.core.frame.DataFrame
+    :param edges: The edges returned by Mass2Motif_2_Network(..., expand=False)
+    :type edges: pandas.core.frame.DataFrame
+    :param path: Path of the GraphML file
+    :type path: str
+    :param overlap: The 'overlap' entry returned by Mass2Motif_2_Network with sparse='csr'
+    :type overlap: dict
+    :param chunksize: Number of nodes or edges per chunk
+    :type chunksize: int
+    :return: The path
+    :rtype: str
+
+    """
+    import pandas as pd
+    
+    # nodes in order of appearance in edges, as networkx adds them
+    ids = pd.unique(edges[['CLUSTERID1', 'CLUSTERID2']].values.ravel()).tolist()
+    
+    with _motif_graphml_writer(path, nodes, ids, edges, overlap, chunksize) as writer:
+        for chunk in iter_motif_edges(edges, chunksize):
+            names, columns = _motif_edge_attributes(chunk)
+            writer.write_edges(chunk['CLUSTERID1'].tolist(), chunk['CLUSTERID2'].tolist(), columns)
+            metrics.count('write_motif_graphml.edges', len(chunk))
+    metrics.count('write_motif_graphml.nodes', len(ids))
+    return path
+
+def _motif_graphml_writer(path, nodes, ids, edges, overlap = None, chunksize = motif_edge_chunksize):
+    """Open a GraphMLWriter for the network of make_motif_graphml and write the nodes ids, leaving the edges, with the columns of edges, to the caller"""
+    from .graphml import GraphMLWriter, graphml_type
+    
+    node_keys = [(c, 'string' if c in _motif_node_lists else graphml_type(nodes[c].dtype)) for c in nodes.columns]
+    if overlap is not None:
+        node_keys += [(motif, 'double') for motif in overlap['motifs']]
+    edge_names = [c for c in edges.columns if c not in ('CLUSTERID1', 'CLUSTERID2')]
+    edge_keys = [(c, 'string' if c in _motif_edge_lists else graphml_type(edges[c].dtype)) for c in edge_names]
+    
+    writer = GraphMLWriter(path, node_keys, edge_keys)
+    # nodes have a value per motif, so chunks of nodes hold about as many values as chunks of edges
+    for chunk_ids, names, columns in _motif_node_attributes(nodes, ids, overlap, max(1, chunksize * len(edge_keys) // max(1, len(node_keys)))):
+        writer.write_nodes(chunk_ids, columns)
+    return writer
+
+# list columns of Mass2Motif_2_Network, mapped onto networks as comma separated strings
+_motif_edge_lists = ('shared_motifs', 'TopSharedMotifs')
+_motif_node_lists = ('precursormass', 'parentrt', 'document', 'motif', 'probability', 'overlap')
+
+def _joined(values):
+    # comma separated strings of lists, 'None' (edges between nodes without motifs) becomes ''
+    return [','.join(map(str, x)) if isinstance(x, list) else ('' if x == 'None' else x) for x in values]
+
+def _rows(columns, n):
+    # values of n rows given per column
+    return zip(*columns) if columns else itertools.repeat((), n)
+
+def _motif_edge_attributes(edges):
+    """Attribute names of edges and per attribute the values of all edges, as make_motif_graphml maps them"""
+    names = [c for c in edges.columns if c not in ('CLUSTERID1', 'CLUSTERID2')]
+    return names, [_joined(edges[c]) if c in _motif_edge_lists else edges[c].tolist() for c in names]
+
+def _motif_node_attributes(nodes, ids, overlap = None, chunksize = motif_edge_chunksize):
+    """Iterate over the attributes make_motif_graphml maps onto the nodes ids, chunksize nodes at a time
+
+    :return: Generator of tuples of node IDs, attribute names and per attribute the values of all nodes, None for nodes without the attribute
+    :rtype: generator
+    """
+    import numpy as np
+    import pandas as pd
+    
+    def fill(values, found):
+        if found.all():
+            return values
+        filled = [None] * len(found)
+        for i, value in zip(np.flatnonzero(found).tolist(), values):
+            filled[i] = value
+        return filled
+    
+    names = list(nodes.columns)
+    rows = nodes.index.get_indexer(ids)
+    if overlap is not None:
+        names += list(overlap['motifs'])
+        matrix = overlap['matrix'].tocsr()
+        scans = pd.Index(overlap['scans']).get_indexer(ids)
     
+    for start in range(0, len(ids), chunksize):
+        found = rows[start:start + chunksize] >= 0
+        part = nodes.iloc[rows[start:start + chunksize][found]]
+        columns = []
+        for column in part.columns:
+            if column in _motif_node_lists:
+                values = _joined(part[column])
+            elif isinstance(part[column].dtype, pd.SparseDtype):
+                values = part[column].sparse.to_dense().tolist()
+            else:
+                values = part[column].tolist()
+            columns.append(fill(values, found))
+        if overlap is not None:
+            found = scans[start:start + chunksize] >= 0
+            dense = matrix[scans[start:start + chunksize][found]].toarray()
+            columns.extend(fill(dense[:, j].tolist(), found) for j in range(dense.shape[1]))
+        yield ids[start:start + chunksize], names, columns
+
 """
 @author: Ricardo Silva (https://github.com/rsilvabioinfo)
 """
 
+@metrics.timer('make_classy_table')
 def make_classy_table(jsondic):  
+    """Convert ClassyFire entities into a table of chemical classes
+
+    :param jsondic: A list of ClassyFire entities as returned by get_classifications, None or {} for structures without entity
+    :type jsondic: list
+    :return: A dataframe with SMILES, InChIKey and the name of the chemical class at each level of the ClassyFire chemical ontology, with "None" in all columns for structures without entity
+    :rtype: pandas.core.frame.DataFrame
+
+    """
+    import pandas as pd
+    
+    # fields taken from each entity, and whether the entity holds a taxonomy node with a name or the value itself
+    fields = [('smiles', False), ('inchikey', False), ('kingdom', True), ('superclass', True), ('class', True), 
+              ('subclass', True), ('direct_parent', True), ('molecular_framework', False)]
     
     dmetadatalist = []
     
-    for idx,entry in enumerate(jsondic):
-        
-        mdict = {}
+    for entry in jsondic:
         
-        if (entry != {} and entry != None):
-    
-            if sum([bool(re.match('smiles', x)) for x in entry.keys()]) > 0 and entry['smiles'] is not None:
-                mdict['smiles'] = entry['smiles']
-            if sum([bool(re.match('inchikey', x)) for x in entry.keys()]) > 0 and entry['inchikey'] is not None:
-                mdict['inchikey'] = entry['inchikey']
-            if sum([bool(re.match('kingdom', x)) for x in entry.keys()]) > 0 and entry['kingdom'] is not None:
-                mdict['kingdom'] = entry['kingdom']['name']
-            if sum([bool(re.match('superclass', x)) for x in entry.keys()]) > 0 and entry['superclass'] is not None :
-                mdict['superclass'] = entry['superclass']['name']
-            if sum([bool(re.match('class', x)) for x in entry.keys()]) > 0 and entry['class'] is not None :
-                mdict['class'] = entry['class']['name']
-            if sum([bool(re.match('subclass', x)) for x in entry.keys()]) > 0 and entry['subclass'] is not None:
-                mdict['subclass'] = entry['subclass']['name']
-            if sum([bool(re.match('direct_parent', x)) for x in entry.keys()]) > 0 and entry['direct_parent'] is not None:
-                mdict['direct_parent'] = entry['direct_parent']['name']
-            if sum([bool(re.match('molecular_framework', x)) for x in entry.keys()]) > 0 and entry['molecular_framework'] is not None:
-                mdict['molecular_framework'] = entry['molecular_framework']
+        if entry:
+            mdict = {}
+            for field, named in fields:
+                value = entry.get(field)
+                if value is not None:
+                    mdict[field] = value['name'] if named else value
         else:
-            
-            mdict['smiles'] = "None"
-            mdict['inchikey'] = "None"
-            mdict['kingdom'] = "None"
-            mdict['superclass'] = "None"
-            mdict['class'] = "None"
-            mdict['subclass'] = "None"
-            mdict['direct_parent'] = "None"
-            mdict['molecular_framework'] = "None"
+            mdict = {field: "None" for field, named in fields}
             
         dmetadatalist.append(mdict)
     
@@ -546,28 +1273,52 @@ def make_classy_table(jsondic):
 @author: Ming Wang (https://github.com/mwang87)
 """
 
-def get_structure_class_entity(inchikey):
-    print(inchikey)
-    entity = None
-    try:
-        entity = json.loads(get_entity(inchikey))
-    except KeyboardInterrupt:
-        raise
-    except:
-        new_inchi_no_stereo = inchikey.split("-")[0] + "-UHFFFAOYSA-N"
+def get_structure_class_entity(inchikey, cache = None):
+    logger.debug('Retrieving ClassyFire entity of %s', inchikey)
+    if cache is not None:
+        hits = cache.get_many([inchikey])
+        if inchikey in hits:
+            return hits[inchikey]
+    
+    entity, cacheable = _fetch_structure_class_entity(inchikey)
+    if cache is not None and cacheable:
+        cache.put(inchikey, entity)
+
+    return entity
+
+def _fetch_structure_class_entity(inchikey, get = None):
+    """Fetch the ClassyFire entity of an InChIKey, falling back to the InChIKey without stereo information
+
+    :param inchikey: An InChIKey
+    :type inchikey: str
+    :param get: Function returning the entity JSON of an InChIKey, defaults to get_entity
+    :type get: function
+    :return: The entity, None if it could not be retrieved, and whether the result may be cached (False for connection errors, rate limits and server errors)
+    :rtype: tuple
+    """
+    import requests
+    
+    get = get or get_entity
+    cacheable = True
+    for key in [inchikey, inchikey.split("-")[0] + "-UHFFFAOYSA-N"]:
         try:
-            entity = json.loads(get_entity(new_inchi_no_stereo))
+            return json.loads(get(key)), True
         except KeyboardInterrupt:
             raise
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code == 429 or e.response.status_code >= 500:
+                cacheable = False
+        except ValueError:
+            pass
         except:
-            return entity
+            cacheable = False
 
-    return entity
+    return None, cacheable
 
 
 def get_structure_class(inchikey):
     return_dict = {}
-    print(inchikey)
+    logger.debug('Retrieving ClassyFire entity of %s', inchikey)
     try:
         entity = json.loads(get_entity(inchikey))
     except KeyboardInterrupt:
@@ -577,7 +1328,7 @@ def get_structure_class(inchikey):
         try:
             entity = json.loads(get_entity(new_inchi_no_stereo))
         except:
-            print(inchikey, "Not Cached")
+            logger.info('No ClassyFire entity of %s', inchikey)
             return_dict["inchikey"] = inchikey
             return_dict["superclass"] = "None"
             return_dict["class"] = "None"
@@ -585,7 +1336,8 @@ def get_structure_class(inchikey):
             return return_dict
 
     try:
-        print(json.dumps(entity))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('ClassyFire entity of %s: %s', inchikey, json.dumps(entity))
         return_dict["inchikey"] = inchikey
         if "superclass" in entity:
             return_dict["superclass"] = entity["superclass"]["name"]
@@ -617,6 +1369,45 @@ url = "http://classyfire.wishartlab.com"
 proxy_url =  "https://gnps-classyfire.ucsd.edu"
 chunk_size = 1000
 sleep_interval = 60
+min_sleep_interval = 5
+max_in_flight = 4
+
+
+def install_cache(cache_name='demo_cache', **kwargs):
+    """Cache all HTTP requests of the process in a requests_cache database until uninstall_cache is called
+
+    :param cache_name: Name or path of the cache database
+    :type cache_name: str
+    :param kwargs: Further arguments of requests_cache.install_cache, e.g. backend or expire_after
+
+    >>> install_cache('demo_cache')
+
+    """
+    import requests_cache
+    requests_cache.install_cache(cache_name, **kwargs)
+
+
+def uninstall_cache():
+    """Stop caching HTTP requests installed with install_cache"""
+    import requests_cache
+    requests_cache.uninstall_cache()
+
+
+@contextlib.contextmanager
+def http_cache(cache_name='demo_cache', **kwargs):
+    """Cache HTTP requests in a requests_cache database within a with block only
+
+    :param cache_name: Name or path of the cache database
+    :type cache_name: str
+    :param kwargs: Further arguments of requests_cache.enabled, e.g. backend or expire_after
+
+    >>> with http_cache('demo_cache'):
+    ...     get_classifications('InchiKeys.txt')
+
+    """
+    import requests_cache
+    with requests_cache.enabled(cache_name, **kwargs):
+        yield
 
 
 def structure_query(compound, label='pyclassyfire'):
@@ -636,6 +1427,8 @@ def structure_query(compound, label='pyclassyfire'):
     >>> structure_query('InChI=1S/C3H4O3/c1-2(4)3(5)6/h1H3,(H,5,6)')
 
     """
+    import requests
+    
     r = requests.post(url + '/queries.json', data='{"label": "%s", '
                       '"query_input": "%s", "query_type": "STRUCTURE"}'
                                                   % (label, compound),
@@ -660,6 +1453,8 @@ def iupac_query(compound, label='pyclassyfire'):
     >>> iupac_query('C001\\tethane\\nC002\\tethanol', 'iupac_test')
 
     """
+    import requests
+    
     r = requests.post(url + '/queries.json', data='{"label": "%s", '
                       '"query_input": "%s", "query_type": "IUPAC_NAME"}'
                                                   % (label, compound),
@@ -683,6 +1478,8 @@ def get_results(query_id, return_format="json", blocking=False):
     >>> get_results('595535', 'sdf')
 
     """
+    import requests
+    
     if blocking == False:
         r = requests.get('%s/queries/%s.%s' % (url, query_id, return_format),
                          headers={"Content-Type": "application/%s" % return_format})
@@ -697,7 +1494,7 @@ def get_results(query_id, return_format="json", blocking=False):
             if result_json["classification_status"] != "In Queue":
                 return r.text
             else:
-                print("WAITING")
+                logger.info('ClassyFire query %s is in queue', query_id)
                 time.sleep(10)
 
 
@@ -717,22 +1514,22 @@ def get_entity(inchikey, return_format="json", gnps_proxy = True):
     >>> get_entity("ATUOYWHBWRKTHZ-UHFFFAOYSA-N", 'sdf')
 
     """
+    import requests
+    
     inchikey = inchikey.replace('InChIKey=', '')
+    entity_url = '%s/entities/%s.%s' % (proxy_url if gnps_proxy == True else url, inchikey, return_format)
     
-    if gnps_proxy == True:
-        
-        r = requests.get('%s/entities/%s.%s' % (proxy_url, inchikey, return_format),
-                     headers={
-                         "Content-Type": "application/%s" % return_format})
-        print('%s/entities/%s.%s' % (proxy_url, inchikey, return_format))
-        
-    else:
-        
-        r = requests.get('%s/entities/%s.%s' % (url, inchikey, return_format),
+    start = time.perf_counter()
+    try:
+        r = requests.get(entity_url,
                      headers={
                          "Content-Type": "application/%s" % return_format})
-        print('%s/entities/%s.%s' % (url, inchikey, return_format))
-        
+    finally:
+        metrics.count('classyfire.requests')
+        metrics.observe('classyfire.request_seconds', time.perf_counter() - start)
+    logger.debug('GET %s: %s', entity_url, r.status_code)
+    metrics.count('classyfire.status_%d' % r.status_code)
+    
     r.raise_for_status()
     return r.text
 
@@ -748,6 +1545,8 @@ def get_chemont_node(chemontid):
     >>> get_chemont_node('CHEMONTID:0004253')
 
     """
+    import requests
+    
     chemontid = chemontid.replace("CHEMONTID:", "C")
     r = requests.get('%s/tax_nodes/%s.json' % (url, chemontid),
                      headers={"Content-Type": "application/json" })
@@ -756,10 +1555,18 @@ def get_chemont_node(chemontid):
 
 
 def tabular_query(inpath, structure_key, dialect='excel', outpath=None,
-                  outfields=('taxonomy', 'description', 'substituents')):
+                  outfields=('taxonomy', 'description', 'substituents'), in_flight=None,
+                  checkpoint=None, resume=False):
     """Given a path to a compound set in tabular form (comma or tab delimited)
      annotate all compounds and write results to an expanded table.
 
+    The input is streamed: each structure is submitted with its row number as
+    id, and results are joined back to rows by that id. Chunks of chunk_size
+    compounds are written as soon as their query is done, so rows of different
+    chunks may be written out of input order. Submitted queries and written
+    chunks are logged to a checkpoint file, so that an interrupted run can be
+    resumed without resubmitting finished chunks.
+
     :param inpath: path to compound file to be annotated
     :type inpath: str
     :param structure_key: column heading which contains the compounds InChIKey
@@ -768,59 +1575,130 @@ def tabular_query(inpath, structure_key, dialect='excel', outpath=None,
     :param dialect: dialect for parsing table (generally 'excel' for csv,
          'excel-tab' for tsv)
     :type dialect: str
-    :param outpath: Path to desired output location
+    :param outpath: Path to desired output location, required to resume
     :type outpath: str
     :param outfields: Fields to append to table from ClassyFire output
     :type outfields: tuple(string)
+    :param in_flight: Maximal number of queries submitted at once, defaults to max_in_flight
+    :type in_flight: int
+    :param checkpoint: Path of the checkpoint file, defaults to outpath + '.checkpoint'
+    :type checkpoint: str
+    :param resume: Resume from the checkpoint file if it exists, chunk_size must not have changed
+    :type resume: bool
 
     >>> tabular_query('/tabulated_data.tsv', 'structure', 'excel-tab')
+    >>> tabular_query('/tabulated_data.tsv', 'structure', 'excel-tab', outpath='/annotated.tsv', resume=True)
 
     """
-    tax_fields = ('kingdom', 'superclass', 'class', 'subclass')
-    query_ids = []
-    infile = open(inpath, 'rU')
     if not outpath:
         outpath = _prevent_overwrite(inpath)
-    comps = []
-    for line in csv.DictReader(infile, dialect=dialect):
-        comps.append(line[structure_key])
-        if not len(comps) % chunk_size:
-            query_ids.append(structure_query('\\n'.join(comps)))
-            comps = []
-    if comps:
-        query_ids.append(structure_query('\\n'.join(comps)))
-    print('%s queries submitted to ClassyFire API' % len(query_ids))
-    i = 0
-    infile.seek(0)
-    with open(outpath, 'w') as outfile:
+    checkpoint = checkpoint or outpath + '.checkpoint'
+    state = _read_checkpoint(checkpoint) if resume else None
+    if state is not None and state['chunk_size'] != chunk_size:
+        raise ValueError('%s was written with a chunk_size of %s' % (checkpoint, state['chunk_size']))
+    
+    with open(inpath, newline='') as infile, \
+         open(outpath, 'w' if state is None else 'a', newline='') as outfile, \
+         open(checkpoint, 'w' if state is None else 'a') as log:
         reader = csv.DictReader(infile, dialect=dialect)
         writer = csv.DictWriter(outfile, reader.fieldnames+list(outfields),
                                 dialect=dialect)
-        writer.writeheader()
-        while i < len(query_ids):
-            result = json.loads(get_results(query_ids[i]))
-            if result["classification_status"] == "Done":
-                for j, line in enumerate(reader):
-                    if result['entities'] and str(j+1) == result['entities'][0]['identifier'].split('-')[1]:
-                        hit = result['entities'].pop(0)
-                        if 'taxonomy' in outfields:
-                            hit['taxonomy'] = ";".join(
-                                ['%s:%s' % (hit[x]['name'], hit[x]['chemont_id'])
-                                 for x in tax_fields if hit[x]])
-                        for field in outfields:
-                            if isinstance(hit[field], list):
-                                line[field] = ';'.join(hit[field])
-                            else:
-                                line[field] = hit[field]
-                    writer.writerow(line)
-                i += 1
+        
+        def record(**kwargs):
+            log.write(json.dumps(kwargs) + '\n')
+            log.flush()
+        
+        if state is None:
+            writer.writeheader()
+            outfile.flush()
+            record(chunk_size=chunk_size, offset=outfile.tell())
+            state = {'submitted': {}, 'done': set()}
+        else:
+            # drop rows of a chunk that was being written when the run was interrupted
+            outfile.truncate(state['offset'])
+            log.write('\n')
+        
+        # rows are only held while their chunk is in flight
+        rows = {}
+        def chunks():
+            for index, chunk in enumerate(_chunks(enumerate(reader, 1), chunk_size)):
+                if index not in state['done']:
+                    rows[index] = chunk
+                    yield index, ['%d\\t%s' % (rowid, line[structure_key]) for rowid, line in chunk]
+        
+        for index, query_id, result in _collect_queries(chunks(), in_flight, submitted=state['submitted'],
+                                                         on_submit=lambda index, query_id: record(chunk=index, query_id=query_id)):
+            chunk = rows.pop(index)
+            hits = {}
+            for hit in result['entities']:
+                # identifiers are the submitted row numbers, or Q<query id>-<position in query>
+                identifier = str(hit['identifier'])
+                if identifier.isdigit():
+                    hits[int(identifier)] = hit
+                else:
+                    hits[chunk[0][0] + int(identifier.split('-')[-1]) - 1] = hit
+            for rowid, line in chunk:
+                if rowid in hits:
+                    _annotate_row(line, hits[rowid], outfields)
+                writer.writerow(line)
+            outfile.flush()
+            record(chunk=index, done=True, offset=outfile.tell())
+    
+    os.remove(checkpoint)
+
+
+def _read_checkpoint(path):
+    """Read the checkpoint file of an interrupted tabular_query
+
+    :param path: Path of the checkpoint file
+    :type path: str
+    :return: chunk_size of the run, query ids of submitted chunks, finished chunks and the output size after the last finished chunk, None if there is no checkpoint file
+    :rtype: dict
+    """
+    if not os.path.exists(path):
+        return None
+    state = {'chunk_size': None, 'submitted': {}, 'done': set(), 'offset': 0}
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # blank or partially written line
+                continue
+            if 'chunk_size' in entry:
+                state['chunk_size'] = entry['chunk_size']
+                state['offset'] = entry['offset']
+            elif entry.get('done'):
+                state['done'].add(entry['chunk'])
+                state['offset'] = entry['offset']
             else:
-                print("%s percent complete" % round(i/len(query_ids)*100))
-                time.sleep(sleep_interval)
-    infile.close()
+                state['submitted'][entry['chunk']] = entry['query_id']
+    return state
+
 
+def _annotate_row(line, hit, outfields):
+    """Add ClassyFire output fields of an entity to a table row
 
-def sdf_query(inpath, outpath=None):
+    :param line: A table row
+    :type line: dict
+    :param hit: The ClassyFire entity of the row
+    :type hit: dict
+    :param outfields: Fields to append to table from ClassyFire output
+    :type outfields: tuple(string)
+    """
+    tax_fields = ('kingdom', 'superclass', 'class', 'subclass')
+    if 'taxonomy' in outfields:
+        hit['taxonomy'] = ";".join(
+            ['%s:%s' % (hit[x]['name'], hit[x]['chemont_id'])
+             for x in tax_fields if hit[x]])
+    for field in outfields:
+        if isinstance(hit[field], list):
+            line[field] = ';'.join(hit[field])
+        else:
+            line[field] = hit[field]
+
+
+def sdf_query(inpath, outpath=None, in_flight=None):
     """Given a path to a compound set in a sdf file, annotate all compounds
      and write results as attributes in a sdf file.
 
@@ -828,34 +1706,98 @@ def sdf_query(inpath, outpath=None):
     :type inpath: str
     :param outpath: Path to desired output location
     :type outpath: str
+    :param in_flight: Maximal number of queries submitted at once, defaults to max_in_flight
+    :type in_flight: int
 
     >>> sdf_query('/sdf_data.sdf')
 
     """
     from rdkit.Chem import AllChem
-    query_ids = []
     if not outpath:
         outpath = _prevent_overwrite(inpath)
-    comps = []
-    for mol in AllChem.SDMolSupplier(inpath):
-        if mol:
-            comps.append(AllChem.MolToSmiles(mol))
-        if not len(comps) % chunk_size:
-            query_ids.append(structure_query('/n'.join(comps)))
-            comps = []
-    if comps:
-        query_ids.append(structure_query('\\n'.join(comps)))
-    print('%s queries submitted to ClassyFire API' % len(query_ids))
-    i = 0
+    smiles = (AllChem.MolToSmiles(mol) for mol in AllChem.SDMolSupplier(inpath) if mol)
     with open(outpath, 'w') as outfile:
-        while i < len(query_ids):
-            result = json.loads(get_results(query_ids[i]))
-            if result["classification_status"] == "Done":
-                outfile.write(get_results(query_ids[i], return_format='sdf'))
-                i += 1
+        for index, query_id, result in _collect_queries(enumerate(_chunks(smiles, chunk_size)), in_flight):
+            outfile.write(get_results(query_id, return_format='sdf'))
+
+
+def _chunks(iterable, size):
+    """Split an iterable into lists of at most size items
+
+    :param iterable: Items to split
+    :type iterable: iterable
+    :param size: Number of items per list
+    :type size: int
+    :return: Generator of lists
+    :rtype: generator
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _collect_queries(chunks, in_flight=None, submitted=None, on_submit=None):
+    """Submit chunks of structures to ClassyFire and yield the results of each query as soon as it is done
+
+    Up to in_flight queries are kept in flight; a new chunk is submitted whenever one
+    completes. All pending queries are polled in each round. The wait between rounds starts
+    at min_sleep_interval, doubles while no query completes up to sleep_interval and falls
+    back to min_sleep_interval when one does.
+
+    :param chunks: Pairs of a key and a list of structures, consumed lazily
+    :type chunks: iterable
+    :param in_flight: Maximal number of pending queries, defaults to max_in_flight
+    :type in_flight: int
+    :param submitted: Query ids of chunks submitted earlier by key, these are polled instead of submitted again
+    :type submitted: dict
+    :param on_submit: Called with key and query id whenever a chunk is submitted
+    :type on_submit: function
+    :return: Generator of (key, query id, result) in order of completion
+    :rtype: generator
+    """
+    in_flight = in_flight or max_in_flight
+    chunks = iter(chunks)
+    pending = OrderedDict()
+    interval = min_sleep_interval
+    n_submitted = done = 0
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < in_flight:
+            try:
+                key, compounds = next(chunks)
+            except StopIteration:
+                exhausted = True
+                break
+            if submitted and key in submitted:
+                query_id = submitted[key]
             else:
-                print("%s percent complete" % round(i / len(query_ids) * 100))
-                time.sleep(sleep_interval)
+                query_id = structure_query('\\n'.join(compounds))
+                if on_submit:
+                    on_submit(key, query_id)
+            pending[query_id] = key
+            n_submitted += 1
+        if not pending:
+            return
+        
+        completed = False
+        for query_id in list(pending):
+            result = json.loads(get_results(query_id))
+            if result["classification_status"] == "Done":
+                done += 1
+                completed = True
+                yield pending.pop(query_id), query_id, result
+        
+        if completed:
+            interval = min_sleep_interval
+        elif pending:
+            logger.info('%s of %s submitted queries complete', done, n_submitted)
+            time.sleep(interval)
+            interval = min(interval * 2, sleep_interval)
 
 
 def _prevent_overwrite(write_path, suffix='_annotated'):
@@ -886,6 +1828,8 @@ def run_parallel_shellcommands(input_shell_commands, parallelism_level):
 
 # Wraps the parallel job running, simplifying code
 def run_parallel_job(input_function, input_parameters_list, parallelism_level):
+    from joblib import Parallel, delayed
+    
     if parallelism_level == 1:
         output_results_list = []
         for input_param in input_parameters_list:
@@ -896,7 +1840,20 @@ def run_parallel_job(input_function, input_parameters_list, parallelism_level):
         results = Parallel(n_jobs = parallelism_level)(delayed(input_function)(input_object) for input_object in input_parameters_list)
         return results
         
-def get_classifications(inchifile):
+@metrics.timer('get_classifications')
+def get_classifications(inchifile, cache = None, client = None):
+    """Retrieve ClassyFire entities for all InChIKeys in a file and write them to all_json.json
+
+    :param inchifile: A comma separated file with an InChIKey column
+    :type inchifile: str
+    :param cache: A persistent entity cache, only InChIKeys missing from it are retrieved from ClassyFire
+    :type cache: pyMolNetEnhancer.cache.EntityCache
+    :param client: The client used to retrieve entities, defaults to a ClassyFireClient with default settings
+    :type client: pyMolNetEnhancer.client.ClassyFireClient
+
+    """
+    from .client import ClassyFireClient
+    
 
     with open(inchifile) as csvfile:
         all_inchi_keys = []
@@ -907,13 +1864,30 @@ def get_classifications(inchifile):
             row_count += 1
     
             if row_count % 1000 == 0:
-                print(row_count)
+                logger.info('%d InChIKeys read from %s', row_count, inchifile)
     
             all_inchi_keys.append(row["InChIKey"].split("=")[1])
     
             continue
+        metrics.count('get_classifications.inchikeys', row_count)
     
         #all_inchi_keys = all_inchi_keys[-1000:]
-        all_json = run_parallel_job(get_structure_class_entity, all_inchi_keys, parallelism_level = 50)
+        entities = cache.get_many(all_inchi_keys) if cache is not None else {}
+        misses = list(OrderedDict.fromkeys(k for k in all_inchi_keys if k not in entities))
+        
+        # results stream in as they complete and are cached in batches
+        client = client or ClassyFireClient()
+        fetched = []
+        for inchikey, entity, cacheable in client.iter_entities(misses):
+            entities[inchikey] = entity
+            if cache is not None and cacheable:
+                fetched.append((inchikey, entity))
+                if len(fetched) >= 100:
+                    cache.put_many(fetched)
+                    fetched = []
+        if cache is not None:
+            cache.put_many(fetched)
+        
+        all_json = [entities[k] for k in all_inchi_keys]
     
         open("all_json.json", "w").write(json.dumps(all_json))
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar input and output of pipeline tables.
+
+GNPS node and edge tables, MS2LDA motif summaries and ClassyFire tables are read into
+frames with categorical label columns, and intermediate results are persisted as Parquet.
+On request, text tables are parsed once: a Parquet copy is kept next to them and used
+instead of the text file for as long as the text file is unchanged.
+"""
+# Standard library imports
+import os
+
+# columns read by each pipeline stage, None reads all columns
+network_columns = ['cluster index', 'componentindex']
+motif_columns = ['scans', 'precursormass', 'parentrt', 'document', 'motif', 'probability', 'overlap']
+classyfire_columns = ['SMILES', 'inchikey', 'kingdom', 'superclass', 'CF_class', 'subclass', 'direct_parent', 'molecular_framework']
+edge_columns = None
+final_columns = None
+
+# label columns held as categoricals, so that repeated names are stored once
+motif_categories = ['motif']
+classyfire_categories = ['kingdom', 'superclass', 'CF_class', 'subclass', 'direct_parent', 'molecular_framework']
+final_categories = ['CF_kingdom', 'CF_superclass', 'CF_class', 'CF_subclass', 'CF_Dparent', 'CF_MFramework']
+
+sidecar_suffix = '.parquet'
+
+def read_table(path, columns = None, categorical = None, sep = '\t', cache = False, dtype_backend = None, **kwargs):
+    """Read a table from Parquet or from a delimited text file, optionally keeping a Parquet copy of text files
+
+    Parquet files are read directly. With cache, local text files are parsed once and saved to
+    path + '.parquet', next to the text file. Later reads use this copy as long as it is newer
+    than the text file. Only the requested columns are loaded from Parquet.
+
+    :param path: Path of a .parquet file, a delimited text file or a URL
+    :type path: str
+    :param columns: Columns to load, None loads all columns
+    :type columns: list
+    :param categorical: Columns to convert to categoricals, if present
+    :type categorical: list
+    :param sep: Delimiter of text files
+    :type sep: str
+    :param cache: Whether to keep and use a Parquet copy of local text files
+    :type cache: bool
+    :param dtype_backend: 'pyarrow' for Arrow-backed columns (pandas >= 2.0), None for NumPy-backed columns
+    :type dtype_backend: str
+    :return: The table
+    :rtype: pandas.core.frame.DataFrame
+
+    """
+    import pandas as pd
+
+    columns = list(columns) if columns is not None else None
+    backend = {'dtype_backend': dtype_backend} if dtype_backend is not None else {}
+
+    if path.endswith('.parquet'):
+        table = pd.read_parquet(path, columns=columns, **backend)
+    elif cache and os.path.isfile(path):
+        sidecar = path + sidecar_suffix
+        if not os.path.isfile(sidecar) or os.path.getmtime(sidecar) < os.path.getmtime(path):
+            # parse all columns once, so that the copy serves every stage
+            write_table(_categorize(pd.read_csv(path, sep=sep, **kwargs), categorical), sidecar)
+        table = pd.read_parquet(sidecar, columns=columns, **backend)
+    else:
+        table = pd.read_csv(path, sep=sep, usecols=columns, **dict(kwargs, **backend))
+        if columns is not None:
+            table = table[columns]
+
+    return _categorize(table, categorical)
+
+def iter_table(path, chunksize, columns = None, sep = '\t', cache = False, **kwargs):
+    """Read a table chunk by chunk from Parquet or from a delimited text file, holding one chunk in memory at a time
+
+    Parquet files are read batch by batch. For local text files, the Parquet copy kept by
+    read_table is used while it is newer than the text file. No copy is made here, as that
+    would need the whole table in memory.
+
+    :param path: Path of a .parquet file, a delimited text file or a URL
+    :type path: str
+    :param chunksize: Number of rows per chunk
+    :type chunksize: int
+    :param columns: Columns to load, None loads all columns
+    :type columns: list
+    :param sep: Delimiter of text files
+    :type sep: str
+    :param cache: Whether to use the Parquet copy of local text files
+    :type cache: bool
+    :return: Generator of dataframes, numbered by a running range index
+    :rtype: generator
+
+    """
+    import pandas as pd
+
+    columns = list(columns) if columns is not None else None
+    sidecar = path + sidecar_suffix
+    if not path.endswith('.parquet') and cache and os.path.isfile(sidecar) and os.path.isfile(path) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+        path = sidecar
+
+    start = 0
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            chunk = batch.to_pandas()
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            yield chunk
+    else:
+        with pd.read_csv(path, sep=sep, usecols=columns, chunksize=chunksize, **kwargs) as reader:
+            for chunk in reader:
+                yield chunk[columns] if columns is not None else chunk
+
+def write_table(table, path, index = None):
+    """Write a table to Parquet
+
+    Categorical columns are stored dictionary encoded and read back as categoricals. Object
+    columns that Parquet cannot store, such as columns mixing numbers and strings or lists
+    and strings, are stored as strings, as they would be after a round trip through a text file.
+
+    :param table: The table
+    :type table: pandas.core.frame.DataFrame
+    :param path: Path of the Parquet file
+    :type path: str
+    :param index: Whether to store the index, None stores it unless it is a default range index
+    :type index: bool
+    :return: The path of the Parquet file
+    :rtype: str
+
+    """
+    import pyarrow as pa
+
+    table = table.copy(deep=False)
+    for column in table.columns:
+        if table[column].dtype == object:
+            try:
+                pa.array(table[column].values, from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                table[column] = _as_text(table[column].values)
+
+    table.to_parquet(path, index=index)
+    return path
+
+def write_chunks(chunks, path, sep = '\t'):
+    """Write a table given as chunks with the same columns, holding one chunk in memory at a time
+
+    Parquet files get one row group per chunk. So that all chunks share one schema, object
+    columns are stored as strings in every chunk, as write_table stores columns Parquet cannot
+    store. Text files are written chunk by chunk, with the header of the first chunk.
+    Indexes are not written.
+
+    :param chunks: The chunks of the table
+    :type chunks: iterable
+    :param path: Path of a .parquet file or of a delimited text file
+    :type path: str
+    :param sep: Delimiter of text files
+    :type sep: str
+    :return: The path
+    :rtype: str
+
+    """
+    if not path.endswith('.parquet'):
+        mode = 'w'
+        for chunk in chunks:
+            chunk.to_csv(path, sep=sep, index=False, header=(mode == 'w'), mode=mode)
+            mode = 'a'
+        return path
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for chunk in chunks:
+            chunk = chunk.copy(deep=False)
+            text = [c for c in chunk.columns if chunk[c].dtype == object]
+            for column in text:
+                chunk[column] = _as_text(chunk[column].values)
+            if writer is None:
+                schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                for column in text:
+                    schema = schema.set(schema.get_field_index(column), pa.field(column, pa.string()))
+                writer = pq.ParquetWriter(path, schema)
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    finally:
+        if writer is not None:
+            writer.close()
+    return path
+
+def _as_text(values):
+    # strings of all values, missing values stay missing
+    return [x if x is None or (isinstance(x, float) and x != x) else str(x) for x in values]
+
+def _categorize(table, categorical):
+    import pandas as pd
+
+    for column in categorical or []:
+        if column in table.columns and not isinstance(table[column].dtype, pd.CategoricalDtype):
+            table[column] = table[column].astype('category')
+    return table
+
+def read_gnps_nodes(path, columns = network_columns, **kwargs):
+    """Read a GNPS node table (clusterinfo summary), by default only the columns molfam_classes needs
+
+    :param path: Path of the table
+    :type path: str
+    :param columns: Columns to load, None loads all columns
+    :type columns: list
+    :return: The node table
+    :rtype: pandas.core.frame.DataFrame
+
+    """
+    return read_table(path, columns=columns, **kwargs)
+
+def read_gnps_edges(path, columns = edge_columns, **kwargs):
+    """Read a GNPS edge table (networkedges_selfloop or networking_pairs_results_file_filtered)
+
+    :param path: Path of the table
+    :type path: str
+    :param columns: Columns to load, None loads all columns
+    :type columns: list
+    :return: The edge table
+    :rtype: pandas.core.frame.DataFrame
+
+    """
+    return read_table(path, columns=columns, **kwargs)
+
+def read_motifs(path, columns = motif_columns, categorical = motif_categories, sep = ',', **kwargs):
+    """Read a motif summary file downloaded from MS2LDA, with motif names as categoricals
+
+    :param path: Path or URL of the summary file
+    :type path: str
+    :param columns: Columns to load, None loads all columns
+    :type columns: list
+    :param categorical: Columns to convert to categoricals
+    :type categorical: list
+    :return: The motif summary
+    :rtype: pandas.core.frame.DataFrame
+
+    """
+    return read_table(path, columns=columns, categorical=categorical, sep=sep, **kwargs)
+
+def read_classyfire_table(path, columns = classyfire_columns, categorical = classyfire_categories, **kwargs):
+    """Read a table of chemical classes per InChIKey as returned by make_classy_table and renamed for molfam_classes, with chemical classes as categoricals
+
+    :param path: Path of the table
+    :type path: str
+    :param columns: Columns to load, None loads all columns
+    :type columns: list
+    :param categorical: Columns to convert to categoricals
+    :type categorical: list
+    :return: The table of chemical classes
+    :rtype: pandas.core.frame.DataFrame
+
+    """
+    return read_table(path, columns=columns, categorical=categorical, **kwargs)
+
+def read_classyfire_results(path, columns = final_columns, categorical = final_categories, **kwargs):
+    """Read most predominant chemical classes per node as returned by molfam_classes, with chemical classes as categoricals
+
+    :param path: Path of the table
+    :type path: str
+    :param columns: Columns to load, None loads all columns
+    :type columns: list
+    :param categorical: Columns to convert to categoricals
+    :type categorical: list
+    :return: The table of chemical classes per node
+    :rtype: pandas.core.frame.DataFrame
+
+    """
+    return read_table(path, columns=columns, categorical=categorical, **kwargs)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of ClassyFireClient, RateLimiter and EntityCache against a local stub ClassyFire server.
+"""
+# Standard library imports
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Third party imports
+import pytest
+
+from pyMolNetEnhancer import ClassyFireClient, EntityCache, RateLimiter, metrics
+
+inchikey = 'ATUOYWHBWRKTHZ-QZTJIDSGSA-N'
+flat = 'ATUOYWHBWRKTHZ-UHFFFAOYSA-N'
+entity = {'inchikey': 'InChIKey=' + inchikey, 'kingdom': {'name': 'Organic compounds'}}
+
+
+class StubClassyFire(object):
+    """A ClassyFire server answering each entity path with scripted responses, 404 once they run out"""
+
+    def __init__(self):
+        self.responses = collections.defaultdict(list)
+        self.hits = collections.Counter()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.hits[self.path] += 1
+                queue = stub.responses[self.path]
+                status, headers, body = queue.pop(0) if queue else (404, {}, '{"error": "not found"}')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def respond(self, key, *responses):
+        """Script the responses to the entity of an InChIKey, as (status, headers, body)"""
+        self.responses['/entities/%s.json' % key].extend(responses)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubClassyFire()
+    yield server
+    server.close()
+
+@pytest.fixture
+def client(stub):
+    with ClassyFireClient(base_url=stub.url, max_workers=4, rate=None, max_retries=2, backoff=0.0) as client:
+        yield client
+
+def ok(body = entity):
+    return (200, {'Content-Type': 'application/json'}, json.dumps(body))
+
+def test_retries_server_errors(stub, client):
+    stub.respond(inchikey, (503, {}, ''), (502, {}, ''), ok())
+    with metrics.collect() as registry:
+        assert client.fetch_entity(inchikey) == (entity, True)
+    assert client.stats['requests'] == 3
+    assert client.stats['retries'] == 2
+    assert client.stats['status_503'] == 1 and client.stats['status_502'] == 1 and client.stats['status_200'] == 1
+    assert client.stats['errors'] == 0
+    counters = registry.as_dict()['counters']
+    assert counters['classyfire.requests'] == 3 and counters['classyfire.retries'] == 2
+    assert registry.as_dict()['observations']['classyfire.request_seconds']['n'] == 3
+
+def test_retries_rate_limits_after_retry_after(stub, client):
+    stub.respond(inchikey, (429, {'Retry-After': '0.2'}, ''), ok())
+    start = time.monotonic()
+    assert client.fetch_entity(inchikey) == (entity, True)
+    assert time.monotonic() - start >= 0.2
+    assert client.stats['status_429'] == 1 and client.stats['retries'] == 1
+
+def test_server_errors_beyond_retries_are_not_cacheable(stub, client):
+    stub.respond(inchikey, *[(503, {}, '')] * 3)
+    stub.respond(flat, *[(503, {}, '')] * 3)
+    assert client.fetch_entity(inchikey) == (None, False)
+    # max_retries retries of the InChIKey and of the InChIKey without stereo information
+    assert stub.hits['/entities/%s.json' % inchikey] == 3 and stub.hits['/entities/%s.json' % flat] == 3
+    assert client.stats['retries'] == 4 and client.stats['errors'] == 2
+
+def test_missing_entities_are_cacheable_negative_results(stub, client):
+    assert client.fetch_entity(inchikey) == (None, True)
+    assert client.stats['status_404'] == 2 and client.stats['retries'] == 0
+
+def test_falls_back_to_inchikey_without_stereo_information(stub, client):
+    stub.respond(flat, ok())
+    assert client.fetch_entity(inchikey) == (entity, True)
+    assert client.stats['status_404'] == 1 and client.stats['status_200'] == 1
+
+def test_iter_entities_counts_entities_and_missing(stub, client):
+    keys = ['KEY%08d-QZTJIDSGSA-N' % i for i in range(20)]
+    for key in keys[:15]:
+        stub.respond(key, ok(dict(entity, inchikey='InChIKey=' + key)))
+    stub.respond(keys[15], (500, {}, ''), (500, {}, ''), (500, {}, ''))
+    stub.respond(keys[15].split('-')[0] + '-UHFFFAOYSA-N', (500, {}, ''), (500, {}, ''), (500, {}, ''))
+    results = {k: (e, c) for k, e, c in client.iter_entities(keys)}
+    assert set(results) == set(keys)
+    assert all(results[k] == (dict(entity, inchikey='InChIKey=' + k), True) for k in keys[:15])
+    assert results[keys[15]] == (None, False)
+    assert all(results[k] == (None, True) for k in keys[16:])
+    assert client.stats['entities'] == 15 and client.stats['missing'] == 5
+
+def test_entity_cache_counts_hits_and_misses(tmp_path):
+    with EntityCache(str(tmp_path / 'cache.sqlite')) as cache, metrics.collect() as registry:
+        cache.put_many([(inchikey, entity), ('InChIKey=' + flat, None)])
+        hits = cache.get_many(['InChIKey=' + inchikey, flat, 'MISSING-UHFFFAOYSA-N'])
+    assert hits == {'InChIKey=' + inchikey: entity, flat: None}
+    assert registry.counters == {'cache.writes': 2, 'cache.hits': 2, 'cache.misses': 1}
+
+def test_entity_cache_expires_negative_results(tmp_path):
+    with EntityCache(str(tmp_path / 'cache.sqlite'), negative_ttl=0.1) as cache:
+        cache.put_many([(inchikey, entity), (flat, None)])
+        time.sleep(0.2)
+        assert cache.get_many([inchikey, flat]) == {inchikey: entity}
+
+def test_rate_limiter_spaces_requests():
+    limiter = RateLimiter(20.0, burst=1)
+    start = time.monotonic()
+    for i in range(5):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.15
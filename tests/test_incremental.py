@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of incremental re-annotation against a full run of molfam_classes.
+"""
+# Third party imports
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from pyMolNetEnhancer import molfam_classes, write_classyfire_graphml
+from pyMolNetEnhancer.incremental import load_state, save_state, update_molfam_classes, new_inchikeys, update_missing, changed_nodes, update_classyfire_graphml
+
+levels = ['kingdom', 'superclass', 'CF_class', 'subclass', 'direct_parent', 'molecular_framework']
+
+
+def _strings(table):
+    # the values as written to network files
+    return [[str(v) for v in row] for row in table.astype(object).values.tolist()]
+
+@pytest.fixture
+def network():
+    """A network of molecular families and singletons, with InChIKeys lacking some or all chemical classes"""
+    rng = np.random.RandomState(0)
+    n_nodes = 300
+    comp = rng.randint(1, 40, n_nodes)
+    comp[rng.rand(n_nodes) < 0.3] = -1
+    net = pd.DataFrame({'cluster index': np.arange(1, n_nodes + 1), 'componentindex': comp})
+
+    keys = ['KEY%08d-UHFFFAOYSA-N' % i for i in range(120)]
+    df = pd.DataFrame({'inchikey': keys[:100]})
+    for i, level in enumerate(levels):
+        classes = pd.Series(['%s_%d' % (level, x) for x in rng.randint(0, 3 + i, 100)], dtype=object)
+        # deeper levels are missing more often
+        classes[rng.rand(100) < 0.1 * i] = np.nan
+        df[level] = classes
+    # the last 20 InChIKeys have no chemical classes at all
+    inchi_dic = {int(k): list(rng.choice(keys, rng.randint(1, 4))) for k in np.flatnonzero(rng.rand(n_nodes) < 0.6) + 1}
+    return net, df, inchi_dic
+
+def test_unchanged_update_matches_molfam_classes(network, tmp_path):
+    net, df, inchi_dic = network
+    final = molfam_classes(net.copy(), df, inchi_dic)
+    save_state(str(tmp_path), net, df, inchi_dic, final)
+
+    update = update_molfam_classes(net.copy(), df, inchi_dic, load_state(str(tmp_path)))
+    assert update.attrs['scored_components'] == 0
+    pd.testing.assert_frame_equal(update, final)
+    # None and NaN are equal to assert_frame_equal, not as GraphML attributes
+    assert _strings(update) == _strings(final)
+
+def test_changed_update_matches_molfam_classes(network, tmp_path):
+    net, df, inchi_dic = network
+    save_state(str(tmp_path), net, df, inchi_dic, molfam_classes(net.copy(), df, inchi_dic))
+
+    inchi_dic = dict(inchi_dic)
+    for node in list(inchi_dic)[:10]:
+        inchi_dic[node] = inchi_dic[node][:1] + ['KEY%08d-UHFFFAOYSA-N' % 7]
+    final = molfam_classes(net.copy(), df, inchi_dic)
+
+    update = update_molfam_classes(net.copy(), df, inchi_dic, load_state(str(tmp_path)))
+    assert 0 < update.attrs['scored_components'] < len(set(final['CF_componentindex']))
+    assert _strings(update) == _strings(final)
+
+def test_missing_inchikeys_are_not_looked_up_again(network, tmp_path):
+    net, df, inchi_dic = network
+    missing = update_missing(['KEY%08d-UHFFFAOYSA-N' % i for i in range(100, 120)], None)
+    save_state(str(tmp_path), net, df, inchi_dic, molfam_classes(net.copy(), df, inchi_dic), missing=missing)
+    state = load_state(str(tmp_path))
+
+    keys = ['KEY%08d-UHFFFAOYSA-N' % i for i in range(95, 125)]
+    assert new_inchikeys(keys, state) == keys[25:]
+    # negative results expire
+    assert new_inchikeys(keys, state, negative_ttl=0) == keys[5:]
+    assert new_inchikeys(keys, state, negative_ttl=None) == keys[25:]
+
+def test_updated_network_file_matches_written_network_file(network, tmp_path):
+    nx = pytest.importorskip('networkx')
+    net, df, inchi_dic = network
+    source = str(tmp_path / 'network.graphml')
+    graph = nx.Graph()
+    graph.add_nodes_from((str(v), {'parent mass': float(v)}) for v in net['cluster index'])
+    graph.add_edges_from((str(v), str(v + 1)) for v in net['cluster index'][:-1])
+    nx.write_graphml(graph, source)
+
+    output = str(tmp_path / 'ClassyFireResults_Network.graphml')
+    write_classyfire_graphml(source, molfam_classes(net.copy(), df, inchi_dic), output)
+    save_state(str(tmp_path / 'state'), net, df, inchi_dic, molfam_classes(net.copy(), df, inchi_dic))
+
+    inchi_dic = dict(inchi_dic)
+    for node in list(inchi_dic)[:10]:
+        inchi_dic[node] = inchi_dic[node][:1] + ['KEY%08d-UHFFFAOYSA-N' % 7]
+    final = molfam_classes(net.copy(), df, inchi_dic)
+    nodes = changed_nodes(final, load_state(str(tmp_path / 'state')))
+    assert 0 < len(nodes) < len(net)
+    assert update_classyfire_graphml(output, final, nodes) == len(net)
+
+    expected = str(tmp_path / 'expected.graphml')
+    write_classyfire_graphml(source, final, expected)
+    updated, written = nx.read_graphml(output), nx.read_graphml(expected)
+    assert dict(updated.nodes(data=True)) == dict(written.nodes(data=True))
+    assert sorted(updated.edges()) == sorted(written.edges())